@@ -8,79 +8,170 @@ Created on June 06th 2019
 import argparse
 import os
 import sys
+import time
 from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import pandas as pd
-import pydicom
-from pydicom import uid
-from pydicom.dataset import Dataset
-from pydicom.sequence import Sequence
 
 import anonymization_xml_logs
-from extract_segm_paths_xml import create_tumour_ablation_mapping
+from batch_manifest import MANIFEST_FILENAME, PatientManifest
+from DicomReader import is_dicom_file
+from dcm_edit_plan import TEMP_SUFFIX, DicomEditPlan, set_dataset_tags
+from dicom_header_index import INDEX_FILENAME, DicomHeaderIndex, read_header_record, state_filepath
+from dicom_uid import UIDAllocator, derive_uid
+from extract_segm_paths_xml import SegmentationPathsCollector, create_tumour_ablation_mapping, prefetch_recordings
+from xml_parse_cache import XmlParseCache
 
 
-def anonymize_all_dcm_files(rootdir, patient_name, patient_id, patient_dob):
+def apply_edit_plan(edit_plan, dcm_index, manifest=None, io_threads=1):
+    """
+    Write the planned edits (one read and one atomic write per file) and refresh the index of the written files.
+    :param edit_plan: DicomEditPlan
+    :param dcm_index: DicomHeaderIndex
+    :param manifest: PatientManifest, the files unchanged since the last run are skipped and the written ones recorded
+    :param io_threads: number of reader and of writer threads, for patient folders on network shares
+    :return: number of files written, raise RuntimeError if some files could not be edited (the patient folder is
+    then not marked complete in the manifest)
+    """
+    if manifest is not None:
+        skipped_files = manifest.filter_plan(edit_plan)
+        if skipped_files:
+            print('Files unchanged since the last run, skipped:', skipped_files)
+
+    def on_written(dcm_file):
+        dcm_index.update(dcm_file)
+        if manifest is not None:
+            manifest.file_written(dcm_file, edit_plan.input_hashes.pop(dcm_file, None))
+
+    written_files = edit_plan.apply(on_written, io_threads)
+    return len(written_files)
+
+
+def anonymize_all_dcm_files(rootdir, patient_name, patient_id, patient_dob, dcm_index=None, edit_plan=None):
     """
     :param rootdir:
     :param patient_name:
     :param patient_id:
     :param patient_dob:
+    :param dcm_index: DicomHeaderIndex of rootdir, built if not provided
+    :param edit_plan: DicomEditPlan collecting the edits, the files are written right away if not provided
     :return:
     """
-    for subdir, dirs, files in os.walk(rootdir):
-        for file in sorted(files):  # sort files by date of creation
-            DcmFilePathName = os.path.join(subdir, file)
-            try:
-                dcm_file = os.path.normpath(DcmFilePathName)
-                dataset = pydicom.read_file(dcm_file)
-            except Exception as e:
-                # print(repr(e))
-                continue  # not a DICOM file
-            dataset.PatientName = patient_name
-            dataset.PatientID = patient_id
-            dataset.PatientBirthDate = patient_dob
-            dataset.InstitutionName = "None"
-            dataset.InstitutionAddress = "None"
-            dataset.save_as(dcm_file)
-
-
-def encode_segmentations_dcm_tags(rootdir, patient_name, patient_id, patient_dob):
+    if dcm_index is None:
+        dcm_index = DicomHeaderIndex.build(rootdir)
+    plan = edit_plan if edit_plan is not None else DicomEditPlan()
+    for record in dcm_index.dicom_records():
+        plan.set_tags(record["Path"],
+                      PatientName=patient_name,
+                      PatientID=patient_id,
+                      PatientBirthDate=patient_dob,
+                      InstitutionName="None",
+                      InstitutionAddress="None")
+    if edit_plan is None:
+        apply_edit_plan(plan, dcm_index)
+
+
+def encode_segmentations_dcm_tags(rootdir, patient_name, patient_id, patient_dob, dcm_index=None, edit_plan=None,
+                                  assigned_uids=None, uid_salt=None):
     """
 
     :param rootdir:
     :param patient_name:
     :param patient_id:
     :param patient_dob:
+    :param dcm_index: DicomHeaderIndex of rootdir, built if not provided
+    :param edit_plan: DicomEditPlan collecting the edits, the files are written right away if not provided
+    :param assigned_uids: dict with SeriesInstanceUID (folder -> UID) and SOPInstanceUID (filepath -> UID) assigned by
+    a previous run (see PatientManifest). They are reused and the new UIDs are added to it.
+    :param uid_salt: if given, the new UIDs are derived from the original UIDs and this salt (reproducible),
+    otherwise they are allocated at random (see dicom_uid)
     :return:
     """
+    if dcm_index is None:
+        dcm_index = DicomHeaderIndex.build(rootdir)
+    plan = edit_plan if edit_plan is not None else DicomEditPlan()
+    if assigned_uids is None:
+        assigned_uids = {"SeriesInstanceUID": {}, "SOPInstanceUID": {}}
+    allocator = UIDAllocator()
+
+    def new_uid(uid_type, key, original_uid):
+        # reuse the UID assigned by a previous run, otherwise derive it (uid_salt) or allocate a new one
+        if key not in assigned_uids[uid_type]:
+            if uid_salt is not None:
+                # the CAS-One segmentations share broken UIDs, the path within the patient folder tells them apart
+                relpath = os.path.relpath(key, rootdir).replace(os.sep, '/')
+                assigned_uids[uid_type][key] = derive_uid('%s|%s' % (relpath, original_uid), uid_salt)
+            else:
+                assigned_uids[uid_type][key] = allocator.next_uid()
+        return assigned_uids[uid_type][key]
+
     series_no = 50  # take absurd series number for the segmentations
-    for subdir, dirs, files in os.walk(rootdir):
+    for subdir in dcm_index.folders:
         if ('Segmentations' in subdir) and ('SeriesNo_' in subdir):
             k = 1
             series_no += 1
-            SeriesInstanceUID_segmentation = uid.generate_uid()  # generate a new series instance uid for each folder
-            for file in sorted(files):
-                DcmFilePathName = os.path.join(subdir, file)
-                try:
-                    dcm_file = os.path.normpath(DcmFilePathName)
-                    dataset_segm = pydicom.read_file(dcm_file)
-                except Exception as e:
-                    print(repr(e))
-                    continue  # not a DICOM file
-                # next lines will be executed only if the file is DICOM
-                dataset_segm.PatientName = patient_name
-                dataset_segm.PatientID = patient_id
-                dataset_segm.PatientBirthDate = patient_dob
-                dataset_segm.InstitutionName = "None"
-                dataset_segm.InstitutionAddress = "None"
-                # dataset_segm.SliceLocation = dataset_segm.ImagePositionPatient[2]
-                dataset_segm.SOPInstanceUID = uid.generate_uid()
-                dataset_segm.SeriesInstanceUID = SeriesInstanceUID_segmentation
-                dataset_segm.InstanceNumber = k
-                dataset_segm.SeriesNumber = series_no
+            # generate a new series instance uid for each folder
+            records = dcm_index.files_in(subdir)
+            if not records:
+                continue
+            SeriesInstanceUID_segmentation = new_uid("SeriesInstanceUID", subdir, records[0]["SeriesInstanceUID"])
+            for record in records:
+                SOPInstanceUID_segmentation = new_uid("SOPInstanceUID", record["Path"], record["SOPInstanceUID"])
+                plan.set_tags(record["Path"],
+                              PatientName=patient_name,
+                              PatientID=patient_id,
+                              PatientBirthDate=patient_dob,
+                              InstitutionName="None",
+                              InstitutionAddress="None",
+                              SOPInstanceUID=SOPInstanceUID_segmentation,
+                              SeriesInstanceUID=SeriesInstanceUID_segmentation,
+                              InstanceNumber=k,
+                              SeriesNumber=series_no)
                 k += 1  # increase the instance number
-                dataset_segm.save_as(dcm_file)  # save to disk
+                # the following steps read the new UIDs from the index
+                dcm_index.update(record["Path"],
+                                 SOPInstanceUID=SOPInstanceUID_segmentation,
+                                 SeriesInstanceUID=SeriesInstanceUID_segmentation,
+                                 SeriesNumber=series_no)
+    if edit_plan is None:
+        apply_edit_plan(plan, dcm_index)
+
+
+def general_reference_segmentation_tags(SOPClassUID_segm,
+                                        ReferencedSeriesInstanceUID_segm,
+                                        ReferencedSOPInstanceUID_src,
+                                        StudyInstanceUID_src,
+                                        segment_label,
+                                        lesion_number
+                                        ):
+    """
+    Tags referencing the tumour/ablation and source img in the DICOM segmentation metatags.
+    :param SOPClassUID_segm: SOPClassUID of the segmentation file
+    :param ReferencedSeriesInstanceUID_segm: SeriesInstanceUID of the related segmentation file (tumour or ablation)
+    :param ReferencedSOPInstanceUID_src: SeriesInstanceUID of the source image
+    :param StudyInstanceUID_src: StudyInstanceUID of the source image
+    :param segment_label: text describing whether is tumor or ablation
+    :param: lesion_number: a int identifying which lesion was this
+    :return: dict DICOM keyword -> value, the sequences as lists of dicts
+    """
+    tags = {}
+    if segment_label == "Lession":
+        tags["SegmentLabel"] = "Tumor"
+    elif segment_label == "AblationZone":
+        tags["SegmentLabel"] = "Ablation"
+
+    tags["StudyInstanceUID"] = StudyInstanceUID_src
+    tags["SegmentationType"] = "BINARY"
+    tags["SegmentAlgorithmType"] = "SEMIAUTOMATIC"
+    tags["DerivationDescription"] = "CasOneIR"
+    tags["ImageType"] = "DERIVED\\PRIMARY"
+
+    tags["ReferencedImageSequence"] = [{"ReferencedSOPInstanceUID": ReferencedSeriesInstanceUID_segm,
+                                        "ReferencedSOPClassUID": SOPClassUID_segm,
+                                        "ReferencedSegmentNumber": lesion_number}]
+    tags["SourceImageSequence"] = [{"ReferencedSOPInstanceUID": ReferencedSOPInstanceUID_src}]
+    return tags
 
 
 def add_general_reference_segmentation(dataset_segm,
@@ -100,201 +191,384 @@ def add_general_reference_segmentation(dataset_segm,
     :param: lesion_number: a int identifying which lesion was this
     :return: dicom single file/slice with new General Reference Sequence Tags
     """
+    tags = general_reference_segmentation_tags(dataset_segm.SOPClassUID,
+                                               ReferencedSeriesInstanceUID_segm,
+                                               ReferencedSOPInstanceUID_src,
+                                               StudyInstanceUID_src,
+                                               segment_label,
+                                               lesion_number)
+    return set_dataset_tags(dataset_segm, tags)
 
-    if segment_label == "Lession":
-        dataset_segm.SegmentLabel = "Tumor"
-    elif segment_label == "AblationZone":
-        dataset_segm.SegmentLabel = "Ablation"
-
-    dataset_segm.StudyInstanceUID = StudyInstanceUID_src
-    dataset_segm.SegmentationType = "BINARY"
-    dataset_segm.SegmentAlgorithmType = "SEMIAUTOMATIC"
-    dataset_segm.DerivationDescription = "CasOneIR"
-    dataset_segm.ImageType = "DERIVED\PRIMARY"
-
-    Segm_ds = Dataset()
-    Segm_ds.ReferencedSOPInstanceUID = ReferencedSeriesInstanceUID_segm
-    Segm_ds.ReferencedSOPClassUID = dataset_segm.SOPClassUID
-    Segm_ds.ReferencedSegmentNumber = lesion_number
-
-    Source_ds = Dataset()
-    Source_ds.ReferencedSOPInstanceUID = ReferencedSOPInstanceUID_src
-
-    dataset_segm.ReferencedImageSequence = Sequence([Segm_ds])
-    dataset_segm.SourceImageSequence = Sequence([Source_ds])
 
-    return dataset_segm
-
-
-def create_dict_paths_series_dcm(rootdir):
-    list_all_ct_series = []
-    for subdir, dirs, files in os.walk(rootdir):
+def read_series_folder_headers(subdir, files, n_verify=0):
+    """
+    Read the header of one representative DICOM file of a series folder, the other slices share its SeriesInstanceUID.
+    :param subdir: series folder
+    :param files: filenames in the folder
+    :param n_verify: number of additional slices sampled over the folder to check the SeriesInstanceUID.
+    If one of them belongs to another series, all the files of the folder are read.
+    :return: list of header records (see dicom_header_index.read_header_record)
+    """
+    dcm_files = [os.path.join(subdir, file) for file in sorted(files) if not file.endswith(TEMP_SUFFIX)]
+    dcm_files = [dcm_file for dcm_file in dcm_files if is_dicom_file(dcm_file)]
+    for idx, dcm_file in enumerate(dcm_files):
+        representative_record = read_header_record(dcm_file)
+        if representative_record is not None:
+            break
+    else:
+        return []  # no DICOM file in this folder
+    remaining_files = dcm_files[idx + 1:]
+    if n_verify <= 0 or not remaining_files:
+        return [representative_record]
+    step = max(1, len(remaining_files) // n_verify)
+    for dcm_file in remaining_files[step - 1::step][:n_verify]:
+        record = read_header_record(dcm_file)
+        if record is not None and record["SeriesInstanceUID"] != representative_record["SeriesInstanceUID"]:
+            print('Multiple series found in the folder, reading all the files:', subdir)
+            records = [read_header_record(dcm_file) for dcm_file in dcm_files]
+            return [record for record in records if record is not None]
+    return [representative_record]
+
+
+def create_dict_paths_series_dcm(rootdir, dcm_index=None, n_verify=0):
+    """
+    Map each source CT and segmentation series to its folder.
+    With the DICOM header index no file is parsed. Without it only one representative file per series folder is read
+    (see read_series_folder_headers), for a quick mapping of a folder that is not fixed.
+    :param rootdir:
+    :param dcm_index: DicomHeaderIndex of rootdir
+    :param n_verify: without index, number of additional slices per folder read to check the series is unique
+    :return: list of dicts with SeriesNumber, SeriesInstanceNumberUID, SOPClassUID, StudyInstanceUID and PathSeries
+    """
+    def is_series_folder(subdir):
         # study_0, study_1 case?
         path, foldername = os.path.split(subdir)
-        if ("Series" in foldername) or ("SegmentationNo" in foldername):
-            # get the source image sequence attribute - SOPClassUID
-            for file in sorted(files):
-                try:
-                    dcm_file = os.path.join(subdir, file)
-                    dataset_source_ct = pydicom.read_file(dcm_file)
-                except Exception:
-                    # not dicom file so continue until you find one
-                    continue
-                source_series_instance_uid = dataset_source_ct.SeriesInstanceUID
-                try:
-                    source_study_instance_uid = dataset_source_ct.StudyInstanceUID
-                except Exception:
-                    source_study_instance_uid = None
-                source_series_number = dataset_source_ct.SeriesNumber
-                source_SOP_class_uid = dataset_source_ct.SOPClassUID
-                # if the ct series is not found in the dictionary, add it
-                result = next((item for item in list_all_ct_series if
-                               item["SeriesInstanceNumberUID"] == source_series_instance_uid), None)
-                path_segmentations_idx = subdir.find("Segmentations")
-                if path_segmentations_idx != -1:
-                    path_segmentations_folder = subdir[path_segmentations_idx - 1:]
-                else:
-                    path_segmentations_folder = subdir
-                if result is None:
-                    dict_series_folder = {"SeriesNumber": source_series_number,
-                                          "SeriesInstanceNumberUID": source_series_instance_uid,
-                                          "SOPClassUID": source_SOP_class_uid,
-                                          "StudyInstanceUID": source_study_instance_uid,
-                                          "PathSeries": path_segmentations_folder
-                                          }
-                    list_all_ct_series.append(dict_series_folder)
-    return list_all_ct_series
-
-
-def create_dict_paths_series_xml(rootdir):
+        return ("Series" in foldername) or ("SegmentationNo" in foldername)
+
+    if dcm_index is not None:
+        series_folders = ((subdir, dcm_index.files_in(subdir))
+                          for subdir in dcm_index.folders if is_series_folder(subdir))
+    else:
+        series_folders = ((os.path.normpath(subdir), read_series_folder_headers(subdir, files, n_verify))
+                          for subdir, dirs, files in os.walk(rootdir) if is_series_folder(subdir))
+    dict_all_ct_series = {}  # SeriesInstanceUID -> series folder
+    for subdir, records in series_folders:
+        path_segmentations_idx = subdir.find("Segmentations")
+        if path_segmentations_idx != -1:
+            path_segmentations_folder = subdir[path_segmentations_idx - 1:]
+        else:
+            path_segmentations_folder = subdir
+        # get the source image sequence attribute - SOPClassUID
+        for record in records:
+            source_series_instance_uid = record["SeriesInstanceUID"]
+            # if the ct series is not found in the dictionary, add it
+            if source_series_instance_uid not in dict_all_ct_series:
+                dict_all_ct_series[source_series_instance_uid] = {
+                    "SeriesNumber": record["SeriesNumber"],
+                    "SeriesInstanceNumberUID": source_series_instance_uid,
+                    "SOPClassUID": record["SOPClassUID"],
+                    "StudyInstanceUID": record["StudyInstanceUID"],
+                    "PathSeries": path_segmentations_folder
+                }
+    return list(dict_all_ct_series.values())
+
+
+def create_dict_paths_series_xml(rootdir, xml_workers=1, parse_cache=None):
     """
 
     :param rootdir:
+    :param xml_workers: number of worker processes parsing the recording folders, the records are merged in the
+    same order as the serial parsing
+    :param parse_cache: XmlParseCache, the XMLs unchanged since their records were cached are not parsed
     :return:
     """
-    list_segmentations_paths_xml = []
+    recordings = []
     for subdir, dirs, files in os.walk(rootdir):
         if 'Segmentations' in subdir and 'SeriesNo_' in subdir:
             path_segmentations, foldername = os.path.split(subdir)
             path_recordings, foldername = os.path.split(path_segmentations)
-            dict_segmentations_paths_xml = \
-                create_tumour_ablation_mapping(path_recordings, list_segmentations_paths_xml)
-    df_segmentations_paths_xml = pd.DataFrame(list_segmentations_paths_xml)
+            if path_recordings not in recordings:
+                recordings.append(path_recordings)  # several SeriesNo_ folders of the same recording
+    prefetch_recordings(recordings, xml_workers, parse_cache=parse_cache)
+    segmentation_paths = SegmentationPathsCollector()
+    for path_recordings in recordings:
+        create_tumour_ablation_mapping(path_recordings, segmentation_paths)
+    df_segmentations_paths_xml = segmentation_paths.to_dataframe()
     # check if the dataframe is empty, exit the script if true
     if df_segmentations_paths_xml.empty:
         print("No Segmentations Paths found in the XML Cas-Recordings for Directory:", rootdir)
-        return df_segmentations_paths_xml
-    try:
-        df_segmentations_paths_xml["TimeStartSegmentation"] = df_segmentations_paths_xml["Timestamp"].map(
-            lambda x: x.split()[0])
-    except KeyError:
-        print('The TimeStamp Column in DataFrame is empty')
     return df_segmentations_paths_xml
 
 
-def main_add_reference_tags_dcm(rootdir, df_ct_mapping, df_segmentations_paths_xml):
+def index_rows_by(df, column):
+    """
+    Hash map of the DataFrame index labels for each value of a column, null values are left out.
+    :param df: pandas DataFrame
+    :param column: column name
+    :return: dict value -> list of index labels, in the DataFrame order
     """
+    rows_by_value = {}
+    if column not in df.columns:
+        return rows_by_value
+    for idx, value in zip(df.index, df[column]):
+        if not pd.isnull(value):
+            rows_by_value.setdefault(value, []).append(idx)
+    return rows_by_value
+
 
+def resolve_segmentation_reference(subdir, dcm_index, df_ct_mapping, df_segmentations_paths_xml, reference_maps):
+    """
+    Find the references of a SeriesNo_*/SegmentationNo_* folder once, they are the same for all its slices.
+    :param subdir: segmentation folder
+    :param dcm_index: DicomHeaderIndex of the patient folder
+    :param df_ct_mapping: DataFrame of the DICOM series (create_dict_paths_series_dcm)
+    :param df_segmentations_paths_xml: DataFrame of the XML segmentations (create_dict_paths_series_xml)
+    :param reference_maps: dict of hash maps built by index_rows_by for the columns used in the lookup
+    :return: dict with the arguments of add_general_reference_segmentation or None if the folder cannot be referenced
+    """
+    path_segmentations_idx = subdir.find("Segmentations")
+    path_segmentations_folder = subdir[path_segmentations_idx - 1:]
+    try:
+        idx_segm_xml = reference_maps["xml_PathSeries"][path_segmentations_folder][0]
+    except KeyError:
+        return None
+    # get the timestamp value at the index of the identified segmentation series_uid both the Plan.xml (
+    # tumour path) and Ablation_Validation.xml (ablation) have the same starting time in the XML
+    # find the other segmentation with the matching start time != from the seriesinstanceuid read atm
+    needle_idx_val = df_segmentations_paths_xml.at[idx_segm_xml, "NeedleIdx"]
+    time_start_segm_val = df_segmentations_paths_xml.at[idx_segm_xml, "TimeStartSegmentation"]
+    ReferencedSOPInstanceUID_src = df_segmentations_paths_xml.at[idx_segm_xml, "SourceSeriesID"]
+    # get the SeriesInstanceUID of the source CT from the XML files.
+    # 1) look for it in DF of the source CTs
+    # 2) get the corresponding StudyInstanceUID
+    try:
+        idx_series_source_study_instance_uid = reference_maps["ct_SeriesInstanceNumberUID"].get(
+            ReferencedSOPInstanceUID_src, [])
+        if not idx_series_source_study_instance_uid:
+            series_number = df_segmentations_paths_xml.at[idx_segm_xml, "SeriesNumber"]
+            idx_series_source_study_instance_uid = reference_maps["ct_SeriesNumber"].get(int(series_number), [])
+        if len(idx_series_source_study_instance_uid) > 1:
+            # print('The StudyInstanceUID for the segmentations is not unique at the following address: ', subdir)
+            return None
+        StudyInstanceUID_src = df_ct_mapping.at[idx_series_source_study_instance_uid[0], "StudyInstanceUID"]
+    except Exception as e:
+        # print(repr(e))
+        return None
+    idx_referenced_segm = [el for el in reference_maps["xml_NeedleIdx"].get(needle_idx_val, [])
+                           if el != idx_segm_xml]
+    if len(idx_referenced_segm) > 1:
+        # do the matching based on the time of the segmentations
+        idx_referenced_segm = [el for el in reference_maps["xml_TimeStartSegmentation"].get(time_start_segm_val, [])
+                               if el != idx_segm_xml]
+    # %% get the path series instead of the segmentationseriesuid_xml
+    #  read the SeriesInstanceUID from the DICOM header index (take the path)
+    if idx_referenced_segm:
+        ReferencedSOPInstanceUID_path = df_segmentations_paths_xml.at[idx_referenced_segm[0], "PathSeries"]
+    else:
+        ReferencedSOPInstanceUID_path = None
+    if ReferencedSOPInstanceUID_path is None:
+        segment_label = 0
+        lesion_number = 0
+        ReferencedSeriesInstanceUID_segm = "None"
+    else:
+        referenced_dcm_dir = subdir[0:len(subdir) - len(path_segmentations_folder)] + ReferencedSOPInstanceUID_path
+        referenced_segm_records = dcm_index.files_in(referenced_dcm_dir)
+        if not referenced_segm_records:
+            # print('No Files have been found at the specified address: ', referenced_dcm_dir)
+            return None
+        ReferencedSeriesInstanceUID_segm = referenced_segm_records[0]["SeriesInstanceUID"]
+        segment_label = df_segmentations_paths_xml.at[idx_segm_xml, "SegmentLabel"]
+        lesion_number = needle_idx_val + 1
+    return {"ReferencedSeriesInstanceUID_segm": ReferencedSeriesInstanceUID_segm,
+            "ReferencedSOPInstanceUID_src": ReferencedSOPInstanceUID_src,
+            "StudyInstanceUID_src": StudyInstanceUID_src,
+            "segment_label": segment_label,
+            "lesion_number": lesion_number}
+
+
+def main_add_reference_tags_dcm(rootdir, df_ct_mapping, df_segmentations_paths_xml, dcm_index=None,
+                                edit_plan=None):
+    """
+    Add the references to the source CT and to the related segmentation in each DICOM segmentation file.
+    The references are resolved once per segmentation folder and then written in all its slices.
     :param rootdir:
     :param df_segmentations_paths_xml:
     :param df_ct_mapping:
+    :param dcm_index: DicomHeaderIndex of rootdir, built if not provided
+    :param edit_plan: DicomEditPlan collecting the edits, the files are written right away if not provided
     :return:
     """
-    for subdir, dirs, files in os.walk(rootdir):
-        k = 1
+    if dcm_index is None:
+        dcm_index = DicomHeaderIndex.build(rootdir)
+    plan = edit_plan if edit_plan is not None else DicomEditPlan()
+    reference_maps = {"xml_PathSeries": index_rows_by(df_segmentations_paths_xml, "PathSeries"),
+                      "xml_NeedleIdx": index_rows_by(df_segmentations_paths_xml, "NeedleIdx"),
+                      "xml_TimeStartSegmentation": index_rows_by(df_segmentations_paths_xml, "TimeStartSegmentation"),
+                      "ct_SeriesInstanceNumberUID": index_rows_by(df_ct_mapping, "SeriesInstanceNumberUID"),
+                      "ct_SeriesNumber": index_rows_by(df_ct_mapping, "SeriesNumber")}
+    for subdir in dcm_index.folders:
         if 'Segmentations' in subdir and 'SeriesNo_' in subdir:
-            for file in sorted(files):
-                DcmFilePathName = os.path.join(subdir, file)
-                try:
-                    dcm_file = os.path.normpath(DcmFilePathName)
-                    dataset_segm = pydicom.read_file(dcm_file)
-                except Exception as e:
-                    print(repr(e))
-                    continue  # not a DICOM file
-                path_segmentations_idx = subdir.find("Segmentations")
-                path_segmentations_folder = subdir[path_segmentations_idx - 1:]
-                try:
-                    idx_segm_xml = df_segmentations_paths_xml.index[
-                        df_segmentations_paths_xml["PathSeries"] == path_segmentations_folder].tolist()[0]
-                except Exception as e:
-                    continue
-                    print(repr(e), "whats happening here")
-                # get the timestamp value at the index of the identified segmentation series_uid both the Plan.xml (
-                # tumour path) and Ablation_Validation.xml (ablation) have the same starting time in the XML
-                # find the other segmentation with the matching start time != from the seriesinstanceuid read atm
-                segm_instance_uid_val = df_segmentations_paths_xml.SegmentationSeriesUID_xml[idx_segm_xml]
-                needle_idx_val = df_segmentations_paths_xml.NeedleIdx[idx_segm_xml]
-                time_start_segm_val = df_segmentations_paths_xml.TimeStartSegmentation[idx_segm_xml]
-                ReferencedSOPInstanceUID_src = \
-                    df_segmentations_paths_xml.loc[idx_segm_xml].SourceSeriesID
-                # get the SeriesInstanceUID of the source CT from the XML files.
-                # 1) look for it in DF of the source CTs
-                # 2) get the corresponding StudyInstanceUID
-                try:
-                    idx_series_source_study_instance_uid = df_ct_mapping.index[
-                        df_ct_mapping['SeriesInstanceNumberUID'] == ReferencedSOPInstanceUID_src].tolist()
-
-                    if not idx_series_source_study_instance_uid:
-                        series_number = df_segmentations_paths_xml.loc[idx_segm_xml].SeriesNumber
-                        idx_series_source_study_instance_uid = df_ct_mapping.index[
-                            df_ct_mapping['SeriesNumber'] == int(series_number)].tolist()
-                    if len(idx_series_source_study_instance_uid) > 1:
-                        continue
-                        # print('The StudyInstanceUID for the segmentations is not unique at the following address: ',
-                        #       DcmFilePathName)
-                        # sys.exit()
-                    StudyInstanceUID_src = df_ct_mapping.loc[idx_series_source_study_instance_uid[0]].StudyInstanceUID
+            records = dcm_index.files_in(subdir)
+            if not records:
+                continue
+            reference = resolve_segmentation_reference(subdir, dcm_index, df_ct_mapping, df_segmentations_paths_xml,
+                                                       reference_maps)
+            if reference is None:
+                continue
+            for record in records:
+                plan.set_tags(record["Path"], **general_reference_segmentation_tags(record["SOPClassUID"],
+                                                                                    **reference))
+                dcm_index.update(record["Path"], StudyInstanceUID=reference["StudyInstanceUID_src"])
+    if edit_plan is None:
+        apply_edit_plan(plan, dcm_index)
+
+
+def fix_segmentations_patient_folder(rootdir, patient_name, patient_id, patient_dob, anonymize_all=True,
+                                     dry_run_plan=None, use_manifest=True, io_threads=1, uid_salt=None, xml_workers=1,
+                                     parse_cache_file=None, state_dir=None):
+    """
+    Run all the steps on a single patient folder: anonymize, encode the segmentations, encode the XMLs and add the
+    references to the source CT and the related segmentation.
+    The DICOM edits of all the steps are collected in one plan, then each file is read and written once.
+    :param rootdir: patient folder
+    :param patient_name:
+    :param patient_id:
+    :param patient_dob:
+    :param anonymize_all: anonymize all the DICOM files, not only the segmentations
+    :param dry_run_plan: if given, json filepath where the DICOM edit plan is exported instead of being applied.
+    Nothing is written (neither DICOM, XML, index nor manifest).
+    :param use_manifest: skip the folder and the files unchanged since the last run and reuse the UIDs it assigned.
+    If False the folder is processed from scratch with new UIDs.
+    :param io_threads: number of reader and of writer threads used to write the DICOM edits
+    :param uid_salt: derive the new segmentation UIDs from the original UIDs and this salt instead of random UIDs
+    :param xml_workers: number of worker processes parsing the XML recording folders
+    :param parse_cache_file: SQLite file of the XmlParseCache shared by the runs, None to parse all the XMLs
+    :param state_dir: folder of the DICOM header index and the manifest of the patient folder, default
+    dicom_header_index.DEFAULT_STATE_DIR. Kept out of the patient folder, they hold the original paths, UIDs and hashes.
+    :return: status "Fixed", "No Segmentations" or "Unchanged" (already processed, nothing changed since)
+    """
+    rootdir = os.path.normpath(rootdir)
+    patient = {"Patient Name": patient_name, "Patient_ID": patient_id, "Date_of_Birth": patient_dob,
+               "Anonymize_All": anonymize_all}
+    # the index and the manifest of the earlier runs were saved in the patient folder
+    manifest = PatientManifest(rootdir, state_filepath(rootdir, MANIFEST_FILENAME, state_dir),
+                               ignore_filenames=(INDEX_FILENAME, MANIFEST_FILENAME))
+    if not use_manifest:
+        manifest.reset()
+    elif dry_run_plan is None and manifest.is_unchanged(patient):
+        print('Patient Folder unchanged since the last run, skipped:', rootdir)
+        return "Unchanged"
+    # 0. walk the patient folder and parse the DICOM headers once for all the steps below
+    dcm_index = DicomHeaderIndex.build(rootdir, state_filepath(rootdir, INDEX_FILENAME, state_dir))
+    edit_plan = DicomEditPlan()
+    if dry_run_plan is None:
+        manifest.start(patient)
+    if anonymize_all:
+        # 1. anonymize ALL the DICOM files
+        anonymize_all_dcm_files(rootdir, patient_name, patient_id, patient_dob, dcm_index, edit_plan)
+    # for each patient folder associated with a patient encode the DCM and the XML
+    encode_segmentations_dcm_tags(rootdir, patient_name, patient_id, patient_dob, dcm_index, edit_plan,
+                                  manifest.assigned_uids(), uid_salt)
+    # 2. create dictionary of filepaths and SeriesUIDs
+    list_all_ct_series = create_dict_paths_series_dcm(rootdir, dcm_index)
+    df_ct_mapping = pd.DataFrame(list_all_ct_series)
+    parse_cache = XmlParseCache(parse_cache_file) if parse_cache_file is not None else None
+    try:
+        # 3. XML encoding. rewrite the series and the name in the xml after re-writing the broken series uid
+        if dry_run_plan is None:
+            anonymization_xml_logs.main_encode_xml(rootdir, patient_id, patient_name, patient_dob, df_ct_mapping,
+                                                   parse_cache=parse_cache)
+        # 4. create dict of xml and dicom paths
+        df_segmentations_paths_xml = create_dict_paths_series_xml(rootdir, xml_workers, parse_cache)
+    finally:
+        if parse_cache is not None:
+            parse_cache.close()
+    # 5. Edit each DICOM Segmentation File  by adding reference Source CT and the related segmentation
+    segmentations_found = not df_segmentations_paths_xml.empty
+    if segmentations_found:
+        main_add_reference_tags_dcm(rootdir, df_ct_mapping, df_segmentations_paths_xml, dcm_index, edit_plan)
+    status = "Fixed" if segmentations_found else "No Segmentations"
+    if dry_run_plan is not None:
+        edit_plan.export(dry_run_plan)
+        print("Dry-run, DICOM edit plan of %d files exported to:" % len(edit_plan), dry_run_plan)
+        return status
+    # 6. write all the DICOM edits, one read and one atomic write per file
+    try:
+        apply_edit_plan(edit_plan, dcm_index, manifest, io_threads)
+    finally:
+        # keep the files written, the failed ones are edited again by the next run
+        dcm_index.save()
+        manifest.save()
+    manifest.complete()
+    if not segmentations_found:
+        print('No Segmentations Found for Patient:', rootdir)
+    else:
+        print("Patient Folder Segmentations Fixed:", patient_name)
+    return status
+
+
+def dry_run_plan_filepath(dry_run_dir, patient_id, rootdir):
+    """
+    :return: json filepath of the DICOM edit plan of a patient folder in the dry-run output directory
+    """
+    if dry_run_dir is None:
+        return None
+    foldername = os.path.basename(os.path.normpath(rootdir))
+    return os.path.join(dry_run_dir, '%s_%s_edit_plan.json' % (patient_id, foldername))
+
 
+def process_patient_task(task):
+    """
+    Worker task of the batch processing. Any error is caught so that one patient folder cannot stop the cohort.
+    :param task: dict with Patient_ID, Patient Name, Date_of_Birth, Rootdir, Anonymize_All, Dry_Run_Plan,
+    Use_Manifest, IO_Threads, UID_Salt, XML_Workers, Parse_Cache and State_Dir keys
+    :return: dict with the task keys, Status (Fixed, No Segmentations, Unchanged, Failed), Error and Duration_s
+    """
+    start = time.time()
+    result = {"Patient_ID": task["Patient_ID"], "Patient Name": task["Patient Name"], "Rootdir": task["Rootdir"]}
+    try:
+        result["Status"] = fix_segmentations_patient_folder(task["Rootdir"], task["Patient Name"],
+                                                            task["Patient_ID"], task["Date_of_Birth"],
+                                                            task["Anonymize_All"], task.get("Dry_Run_Plan"),
+                                                            task.get("Use_Manifest", True),
+                                                            task.get("IO_Threads", 1), task.get("UID_Salt"),
+                                                            task.get("XML_Workers", 1), task.get("Parse_Cache"),
+                                                            task.get("State_Dir"))
+        result["Error"] = None
+    except Exception as e:
+        result["Status"] = "Failed"
+        result["Error"] = repr(e)
+    result["Duration_s"] = round(time.time() - start, 2)
+    return result
+
+
+def process_batch(tasks, workers=1):
+    """
+    Process the patient folders of a batch, each folder as an isolated task in a pool of worker processes.
+    :param tasks: list of task dicts (see process_patient_task)
+    :param workers: number of worker processes, 1 runs the tasks one after another in this process
+    :return: pandas DataFrame summary with one row per patient folder, in the order of the tasks
+    """
+    results = [None] * len(tasks)
+    if workers <= 1:
+        for idx, task in enumerate(tasks):
+            results[idx] = process_patient_task(task)
+            print('[%d/%d] %s %s' % (idx + 1, len(tasks), results[idx]["Status"], task["Rootdir"]))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            future_to_idx = {executor.submit(process_patient_task, task): idx for idx, task in enumerate(tasks)}
+            for count, future in enumerate(as_completed(future_to_idx), 1):
+                idx = future_to_idx[future]
+                try:
+                    results[idx] = future.result()
                 except Exception as e:
-                    continue
-                    # print(repr(e))
-                needle_idx_df_xml = df_segmentations_paths_xml.index[
-                    df_segmentations_paths_xml["NeedleIdx"] == needle_idx_val].tolist()
-                idx_referenced_segm = [el for el in needle_idx_df_xml if el != idx_segm_xml]
-                if len(idx_referenced_segm) > 1:
-                    # print('The SeriesInstanceUID for the segmentations is not unique at the following address: ',
-                    #       DcmFilePathName)
-                    # do the matching based on the time of the segmentations
-                    time_start_idx_df_xml = df_segmentations_paths_xml.index[
-                        df_segmentations_paths_xml["TimeStartSegmentation"] == time_start_segm_val].tolist()
-                    idx_referenced_segm = [el for el in time_start_idx_df_xml if el != idx_segm_xml]
-
-                # %% get the path series instead of the segmentationseriesuid_xml
-                #  read the SeriesInstanceUID from the DICOM file (take the path)
-                if idx_referenced_segm:
-                    ReferencedSOPInstanceUID_path = \
-                        df_segmentations_paths_xml.loc[idx_referenced_segm[0]].PathSeries
-                elif len(idx_referenced_segm) > 1:
-                    print('Multiple Segmentation Folders present.,'
-                          'Please clean ')
-                    sys.exit()
-                else:
-                    ReferencedSOPInstanceUID_path = None
-                if ReferencedSOPInstanceUID_path is None:
-                    segment_label = 0
-                    lesion_number = 0
-                    ReferencedSOPInstanceUID_ds = "None"
-                    ReferencedSeriesInstanceUID_segm = "None"
-                else:
-                    referenced_dcm_dir = subdir[
-                                         0:len(subdir) - len(path_segmentations_folder)] + ReferencedSOPInstanceUID_path
-                    try:
-                        segm_file = os.listdir(referenced_dcm_dir)[0]
-                    except FileNotFoundError:
-                        # print('No Files have been found at the specified address: ', referenced_dcm_dir)
-                        continue  # go back to the beginning of the loop
-                    ReferencedSOPInstanceUID_ds = pydicom.read_file(os.path.join(referenced_dcm_dir, segm_file))
-                    ReferencedSeriesInstanceUID_segm = ReferencedSOPInstanceUID_ds.SeriesInstanceUID
-                    segment_label = df_segmentations_paths_xml.loc[idx_segm_xml].SegmentLabel
-                    lesion_number = df_segmentations_paths_xml.loc[idx_segm_xml].NeedleIdx + 1
-                # call function to change the segmentation uid
-                dataset_segm = add_general_reference_segmentation(dataset_segm,
-                                                                  ReferencedSeriesInstanceUID_segm,
-                                                                  ReferencedSOPInstanceUID_src,
-                                                                  StudyInstanceUID_src,
-                                                                  segment_label,
-                                                                  lesion_number)
-                dataset_segm.save_as(dcm_file)  # save to disk
+                    # the worker process itself died (eg. out of memory)
+                    results[idx] = {"Patient_ID": tasks[idx]["Patient_ID"],
+                                    "Patient Name": tasks[idx]["Patient Name"],
+                                    "Rootdir": tasks[idx]["Rootdir"],
+                                    "Status": "Failed", "Error": repr(e), "Duration_s": None}
+                print('[%d/%d] %s %s' % (count, len(tasks), results[idx]["Status"], tasks[idx]["Rootdir"]))
+    return pd.DataFrame(results, columns=["Patient_ID", "Patient Name", "Rootdir", "Status", "Error", "Duration_s"])
 
 
 # %%
@@ -311,6 +585,30 @@ if __name__ == '__main__':
                     help="input Excel file for batch processing, eg: Batch_processing_MAVERRIC")
     ap.add_argument("-a", '--anonymize_all_dcm_files', required=True,
                     help='flag whether to anonymize all the dcm files or not')
+    ap.add_argument("-w", "--workers", required=False, type=int, default=1,
+                    help="number of patient folders processed in parallel in batch processing. eg: 4")
+    ap.add_argument("-s", "--batch_summary", required=False,
+                    help="output Excel file with the status of each patient folder after batch processing")
+    ap.add_argument("-p", "--dry_run_dir", required=False,
+                    help="dry-run: export the DICOM edit plan of each patient folder as json to this directory, "
+                         "without modifying the patient folders")
+    ap.add_argument("--ignore_manifest", required=False, action="store_true",
+                    help="process all the patient folders from scratch with new UIDs, even if unchanged since the "
+                         "last run")
+    ap.add_argument("-t", "--io_threads", required=False, type=int, default=1,
+                    help="number of threads reading and of threads writing the DICOM files of a patient folder, "
+                         "for folders on network shares. eg: 8")
+    ap.add_argument("--uid_salt", required=False,
+                    help="derive the new segmentation UIDs from the original UIDs and this salt, reruns from scratch "
+                         "give the same UIDs")
+    ap.add_argument("--xml_workers", required=False, type=int, default=1,
+                    help="number of processes parsing the XML recording folders of a patient folder. eg: 4")
+    ap.add_argument("--parse_cache", required=False,
+                    help="SQLite file caching the values read from the XML recordings across runs, the unchanged XMLs "
+                         "are not parsed again. eg: xml_parse_cache.sqlite")
+    ap.add_argument("--state_dir", required=False,
+                    help="folder of the state files of the runs (DICOM header index, manifest), kept out of the "
+                         "patient folders. default ~/.segmentation_fix_state")
     args = vars(ap.parse_args())
     if args["patient_name"] is not None:
         print("Patient Name:", args["patient_name"])
@@ -334,54 +632,33 @@ if __name__ == '__main__':
         df['Patient_Dir_Paths'] = df['Patient_Dir_Paths'].apply(literal_eval)
         # remove the dash from the PatientName variable
         df['Patient Name'] = df['Patient Name'].map(lambda x: x.split('-')[0] + x.split('-')[1])
+        tasks = []
         for idx in range(len(df)):
-            patient_id = str(df["Patient_ID"].iloc[idx])
-            patient_dob = str(df['Date_of_Birth'].iloc[idx])
-            patient_name = str(df['Patient Name'].iloc[idx])
-            patient_dir_paths = df.Patient_Dir_Paths[idx]
-            if len(patient_dir_paths) > 0:
-                for rootdir in patient_dir_paths:
-                    rootdir = os.path.normpath(rootdir)
-                    # 1. anonymize ALL the DICOM files
-                    if args["anonymize_all_dcm_files"] == 'True':
-                        anonymize_all_dcm_files(rootdir, patient_name, patient_id, patient_dob)
-                    # for each patient folder associated with a patient encode the DCM and the XML
-                    encode_segmentations_dcm_tags(rootdir, patient_name, patient_id, patient_dob)
-                    # 2. create dictionary of filepaths and SeriesUIDs
-                    list_all_ct_series = create_dict_paths_series_dcm(rootdir)
-                    df_ct_mapping = pd.DataFrame(list_all_ct_series)
-                    # 3. XML encoding. rewrite the series and the name in the xml after re-writing the broken series uid
-                    anonymization_xml_logs.main_encode_xml(rootdir, patient_id, patient_name, patient_dob,
-                                                           df_ct_mapping)
-                    # 4. create dict of xml and dicom paths
-                    df_segmentations_paths_xml = create_dict_paths_series_xml(rootdir)
-                    # 5. Edit each DICOM Segmentation File  by adding reference Source CT and the related segmentation
-                    if df_segmentations_paths_xml.empty:
-                        print('No Segmentations Found for Patient:', rootdir)
-                        continue
-                    else:
-                        main_add_reference_tags_dcm(rootdir, df_ct_mapping, df_segmentations_paths_xml)
-                        print("Patient Folder Segmentations Fixed:", patient_name)
+            for rootdir in df.Patient_Dir_Paths[idx]:
+                tasks.append({"Patient_ID": str(df["Patient_ID"].iloc[idx]),
+                              "Patient Name": str(df['Patient Name'].iloc[idx]),
+                              "Date_of_Birth": str(df['Date_of_Birth'].iloc[idx]),
+                              "Rootdir": os.path.normpath(rootdir),
+                              "Anonymize_All": args["anonymize_all_dcm_files"] == 'True',
+                              "Dry_Run_Plan": dry_run_plan_filepath(args["dry_run_dir"], df["Patient_ID"].iloc[idx],
+                                                                    rootdir),
+                              "Use_Manifest": not args["ignore_manifest"],
+                              "IO_Threads": args["io_threads"],
+                              "UID_Salt": args["uid_salt"],
+                              "XML_Workers": args["xml_workers"],
+                              "Parse_Cache": args["parse_cache"],
+                              "State_Dir": args["state_dir"]})
+        df_summary = process_batch(tasks, args["workers"])
+        print(df_summary.to_string(index=False))
+        print(df_summary["Status"].value_counts().to_string())
+        if args["batch_summary"] is not None:
+            df_summary.to_excel(args["batch_summary"], index=False)
 
     else:
         # single patient folder
-        if args["anonymize_all_dcm_files"] == 'True':
-            # 1. anonymize ALL the DICOM files
-            anonymize_all_dcm_files(args["rootdir"], args["patient_name"], args["patient_id"], args["patient_dob"])
-        # 2. create dictionary of filepaths and SeriesUIDs
-        encode_segmentations_dcm_tags(args["rootdir"], args["patient_name"], args["patient_id"], args["patient_dob"])
-        # 3. XML encoding. rewrite the series and the name in the xml after re-writing the broken series uid
-        list_all_ct_series = create_dict_paths_series_dcm(args["rootdir"])
-        df_ct_mapping = pd.DataFrame(list_all_ct_series)
-        # 4. create dict of xml and dicom paths
-        anonymization_xml_logs.main_encode_xml(args["rootdir"], args["patient_id"], args["patient_name"],
-                                               args["patient_dob"], df_ct_mapping)
-        # create dict of xml and dicom paths
-        df_segmentations_paths_xml = create_dict_paths_series_xml(args["rootdir"])
-        # 5. Edit each DICOM Segmentation File  by adding reference Source CT and the related segmentation
-        if df_segmentations_paths_xml.empty:
-            print('No Segmentations Found for Patient:', args["rootdir"])
-        else:
-            # Edit each DICOM Segmentation File  by adding reference Source CT and the related segmentation
-            main_add_reference_tags_dcm(args["rootdir"], df_ct_mapping, df_segmentations_paths_xml)
-            print("Patient Folder Segmentations Fixed:", args["patient_name"])
+        fix_segmentations_patient_folder(args["rootdir"], args["patient_name"], args["patient_id"],
+                                         args["patient_dob"], args["anonymize_all_dcm_files"] == 'True',
+                                         dry_run_plan_filepath(args["dry_run_dir"], args["patient_id"],
+                                                               args["rootdir"]),
+                                         not args["ignore_manifest"], args["io_threads"], args["uid_salt"],
+                                         args["xml_workers"], args["parse_cache"], args["state_dir"])
@@ -4,32 +4,92 @@ Created on Wed Apr 25 13:45:50 2018
 
 @author: Raluca Sandu
 """
+import argparse
+import io
+import json
 import os
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+
 import numpy as np
 import SimpleITK as sitk
 import pydicom
+
+DICM_PREAMBLE_LENGTH = 128
+DICM_PREFIX = b'DICM'
+GEOMETRY_TAGS = ["ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing", "InstanceNumber",
+                 "SliceLocation", "SliceThickness", "Rows", "Columns", "SeriesInstanceUID"]
+DISCOVERY_TAGS = GEOMETRY_TAGS + ["StudyInstanceUID", "SeriesNumber", "Modality", "SeriesDescription"]
+SLICE_SPACING_TOLERANCE = 0.01  # mm
+DEFAULT_VOLUME_CACHE_BYTES = 2 * 1024 ** 3
+DECODE_CHUNK_SLICES = 8  # slices decoded per task of the process pool
 #%%
 
 
-def read_dcm_series(folder_path, reader_flag=True):
+def read_dcm_series(folder_path, reader_flag=True, cache_dir=None, memory_cache=None, series_uid=None,
+                    series_index=None):
     """
     Read DICOM Series/Single Image from a folder path into a SimpleITK Image Object.
     :param folder_path: directory address containing DICOM Images
     :param reader_flag:
+    :param cache_dir: folder of the on-disk volume cache (see volume_cache), the series is decoded only once. On a
+    cache hit the reader is a volume_cache.CachedSeriesReader (file names and metadata of the slices).
+    :param memory_cache: VolumeCache of the run, the image returned is a copy the caller can modify
+    :param series_uid: SeriesInstanceUID of the series to read when the folder has several, default the first
+    series found by GDCM
+    :param series_index: result of discover_series, the sorted files of series_uid are taken from it instead of
+    scanning the folder again
     :return: SimpleITK Image Object
     """
 
-    try:
-        if next(os.walk(folder_path), None) is None:
-            # single DICOM File
+    if os.path.isfile(folder_path):
+        # single DICOM File
+        try:
             image = sitk.ReadImage(os.path.normpath(folder_path), sitk.sitkInt16)
-            return image, None
-    except Exception:
-        print('Non-readable DICOM Data: ', folder_path)
-        return None
+            if reader_flag:
+                return image, None
+            else:
+                return image
+        except Exception:
+            print('Non-readable DICOM Data: ', folder_path)
+            return None
+    if not os.path.isdir(folder_path) or (series_index is not None and series_uid not in series_index):
+        print('Non-readable DICOM Data: ', folder_path, series_uid or '')
+        if reader_flag:
+            return None, None
+        else:
+            return None
+    if memory_cache is not None:
+        key = ("read_dcm_series", source_key(folder_path), cache_dir is not None, series_uid)
+        image, reader = memory_cache.get_or_load(key, lambda: read_dcm_series(folder_path, True, cache_dir, None,
+                                                                              series_uid, series_index))
+        if reader_flag:
+            return image, reader
+        else:
+            return image
+    if cache_dir is not None:
+        # a cache hit returns the image GDCM read on the miss, with a CachedSeriesReader for its metadata
+        from volume_cache import VolumeDiskCache
+        series_path = list(series_index[series_uid]["Files"]) if series_index is not None else folder_path
+        image, reader = VolumeDiskCache(cache_dir).load_image(series_path, series_uid)
+        if reader_flag:
+            return image, reader
+        else:
+            return image
+    dicom_names = None
+    if series_index is not None:
+        dicom_names = series_index[series_uid]["Files"]
+    elif series_uid is not None:
+        dicom_names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(os.path.normpath(folder_path), series_uid)
     # DICOM Series
     reader = sitk.ImageSeriesReader()
-    dicom_names = reader.GetGDCMSeriesFileNames(os.path.normpath(folder_path))
+    if dicom_names is None:
+        dicom_names = reader.GetGDCMSeriesFileNames(os.path.normpath(folder_path))
     reader.SetFileNames(dicom_names)
     # Configure the reader to load all of the DICOM tags (public+private):
     # By default tags are not loaded (saves time).
@@ -51,7 +111,74 @@ def read_dcm_series(folder_path, reader_flag=True):
         else:
             return None
 
-def read_single_dcm(path):
+def read_dcm_series_array(folder_path, cache_dir=None, series_uid=None, series_index=None):
+    """
+    Read a DICOM series as a NumPy array, for the callers that do not need a SimpleITK Image. With cache_dir a warm
+    cache hit is the memory-mapped cached volume, neither decoded nor copied.
+    :param folder_path: directory address containing DICOM Images
+    :param cache_dir: folder of the on-disk volume cache (see volume_cache)
+    :param series_uid: SeriesInstanceUID of the series to read when the folder has several
+    :param series_index: result of discover_series (see read_dcm_series)
+    :return: (z, y, x) volume and geometry dict (Origin, Spacing, Direction, Size, Files), None, None if the series
+    is not readable
+    """
+    if cache_dir is not None:
+        from volume_cache import VolumeDiskCache
+        series_path = list(series_index[series_uid]["Files"]) if series_index is not None else folder_path
+        return VolumeDiskCache(cache_dir).load_series(series_path, series_uid)
+    image, reader = read_dcm_series(folder_path, True, series_uid=series_uid, series_index=series_index)
+    if image is None:
+        return None, None
+    geometry = {"Origin": image.GetOrigin(),
+                "Spacing": image.GetSpacing(),
+                "Direction": image.GetDirection(),
+                "Size": image.GetSize(),
+                "Files": list(reader.GetFileNames()) if reader is not None else [folder_path]}
+    return sitk.GetArrayFromImage(image), geometry
+
+
+def is_dicom_file(path):
+    """
+    Cheap check of the 128 bytes preamble followed by the "DICM" prefix, without parsing and without raising.
+    :param path: filepath
+    :return: True if the file starts like a DICOM Part 10 file
+    """
+    try:
+        with open(path, 'rb') as fp:
+            header = fp.read(DICM_PREAMBLE_LENGTH + len(DICM_PREFIX))
+    except OSError:
+        return False
+    return header[DICM_PREAMBLE_LENGTH:] == DICM_PREFIX
+
+
+def read_dcm_metadata(path, tags=None, defer_size=1024):
+    """
+    Header-only read: stop before the pixel data, defer the large elements and optionally parse only some tags.
+    :param path: filepath
+    :param tags: list of DICOM keywords or tags to read, all the header tags if None
+    :param defer_size: elements larger than this (bytes) are read only when accessed
+    :return: pydicom Dataset without pixel data or None if the file is not DICOM
+    """
+    if not is_dicom_file(path):
+        return None
+    try:
+        ds = pydicom.read_file(path, defer_size=defer_size, stop_before_pixels=True, specific_tags=tags)
+    except Exception:
+        return None
+    return ds
+
+
+def read_single_dcm(path, metadata_only=False, tags=None):
+    """
+    :param path: filepath
+    :param metadata_only: read only the header (see read_dcm_metadata)
+    :param tags: with metadata_only, the list of DICOM keywords to read
+    :return: pydicom Dataset or None if the file is not DICOM
+    """
+    if metadata_only:
+        return read_dcm_metadata(path, tags)
+    if not is_dicom_file(path):
+        return None
     try:
         ds = pydicom.read_file(path)
     except Exception:
@@ -73,3 +200,613 @@ def read_dcm_series_pydicom(path):
         s.SliceThickness = slice_thickness
         
     return slices
+
+
+def slice_normal(orientation):
+    """
+    :param orientation: ImageOrientationPatient, row and column direction cosines
+    :return: unit vector orthogonal to the slice plane
+    """
+    orientation = np.asarray(orientation, dtype=np.float64)
+    normal = np.cross(orientation[0:3], orientation[3:6])
+    return normal / np.linalg.norm(normal)
+
+
+def sort_slices(headers):
+    """
+    Order the slices along the slice normal: ImagePositionPatient projected onto the normal of the first slice.
+    Falls back on InstanceNumber if a slice has no position or orientation.
+    :param headers: list of (filepath, header Dataset or dict of the tag values)
+    :return: the sorted list and the slice positions along the normal (None with the InstanceNumber order)
+    """
+    orientation = headers[0][1].get("ImageOrientationPatient")
+    try:
+        if not orientation or not all(ds.get("ImagePositionPatient") for filepath, ds in headers):
+            raise ValueError('no slice position')
+        normal = slice_normal(orientation)
+        positions = np.array([np.dot(normal, np.asarray(ds.get("ImagePositionPatient"), dtype=np.float64))
+                              for filepath, ds in headers])
+    except (TypeError, ValueError, IndexError):
+        return sorted(headers, key=lambda header: int(header[1].get("InstanceNumber", 0) or 0)), None
+    order = np.argsort(positions, kind='stable')
+    return [headers[i] for i in order], positions[order]
+
+
+def series_geometry(sorted_headers, positions):
+    """
+    :param sorted_headers: list of (filepath, header Dataset) sorted along the slice normal
+    :param positions: slice positions along the normal, None if unknown
+    :return: dict with the SimpleITK style Origin (x, y, z), Spacing (x, y, z), Direction (row major 3x3) and the
+    sorted Files
+    """
+    first = sorted_headers[0][1]
+    pixel_spacing = [float(value) for value in first.get("PixelSpacing", [1, 1])]
+    if positions is not None and len(positions) > 1:
+        slice_spacing = float(np.median(np.diff(positions)))
+    else:
+        slice_spacing = float(first.get("SliceThickness", 1) or 1)
+    orientation = [float(value) for value in first.get("ImageOrientationPatient", [1, 0, 0, 0, 1, 0])]
+    normal = slice_normal(orientation)
+    direction = np.column_stack([orientation[0:3], orientation[3:6], normal])
+    origin = [float(value) for value in first.get("ImagePositionPatient", [0, 0, 0])]
+    return {"Origin": tuple(origin),
+            "Spacing": (pixel_spacing[1], pixel_spacing[0], slice_spacing),
+            "Direction": tuple(direction.flatten().tolist()),
+            "Files": [filepath for filepath, ds in sorted_headers]}
+
+
+def series_filepaths(path):
+    """
+    :param path: folder of the series or list of the series filepaths
+    :return: list of the filepaths, the files of a folder sorted by name
+    """
+    if isinstance(path, str):
+        filepaths = [os.path.join(path, f) for f in sorted(os.listdir(path))]
+        return [f for f in filepaths if os.path.isfile(f)]
+    return list(path)
+
+
+def read_series_geometry(path, workers=None):
+    """
+    Header-only pass over a single DICOM series, the headers are read by a thread pool.
+    :param path: folder of the series or list of the series filepaths, the non-DICOM files are skipped
+    :param workers: number of reading threads, default the number of CPUs
+    :return: geometry (see series_geometry) with the Size (x, y, z) of the volume, None if no DICOM slice was found
+    """
+    filepaths = series_filepaths(path)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        headers = [(filepath, ds) for filepath, ds in
+                   zip(filepaths, executor.map(lambda f: read_dcm_metadata(f, GEOMETRY_TAGS), filepaths))
+                   if ds is not None]
+    if not headers:
+        return None
+    sorted_headers, positions = sort_slices(headers)
+    geometry = series_geometry(sorted_headers, positions)
+    shapes = set((int(ds.Rows), int(ds.Columns)) for filepath, ds in sorted_headers)
+    if len(shapes) > 1:
+        raise ValueError('Slices of different sizes in the series: %s' % sorted(shapes))
+    rows, columns = shapes.pop()
+    geometry["Size"] = (columns, rows, len(sorted_headers))
+    return geometry
+
+
+def read_file_bytes(filepath):
+    with open(filepath, 'rb') as fp:
+        return fp.read()
+
+
+def decode_slice(filepath, volume_slice, rescale=True, content=None):
+    """
+    Decode the pixel data of a single slice into an allocated array, the dataset is dropped on return.
+    :param filepath: DICOM filepath
+    :param volume_slice: (y, x) NumPy array written in place, eg. a z-slice of the volume
+    :param rescale: apply RescaleSlope and RescaleIntercept (Hounsfield Units for CT), rounded to the nearest integer
+    for an integer array (a float32 volume keeps the fractional values)
+    :param content: bytes of the file if already read, otherwise the file is read
+    :return:
+    """
+    ds = pydicom.read_file(io.BytesIO(content) if content is not None else filepath)
+    slope = float(ds.get("RescaleSlope", 1) or 1) if rescale else 1.0
+    intercept = float(ds.get("RescaleIntercept", 0) or 0) if rescale else 0.0
+    if slope == 1 and intercept.is_integer():
+        volume_slice[...] = ds.pixel_array
+        if intercept != 0:
+            volume_slice += volume_slice.dtype.type(intercept)
+    else:
+        values = ds.pixel_array * slope + intercept
+        if np.issubdtype(volume_slice.dtype, np.integer):
+            # round to the nearest value, the cast alone truncates towards zero
+            values = np.rint(values)
+        volume_slice[...] = values
+
+
+# slots of the shared memory segment the pool processes decode the slices into, attached once per process
+_decode_slots = None
+
+
+def _attach_decode_slots(name, shape, dtype):
+    global _decode_slots
+    segment = shared_memory.SharedMemory(name=name)
+    _decode_slots = (segment, np.ndarray(shape, dtype=dtype, buffer=segment.buf))
+
+
+def _decode_slices_into_slots(filepaths, first_slot, rescale):
+    for idx, filepath in enumerate(filepaths):
+        decode_slice(filepath, _decode_slots[1][first_slot + idx], rescale)
+    return first_slot
+
+
+def decode_slices_processes(filepaths, volume, processes, rescale=True):
+    """
+    Decode the slices in a pool of processes, for the decoding to use several cores (it holds the GIL in threads).
+    Each task decodes DECODE_CHUNK_SLICES slices into slots of a shared memory segment (2 tasks per process in
+    flight), the slots are copied into the volume in slice order and reused. The volume is a normal array and the
+    peak memory is one volume plus the slots.
+    :param filepaths: DICOM filepaths in slice order
+    :param volume: (z, y, x) NumPy array written in place
+    :param processes: number of decoding processes
+    :param rescale: apply RescaleSlope and RescaleIntercept
+    :return:
+    """
+    chunk = DECODE_CHUNK_SLICES
+    n_chunks = (len(filepaths) + chunk - 1) // chunk
+    n_blocks = min(2 * processes, n_chunks)
+    slot_shape = (n_blocks * chunk,) + volume.shape[1:]
+    segment = shared_memory.SharedMemory(create=True, size=int(np.prod(slot_shape)) * volume.itemsize)
+    try:
+        slots = np.ndarray(slot_shape, dtype=volume.dtype, buffer=segment.buf)
+
+        def submit(executor, idx):
+            return executor.submit(_decode_slices_into_slots, filepaths[idx * chunk:(idx + 1) * chunk],
+                                   (idx % n_blocks) * chunk, rescale)
+        with ProcessPoolExecutor(max_workers=processes, initializer=_attach_decode_slots,
+                                 initargs=(segment.name, slot_shape, volume.dtype.str)) as executor:
+            decodes = deque(submit(executor, idx) for idx in range(n_blocks))
+            for idx in range(n_chunks):
+                first_slot = decodes.popleft().result()
+                z = idx * chunk
+                n_slices = min(chunk, len(filepaths) - z)
+                volume[z:z + n_slices] = slots[first_slot:first_slot + n_slices]
+                if idx + n_blocks < n_chunks:
+                    decodes.append(submit(executor, idx + n_blocks))
+        del slots
+    finally:
+        segment.close()
+        segment.unlink()
+
+
+def read_dcm_volume(path, workers=1, dtype=np.int16, rescale=True, memory_cache=None, processes=None):
+    """
+    Read a single DICOM series into one (z, y, x) NumPy array.
+    The headers are read first to sort the slices and allocate the volume, then the slices are decoded one by one
+    straight into the volume. Each dataset is dropped once its slice is copied, so the peak memory is about one
+    volume plus one slice. The decoding (pydicom parsing, pixel conversion) holds the GIL and runs in the calling
+    thread; with workers > 1 the files are read ahead by that many threads, for storage with a high latency. With
+    processes > 1 the slices are decoded by a pool of processes (see decode_slices_processes), for several cores.
+    :param path: folder of the series or list of the series filepaths, the non-DICOM files are skipped
+    :param workers: number of threads reading the files ahead of the decoding, 1 for serial reads
+    :param dtype: dtype of the volume
+    :param rescale: apply RescaleSlope and RescaleIntercept (Hounsfield Units for CT)
+    :param memory_cache: VolumeCache of the run, the volume returned is a read-only view of the cached volume
+    :param processes: number of decoding processes, None or 1 to decode in the calling process
+    :return: volume and geometry (see read_series_geometry), None, None if no DICOM slice was found
+    """
+    if memory_cache is not None:
+        key = ("read_dcm_volume", source_key(path), np.dtype(dtype).str, rescale)
+        return memory_cache.get_or_load(key, lambda: read_dcm_volume(path, workers, dtype, rescale,
+                                                                     processes=processes))
+    geometry = read_series_geometry(path, workers)
+    if geometry is None:
+        return None, None
+    columns, rows, slices = geometry["Size"]
+    volume = np.empty((slices, rows, columns), dtype=dtype)
+    filepaths = geometry["Files"]
+    if processes is not None and processes > 1:
+        decode_slices_processes(filepaths, volume, processes, rescale)
+        return volume, geometry
+    if workers is None or workers <= 1:
+        for z in range(slices):
+            decode_slice(filepaths[z], volume[z], rescale)
+        return volume, geometry
+    # at most 2 * workers files read ahead are held in memory
+    read_ahead = 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reads = deque(executor.submit(read_file_bytes, filepath) for filepath in filepaths[:read_ahead])
+        for z in range(slices):
+            content = reads.popleft().result()
+            if z + read_ahead < slices:
+                reads.append(executor.submit(read_file_bytes, filepaths[z + read_ahead]))
+            decode_slice(filepaths[z], volume[z], rescale, content)
+    return volume, geometry
+
+
+def header_record(ds):
+    """
+    :param ds: header Dataset read with the DISCOVERY_TAGS
+    :return: dict of the present DISCOVERY_TAGS values as json types (lists of floats, int, str)
+    """
+    record = {}
+    for tag in DISCOVERY_TAGS:
+        value = ds.get(tag)
+        if value is None or value == '':
+            continue
+        if tag in ("ImagePositionPatient", "ImageOrientationPatient", "PixelSpacing"):
+            record[tag] = [float(item) for item in value]
+        elif tag in ("SliceLocation", "SliceThickness"):
+            record[tag] = float(value)
+        elif tag in ("InstanceNumber", "Rows", "Columns", "SeriesNumber"):
+            record[tag] = int(value)
+        else:
+            record[tag] = str(value)
+    return record
+
+
+def series_issues(sorted_headers, positions):
+    """
+    Consistency checks of a series before it is read as a volume.
+    :param sorted_headers: list of (filepath, header record) sorted along the slice normal
+    :param positions: slice positions along the normal, None if unknown
+    :return: list of the issues found, empty for a regular volume
+    """
+    issues = []
+    if len(set((ds.get("Rows"), ds.get("Columns")) for filepath, ds in sorted_headers)) > 1:
+        issues.append('slices of different sizes')
+    orientations = set(tuple(np.round(ds.get("ImageOrientationPatient", []), 4)) for filepath, ds in sorted_headers)
+    if len(orientations) > 1:
+        issues.append('slices of different orientations')
+    if positions is None:
+        issues.append('no slice position, sorted by InstanceNumber')
+    elif len(positions) > 1:
+        gaps = np.diff(positions)
+        if np.any(gaps < SLICE_SPACING_TOLERANCE):
+            issues.append('duplicate slice positions')
+        gaps = gaps[gaps >= SLICE_SPACING_TOLERANCE]
+        if len(gaps) and gaps.max() - gaps.min() > SLICE_SPACING_TOLERANCE:
+            issues.append('irregular slice spacing (%.3f to %.3f mm)' % (gaps.min(), gaps.max()))
+    return issues
+
+
+def discover_series(rootdir, workers=None, cache_file=None):
+    """
+    Find every DICOM series under a folder tree: a single walk, the headers read in parallel (header only, the
+    DISCOVERY_TAGS) and the files grouped by SeriesInstanceUID.
+    :param rootdir: folder to scan, eg. a patient folder
+    :param workers: number of header reading threads, default the number of CPUs
+    :param cache_file: json file of the header records, the files unchanged (same size and mtime) since it was
+    written are not read again
+    :return: dict SeriesInstanceUID -> series dict with StudyInstanceUID, SeriesNumber, Modality, SeriesDescription,
+    Folders, the Files sorted along the slice normal, Origin, Spacing, Direction, Size (x, y, z), SliceSpacing
+    (min, max), Issues (see series_issues) and Consistent, in the order the series were found
+    """
+    rootdir = os.path.normpath(rootdir)
+    cached_files = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r') as fp:
+                saved = json.load(fp)
+            if saved.get("rootdir") == rootdir:
+                cached_files = saved["files"]
+        except (OSError, ValueError, KeyError):
+            cached_files = {}
+    files = {}
+    to_read = []
+    for subdir, dirs, filenames in os.walk(rootdir):
+        dirs.sort()
+        for filename in sorted(filenames):
+            filepath = os.path.normpath(os.path.join(subdir, filename))
+            if cache_file is not None and filepath == os.path.normpath(cache_file):
+                continue
+            stat = os.stat(filepath)
+            cached = cached_files.get(filepath)
+            if cached is not None and cached["Size"] == stat.st_size and cached["Mtime"] == stat.st_mtime_ns:
+                files[filepath] = cached
+            else:
+                files[filepath] = {"Size": stat.st_size, "Mtime": stat.st_mtime_ns, "Header": None}
+                to_read.append(filepath)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for filepath, ds in zip(to_read, executor.map(lambda f: read_dcm_metadata(f, DISCOVERY_TAGS), to_read)):
+            files[filepath]["Header"] = header_record(ds) if ds is not None else None
+    if cache_file is not None and to_read:
+        with open(cache_file, 'w') as fp:
+            json.dump({"rootdir": rootdir, "files": files}, fp)
+
+    headers_by_series = OrderedDict()
+    for filepath, file_record in files.items():
+        header = file_record["Header"]
+        if header is not None and "SeriesInstanceUID" in header:
+            headers_by_series.setdefault(header["SeriesInstanceUID"], []).append((filepath, header))
+    series_index = OrderedDict()
+    for series_uid, headers in headers_by_series.items():
+        sorted_headers, positions = sort_slices(headers)
+        series = series_geometry(sorted_headers, positions)
+        first = sorted_headers[0][1]
+        series.update({"SeriesInstanceUID": series_uid,
+                       "StudyInstanceUID": first.get("StudyInstanceUID"),
+                       "SeriesNumber": first.get("SeriesNumber"),
+                       "Modality": first.get("Modality"),
+                       "SeriesDescription": first.get("SeriesDescription"),
+                       "Folders": sorted(set(os.path.dirname(filepath) for filepath, ds in sorted_headers)),
+                       "Size": (first.get("Columns"), first.get("Rows"), len(sorted_headers)),
+                       "SliceSpacing": None,
+                       "Issues": series_issues(sorted_headers, positions)})
+        if positions is not None and len(positions) > 1:
+            gaps = np.diff(positions)
+            series["SliceSpacing"] = (float(gaps.min()), float(gaps.max()))
+        series["Consistent"] = not series["Issues"]
+        series_index[series_uid] = series
+    return series_index
+
+
+def source_key(path):
+    """
+    Cache key of the files a volume is read from: the size and mtime (ns) of each file, so a file added, removed or
+    rewritten in place (eg. mmap patch, os.replace that keeps the folder mtime) gives a new key.
+    :param path: folder or list of filepaths
+    :return: hashable key
+    """
+    if isinstance(path, str):
+        filepaths = [os.path.join(path, f) for f in os.listdir(path)]
+        path = [f for f in filepaths if os.path.isfile(f)]
+    key = []
+    for filepath in sorted(os.path.normpath(f) for f in path):
+        stat = os.stat(filepath)
+        key.append((filepath, stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
+
+
+def shared_copy(value):
+    """
+    Copy of a cached value that the caller can modify without changing the cache: a SimpleITK Image copy (the pixel
+    buffer is copied on the first write only), a read-only view of a NumPy array.
+    :param value: NumPy array, SimpleITK Image or tuple of them, other items are returned as they are
+    :return: the copy
+    """
+    if isinstance(value, tuple):
+        return tuple(shared_copy(item) for item in value)
+    if isinstance(value, sitk.Image):
+        return sitk.Image(value)
+    if isinstance(value, np.ndarray):
+        view = value.view()
+        view.flags.writeable = False
+        return view
+    return value
+
+
+def cached_nbytes(value):
+    """
+    :param value: NumPy array, SimpleITK Image or tuple of them (other items count as 0)
+    :return: size in bytes of the pixel data
+    """
+    if isinstance(value, tuple):
+        return sum(cached_nbytes(item) for item in value)
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, sitk.Image):
+        return value.GetNumberOfPixels() * value.GetNumberOfComponentsPerPixel() * value.GetSizeOfPixelComponent()
+    return 0
+
+
+class VolumeCache(object):
+
+    def __init__(self, max_bytes=DEFAULT_VOLUME_CACHE_BYTES):
+        """
+        In-process cache of the decoded volumes and masks of a batch run, least recently used entries evicted first
+        above the memory budget. get and get_or_load return a shared_copy of the cached value: the Images can be
+        modified by the caller, the arrays are read-only.
+        :param max_bytes: memory budget of the cached pixel data
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.peak_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.evicted_bytes = 0
+        self.oversized = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: hashable key, eg. built with source_key
+        :return: a shared_copy of the cached value, None if not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return shared_copy(entry[0])
+
+    def put(self, key, value):
+        """
+        Cache the value, evicting the least recently used entries to stay within the budget.
+        A value larger than the whole budget is not cached.
+        :param key: hashable key
+        :param value: NumPy array, SimpleITK Image or tuple of them
+        :return: True if the value was cached
+        """
+        nbytes = cached_nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                self.oversized += 1
+                return False
+            while self.nbytes + nbytes > self.max_bytes:
+                evicted_key, (evicted_value, evicted_nbytes) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+                self.evicted_bytes += evicted_nbytes
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self.peak_bytes = max(self.peak_bytes, self.nbytes)
+            return True
+
+    def get_or_load(self, key, load_fn):
+        """
+        :param key: hashable key
+        :param load_fn: function() -> value, called on a miss, a value without pixel data is returned but not cached
+        :return: a shared_copy of the cached or loaded value
+        """
+        value = self.get(key)
+        if value is None:
+            value = load_fn()
+            if cached_nbytes(value) > 0:
+                self.put(key, value)
+            value = shared_copy(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        :return: dict of the hits, misses, evictions and memory use since the cache was created
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "evicted_bytes": self.evicted_bytes,
+                    "oversized": self.oversized,
+                    "entries": len(self._entries),
+                    "bytes": self.nbytes,
+                    "peak_bytes": self.peak_bytes,
+                    "max_bytes": self.max_bytes}
+
+
+def benchmark_metadata_read(folder, tags=None, repeat=50):
+    """
+    Compare full reads (caught exception for non-DICOM) with the header-only read and the DICM sniff.
+    :param folder: directory with DICOM files, eg. mask_img
+    :param tags: list of DICOM keywords for the header-only read
+    :param repeat: how many times each folder pass is repeated
+    :return: dict of seconds per file for each read mode
+    """
+    filepaths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))]
+    filepaths = [f for f in filepaths if os.path.isfile(f)]
+
+    def full_read(path):
+        try:
+            return pydicom.read_file(path)
+        except Exception:
+            return None
+
+    read_modes = {"full read": full_read,
+                  "metadata read": lambda path: read_dcm_metadata(path),
+                  "metadata read, selected tags": lambda path: read_dcm_metadata(path, tags)}
+    timings = {}
+    for name, read_mode in read_modes.items():
+        start = time.perf_counter()
+        for i in range(repeat):
+            for path in filepaths:
+                ds = read_mode(path)
+                if ds is not None and tags is not None:
+                    # access the tags as the callers do, values are converted on first access
+                    [ds.get(tag) for tag in tags]
+        timings[name] = (time.perf_counter() - start) / (repeat * len(filepaths))
+    start = time.perf_counter()
+    for i in range(repeat):
+        for path in filepaths:
+            is_dicom_file(path)
+    timings["DICM sniff"] = (time.perf_counter() - start) / (repeat * len(filepaths))
+    return timings
+
+
+def benchmark_volume_read(folder, workers=4, repeat=3, processes=None):
+    """
+    Compare reading the series as a list of datasets stacked afterwards (read_dcm_series_pydicom + np.stack as
+    utilCThistogram.get_pixels_hu does) with read_dcm_volume, serial, with the files read ahead by threads and
+    decoded by a pool of processes.
+    :param folder: folder of a single DICOM series
+    :param workers: number of read-ahead threads of read_dcm_volume
+    :param repeat: number of reads of each mode, the best time is kept
+    :param processes: number of decoding processes, default the number of cores. The traced peak memory is the one of
+    the calling process, without the pool processes.
+    :return: dict read mode -> (seconds, peak traced memory in MB)
+    """
+    def stacked_read():
+        slices = read_dcm_series_pydicom(folder)
+        return np.stack([s.pixel_array for s in slices]).astype(np.int16)
+
+    processes = processes if processes is not None else max(os.cpu_count() or 1, 2)
+    read_modes = {"datasets + np.stack": stacked_read,
+                  "read_dcm_volume": lambda: read_dcm_volume(folder)[0],
+                  "read_dcm_volume, read-ahead": lambda: read_dcm_volume(folder, max(workers, 2))[0],
+                  "read_dcm_volume, %d processes" % processes: lambda: read_dcm_volume(folder,
+                                                                                      processes=processes)[0]}
+    timings = {}
+    for name, read_mode in read_modes.items():
+        seconds = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            read_mode()
+            seconds.append(time.perf_counter() - start)
+        # separate traced read, tracing slows down the allocations
+        tracemalloc.start()
+        read_mode()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        timings[name] = (min(seconds), peak / 1024 ** 2)
+    return timings
+
+
+def benchmark_series_discovery(rootdir, workers=None):
+    """
+    Compare the folder walk with a GDCM scan of each folder (GetGDCMSeriesIDs + GetGDCMSeriesFileNames) with
+    discover_series, cold and with its header cache.
+    :param rootdir: folder tree to scan
+    :param workers: number of header reading threads of discover_series
+    :return: dict scan mode -> (seconds, number of series found)
+    """
+    def gdcm_scan():
+        series_files = {}
+        for subdir, dirs, files in os.walk(rootdir):
+            for series_uid in sitk.ImageSeriesReader.GetGDCMSeriesIDs(subdir):
+                series_files[series_uid] = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(subdir, series_uid)
+        return series_files
+
+    cache_file = os.path.join(tempfile.mkdtemp(), 'series_index.json')
+    scan_modes = {"GDCM scan per folder": gdcm_scan,
+                  "discover_series": lambda: discover_series(rootdir, workers),
+                  "discover_series, cold cache": lambda: discover_series(rootdir, workers, cache_file),
+                  "discover_series, warm cache": lambda: discover_series(rootdir, workers, cache_file)}
+    timings = {}
+    for name, scan_mode in scan_modes.items():
+        start = time.perf_counter()
+        found = scan_mode()
+        timings[name] = (time.perf_counter() - start, len(found))
+    os.remove(cache_file)
+    os.rmdir(os.path.dirname(cache_file))
+    return timings
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--folder", required=False, default="mask_img", help="folder with DICOM files to time")
+    ap.add_argument("-r", "--repeat", required=False, type=int, default=50, help="number of passes over the folder")
+    ap.add_argument("-s", "--series", required=False, help="folder of a DICOM series to time the volume read")
+    ap.add_argument("-w", "--workers", required=False, type=int, default=1,
+                    help="threads reading the files ahead of the volume decoding, header reading threads")
+    ap.add_argument("-p", "--processes", required=False, type=int,
+                    help="processes decoding the volume slices, default the number of cores")
+    ap.add_argument("-d", "--discover", required=False, help="folder tree to time the series discovery")
+    args = vars(ap.parse_args())
+    if args["discover"] is not None:
+        for name, (seconds, n_series) in benchmark_series_discovery(args["discover"], args["workers"]).items():
+            print('%-30s %8.3f s  %d series' % (name, seconds, n_series))
+    if args["series"] is not None:
+        for name, (seconds, peak_mb) in benchmark_volume_read(args["series"], max(args["workers"], 2),
+                                                                 processes=args["processes"]).items():
+            print('%-30s %8.3f s  peak %8.1f MB' % (name, seconds, peak_mb))
+    uid_tags = ["SOPInstanceUID", "SeriesInstanceUID", "StudyInstanceUID", "SeriesNumber", "SOPClassUID"]
+    timings = benchmark_metadata_read(args["folder"], uid_tags, args["repeat"])
+    for name, seconds in timings.items():
+        print('%-30s %8.1f us/file  (x%.1f)' % (name, seconds * 1e6, timings["full read"] / seconds))
@@ -3,10 +3,14 @@
 @author: Raluca Sandu
 """
 
+import argparse
+
 import numpy as np
 import scipy
 import SimpleITK as sitk
 
+import DicomReader
+
 
 class ResizeSegmentation(object):
 
@@ -14,6 +18,7 @@ class ResizeSegmentation(object):
         """
 
         :param ablation_segmentation:  the larger image onto which we want to resample (either a source ct image or another segmentation)
+        or only its geometry, a dict with Origin, Spacing, Direction and Size (see DicomReader.read_dcm_series_array)
         :param tumor_segmentation:  the segmentation image
         Both images should be into SimpleITK Format.
         """
@@ -21,6 +26,25 @@ class ResizeSegmentation(object):
         self.tumor_segmentation = tumor_segmentation
         self.ablation_segmentation = ablation_segmentation
 
+    @classmethod
+    def from_series(cls, reference_path, segmentation_path, cache_dir=None):
+        """
+        Read the reference series and the segmentation from their DICOM folders.
+        :param reference_path: folder of the series onto which the segmentation is resampled
+        :param segmentation_path: folder of the segmentation
+        :param cache_dir: folder of the on-disk volume cache (see volume_cache), on a cache hit the reference is not
+        decoded, only the geometry of its memory-mapped volume is used
+        :return: ResizeSegmentation, None if a series is not readable
+        """
+        if cache_dir is not None:
+            reference = DicomReader.read_dcm_series_array(reference_path, cache_dir)[1]
+        else:
+            reference = DicomReader.read_dcm_series(reference_path, False)
+        segmentation = DicomReader.read_dcm_series(segmentation_path, False, cache_dir)
+        if reference is None or segmentation is None:
+            return None
+        return cls(reference, segmentation)
+
     def resample_segmentation_pydicom(self, scan, new_spacing=[1,1,1]):
         """
 
@@ -61,13 +85,20 @@ class ResizeSegmentation(object):
         :return: new_segmentation of the image_roi
         """
         resampler = sitk.ResampleImageFilter()
-        resampler.SetReferenceImage(self.ablation_segmentation)  # the ablation mask
+        if isinstance(self.ablation_segmentation, dict):
+            # geometry of the reference, eg. of a memory-mapped cached volume
+            resampler.SetOutputOrigin(self.ablation_segmentation["Origin"])
+            resampler.SetSize([int(size) for size in self.ablation_segmentation["Size"]])
+            resampler.SetOutputSpacing(self.ablation_segmentation["Spacing"])
+            resampler.SetOutputDirection(self.ablation_segmentation["Direction"])
+        else:
+            resampler.SetReferenceImage(self.ablation_segmentation)  # the ablation mask
+            resampler.SetSize(self.ablation_segmentation.GetSize())
+            resampler.SetOutputSpacing(self.ablation_segmentation.GetSpacing())
+            resampler.SetOutputDirection(self.ablation_segmentation.GetDirection())
         resampler.SetDefaultPixelValue(0)
         # use NearestNeighbor interpolation for the ablation&tumor segmentations so no new labels are generated
         resampler.SetInterpolator(sitk.sitkNearestNeighbor)
-        resampler.SetSize(self.ablation_segmentation.GetSize())
-        resampler.SetOutputSpacing(self.ablation_segmentation.GetSpacing())
-        resampler.SetOutputDirection(self.ablation_segmentation.GetDirection())
         resampled_img = resampler.Execute(self.tumor_segmentation)  # the tumour mask
         return resampled_img
 
@@ -114,4 +145,16 @@ class ResizeSegmentation(object):
         # paste the roi mask into the re-sized image
         pasted_img = sitk.Paste(outputImage, image_roi, image_roi.GetSize(), destinationIndex=destinationIndex)
 
-        return pasted_img
\ No newline at end of file
+        return pasted_img
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-r", "--reference", required=True, help="folder of the DICOM series to resample onto")
+    ap.add_argument("-s", "--segmentation", required=True, help="folder of the DICOM segmentation to resample")
+    ap.add_argument("-o", "--output", required=True, help="output image file, eg. segmentation_resampled.nii.gz")
+    ap.add_argument("-c", "--cache_dir", required=False, default=None, help="folder of the decoded volumes cache")
+    args = vars(ap.parse_args())
+    resizer = ResizeSegmentation.from_series(args["reference"], args["segmentation"], args["cache_dir"])
+    if resizer is not None:
+        sitk.WriteImage(resizer.resample_segmentation(), args["output"])
@@ -4,8 +4,105 @@ Created on June 06th 2019
 
 @author: Raluca Sandu
 """
+import mmap
 import os
+import re
+import shutil
+import tempfile
 import xml.etree.ElementTree as ET
+import xml.sax
+from xml.sax.saxutils import XMLGenerator
+from xml.sax.xmlreader import AttributesImpl
+
+from xml_parse_cache import HashingFile
+
+XML_TEMP_SUFFIX = ".xmlenc.tmp"
+XML_METADATA_KIND = "encode_xml_metadata"  # XmlParseCache entries of the encoded metadata of each XML
+# start tags of the elements changed by the encoding, searched in the raw bytes before parsing
+ENCODED_ELEMENTS_PATTERN = re.compile(rb'<(PatientInfo|PatientData|Segmentation)[\s/>]')
+UTF16_BOMS = (b'\xff\xfe', b'\xfe\xff')
+
+
+def xml_needs_encoding(filename):
+    """
+    Prescan of the raw bytes of an XML (memory-mapped, no parsing) for the elements changed by the encoding.
+    :param filename: XML filepath
+    :return: False if the file has no PatientInfo, PatientData or Segmentation element and can be skipped
+    """
+    if os.path.getsize(filename) == 0:
+        return False
+    with open(filename, 'rb') as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:2] in UTF16_BOMS:
+                return True  # the tags are not ascii bytes, let the parser decide
+            return ENCODED_ELEMENTS_PATTERN.search(mm) is not None
+
+
+def encoded_attributes(patient_id, patient_name, patient_dob):
+    """
+    :return: dict element name -> attributes written by the encoding, for the PatientInfo and PatientData elements
+    """
+    return {"PatientInfo": {"ID": patient_id,
+                            "Initial": patient_name,
+                            "DOB": patient_dob[0:4] + '-01-01'},
+            "PatientData": {"seriesPath": " ",
+                            "patientID": patient_id}}
+
+
+def encoding_needed(metadata, patient_id, patient_name, patient_dob, series_uid_of_path):
+    """
+    Tell from the metadata cached after the last encoding of a file if encoding it again would change anything.
+    :param metadata: StreamingXmlEncoder.metadata of the file
+    :param patient_id:
+    :param patient_name:
+    :param patient_dob:
+    :param series_uid_of_path: function(Segmentation Path) -> new SeriesUID
+    :return: True if an attribute or a SeriesUID would change
+    """
+    attributes = encoded_attributes(patient_id, patient_name, patient_dob)
+    for name, list_attributes in metadata["attributes"].items():
+        if any(element_attributes != attributes[name] for element_attributes in list_attributes):
+            return True
+    for path, series_uid in metadata["segmentations"]:
+        new_series_uid = series_uid_of_path(path)
+        if new_series_uid is not None and str(new_series_uid) != series_uid:
+            return True
+    return False
+
+
+class SeriesUIDMap(object):
+
+    def __init__(self, df_ct_mapping):
+        """
+        PathSeries -> SeriesInstanceUID of the DICOM series of a patient, built once for all the XMLs of the patient.
+        The first row of a PathSeries wins, as with the DataFrame lookup.
+        :param df_ct_mapping: DataFrame with the PathSeries and SeriesInstanceNumberUID of the DICOM series
+        """
+        self.series_uids = {}
+        if "PathSeries" in df_ct_mapping.columns and "SeriesInstanceNumberUID" in df_ct_mapping.columns:
+            for path, series_uid in zip(df_ct_mapping["PathSeries"], df_ct_mapping["SeriesInstanceNumberUID"]):
+                self.series_uids.setdefault(path, series_uid)
+        self.misses = {}  # (XML filename, Segmentation Path) not found, in the order they were found
+
+    def lookup(self, path, filename=None):
+        """
+        :param path: Segmentation Path as written in the XML
+        :param filename: XML filename, for the report of the misses
+        :return: the SeriesInstanceUID of the series found at path, None if there is none (the miss is recorded)
+        """
+        series_uid = self.series_uids.get(path)
+        if series_uid is None:
+            self.misses[(filename, path)] = None
+        return series_uid
+
+    def report_misses(self):
+        """
+        Print the Segmentation Paths of the XMLs that have no DICOM series.
+        :return: list of (XML filename, Segmentation Path)
+        """
+        for filename, path in self.misses:
+            print('No DICOM series found for the Segmentation Path, SeriesUID not updated:', path, 'in', filename)
+        return list(self.misses)
 
 
 def encode_xml(filename, patient_id, patient_name, patient_dob,  df_ct_mapping):
@@ -15,9 +112,10 @@ def encode_xml(filename, patient_id, patient_name, patient_dob,  df_ct_mapping):
     :param patient_id:
     :param patient_name:
     :param patient_dob:
-    :param df_ct_mapping:
+    :param df_ct_mapping: DataFrame of the DICOM series or its SeriesUIDMap
     :return:
     """
+    series_uid_map = df_ct_mapping if isinstance(df_ct_mapping, SeriesUIDMap) else SeriesUIDMap(df_ct_mapping)
     try:
         xmlobj = ET.parse(filename)
     except Exception as e:
@@ -52,12 +150,11 @@ def encode_xml(filename, patient_id, patient_name, patient_dob,  df_ct_mapping):
         pass  # elements not found in XML
 
     for segmentation in root.iter('Segmentation'):
-        path = segmentation.find('Path').text
-        series_uid = segmentation.find('SeriesUID').text
+        path_element = segmentation.find('Path')
         # update the series_uid
-        idx_segm_xml = df_ct_mapping.index[
-            df_ct_mapping["PathSeries"] == path].tolist()[0]
-        series_instance_uid = df_ct_mapping.loc[idx_segm_xml].SeriesInstanceNumberUID
+        series_instance_uid = series_uid_map.lookup(path_element.text if path_element is not None else None, filename)
+        if series_instance_uid is None:
+            continue
         for el in segmentation:
             if el.tag == 'SeriesUID':
                 el.text = series_instance_uid
@@ -66,7 +163,156 @@ def encode_xml(filename, patient_id, patient_name, patient_dob,  df_ct_mapping):
     xmlobj.write(filename)
 
 
-def main_encode_xml(rootdir, patient_id, patient_name, patient_dob, df_ct_mapping):
+class StreamingXmlEncoder(xml.sax.handler.ContentHandler):
+
+    def __init__(self, out, patient_id, patient_name, patient_dob, series_uid_of_path):
+        """
+        SAX handler writing the XML events to out as they are parsed, with the identifying attributes of PatientInfo
+        and PatientData replaced and the SeriesUID of each Segmentation updated. Only the events of the current
+        Segmentation element are held in memory, until its Path is known.
+        :param out: binary file object the encoded XML is written to
+        :param patient_id:
+        :param patient_name:
+        :param patient_dob:
+        :param series_uid_of_path: function(Segmentation Path) -> new SeriesUID, None to keep the SeriesUID
+        """
+        super(StreamingXmlEncoder, self).__init__()
+        self._writer = XMLGenerator(out, encoding='utf-8', short_empty_elements=True)
+        self._attributes = encoded_attributes(patient_id, patient_name, patient_dob)
+        self._series_uid_of_path = series_uid_of_path
+        self._depth = 0
+        self._segmentation_depth = None
+        self._segmentation_events = []
+        self._segmentation_texts = {}
+        self._segmentation_child = None
+        self.changed = False
+        # encoded values, cached to skip the parsing of the file when they are still up to date
+        self.metadata = {"attributes": {name: [] for name in self._attributes}, "segmentations": []}
+
+    def startDocument(self):
+        self._writer.startDocument()
+
+    def endDocument(self):
+        self._writer.endDocument()
+
+    def startElement(self, name, attrs):
+        self._depth += 1
+        if self._depth == 2 and name in self._attributes:
+            # PatientInfo and PatientData elements of the root
+            new_attrs = dict(attrs.items())
+            new_attrs.update(self._attributes[name])
+            if new_attrs != dict(attrs.items()):
+                self.changed = True
+            attrs = AttributesImpl(new_attrs)
+            self.metadata["attributes"][name].append(self._attributes[name])
+        if self._segmentation_depth is None and name == 'Segmentation':
+            self._segmentation_depth = self._depth
+        if self._segmentation_depth is None:
+            self._writer.startElement(name, attrs)
+            return
+        if self._depth == self._segmentation_depth + 1:
+            self._segmentation_child = name
+            self._segmentation_texts.setdefault(name, '')
+        self._segmentation_events.append(('start', self._depth, name, AttributesImpl(dict(attrs.items()))))
+
+    def characters(self, content):
+        if self._segmentation_depth is None:
+            self._writer.characters(content)
+            return
+        if self._depth == self._segmentation_depth + 1:
+            self._segmentation_texts[self._segmentation_child] += content
+        self._segmentation_events.append(('characters', self._depth, content, None))
+
+    def ignorableWhitespace(self, whitespace):
+        self.characters(whitespace)
+
+    def endElement(self, name):
+        if self._segmentation_depth is None:
+            self._writer.endElement(name)
+        else:
+            self._segmentation_events.append(('end', self._depth, name, None))
+            if self._depth == self._segmentation_depth:
+                self._write_segmentation()
+        self._depth -= 1
+
+    def _write_segmentation(self):
+        # the text of the SeriesUID child is replaced by the UID of the series at Path
+        series_uid = self._segmentation_texts.get('SeriesUID')
+        if series_uid is not None:
+            new_series_uid = self._series_uid_of_path(self._segmentation_texts.get('Path'))
+            new_series_uid = series_uid if new_series_uid is None else str(new_series_uid)
+            self.changed = self.changed or new_series_uid != series_uid
+            self.metadata["segmentations"].append([self._segmentation_texts.get('Path'), new_series_uid])
+        child_depth = self._segmentation_depth + 1
+        in_series_uid = False
+        for event, depth, value, attrs in self._segmentation_events:
+            if event == 'start':
+                self._writer.startElement(value, attrs)
+                if depth == child_depth and value == 'SeriesUID':
+                    in_series_uid = True
+                    self._writer.characters(new_series_uid)
+            elif event == 'characters':
+                if not (in_series_uid and depth == child_depth):
+                    self._writer.characters(value)
+            else:
+                if depth == child_depth:
+                    in_series_uid = False
+                self._writer.endElement(value)
+        self._segmentation_depth = None
+        self._segmentation_events = []
+        self._segmentation_texts = {}
+        self._segmentation_child = None
+
+
+def encode_xml_streaming(filename, patient_id, patient_name, patient_dob, df_ct_mapping, parse_cache=None):
+    """
+    Same encoding as encode_xml, streamed: the file is parsed and written event by event with bounded memory,
+    to a temporary file that replaces the original only if a value actually changed.
+    :param filename:
+    :param patient_id:
+    :param patient_name:
+    :param patient_dob:
+    :param df_ct_mapping: DataFrame of the DICOM series or its SeriesUIDMap
+    :param parse_cache: XmlParseCache, the file is not parsed if it is unchanged since its metadata was cached and
+    the metadata is already encoded with these values
+    :return: True if the file was rewritten, False if nothing changed, None if the file cannot be parsed
+    """
+    series_uid_map = df_ct_mapping if isinstance(df_ct_mapping, SeriesUIDMap) else SeriesUIDMap(df_ct_mapping)
+    series_uid_of_path = lambda path: series_uid_map.lookup(path, filename)
+    if parse_cache is not None:
+        metadata = parse_cache.get(filename, XML_METADATA_KIND)
+        if metadata is not None and not encoding_needed(metadata, patient_id, patient_name, patient_dob,
+                                                        series_uid_of_path):
+            return False
+    folder, basename = os.path.split(filename)
+    fd, tmp_file = tempfile.mkstemp(prefix="." + basename, suffix=XML_TEMP_SUFFIX, dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as out, open(filename, 'rb') as fp:
+            # the content hashes of the parsed and the written file validate the cached metadata after a copy
+            source, output = HashingFile(fp), HashingFile(out)
+            encoder = StreamingXmlEncoder(output, patient_id, patient_name, patient_dob, series_uid_of_path)
+            xml.sax.parse(source, encoder)
+    except xml.sax.SAXException as e:
+        os.remove(tmp_file)
+        print(repr(e))
+        print('This file cannot be parsed: ', filename)
+        return None
+    except Exception:
+        os.remove(tmp_file)
+        raise
+    if not encoder.changed:
+        os.remove(tmp_file)
+    else:
+        shutil.copymode(filename, tmp_file)
+        os.replace(tmp_file, filename)
+    if parse_cache is not None:
+        parse_cache.put(filename, XML_METADATA_KIND, encoder.metadata,
+                        sha1=(output if encoder.changed else source).hexdigest())
+    return encoder.changed
+
+
+def main_encode_xml(rootdir, patient_id, patient_name, patient_dob, df_ct_mapping, streaming=True, parse_cache=None,
+                    prescan=True):
     """
 
     :param rootdir:
@@ -74,13 +320,32 @@ def main_encode_xml(rootdir, patient_id, patient_name, patient_dob, df_ct_mappin
     :param patient_name:
     :param patient_dob:
     :param df_ct_mapping:
-    :return:
+    :param streaming: encode the files with encode_xml_streaming (bounded memory, unchanged files not written),
+    otherwise with encode_xml (whole tree in memory)
+    :param parse_cache: XmlParseCache of the streaming encoding, the files already encoded are not parsed again
+    :param prescan: skip the files without any element to encode (see xml_needs_encoding)
+    :return: list of (XML filename, Segmentation Path) without DICOM series, their SeriesUID is not updated
     """
+    series_uid_map = SeriesUIDMap(df_ct_mapping)
+    n_files, skipped_files, skipped_bytes = 0, 0, 0
+    if streaming:
+        encode = lambda *args: encode_xml_streaming(*args, parse_cache=parse_cache)
+    else:
+        encode = encode_xml
     for subdir, dirs, files in os.walk(rootdir):
         for file in sorted(files):  # sort files by date of creation
             fileName, fileExtension = os.path.splitext(file)
             if fileExtension.lower().endswith('.xml'):
                 xmlFilePathName = os.path.join(subdir, file)
                 xmlfilename = os.path.normpath(xmlFilePathName)
-                encode_xml(xmlfilename, patient_id, patient_name, patient_dob, df_ct_mapping)
+                n_files += 1
+                if prescan and not xml_needs_encoding(xmlfilename):
+                    skipped_files += 1
+                    skipped_bytes += os.path.getsize(xmlfilename)
+                    continue
+                encode(xmlfilename, patient_id, patient_name, patient_dob, series_uid_map)
+    if prescan:
+        print('XML files skipped by the prescan: %d of %d, %.1f MB not parsed nor rewritten' % (
+            skipped_files, n_files, skipped_bytes / 1e6))
+    return series_uid_map.report_misses()
 
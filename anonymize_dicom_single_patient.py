@@ -6,9 +6,8 @@ Created on June 2019
 """
 import os
 
-import pydicom
-
 from anonymization_xml_logs import encode_xml
+from dcm_inplace_patch import anonymize_dcm_file
 
 # %%
 
@@ -35,13 +34,12 @@ if __name__ == '__main__':
             DcmFilePathName = os.path.join(subdir, file)
             try:
                 dcm_file = os.path.normpath(DcmFilePathName)
-                dataset = pydicom.read_file(dcm_file)
-                dataset.PatientName = patient_name
-                dataset.PatientID = patient_id
-                # dataset.PatientBirthDate = patient_dob
-                dataset.InstitutionName = "None"
-                dataset.InstitutionAddress = "None"
-                dataset.save_as(dcm_file)
+                # patched in place when the new values fit, otherwise rewritten
+                anonymize_dcm_file(dcm_file, {"PatientName": patient_name,
+                                              "PatientID": patient_id,
+                                              # "PatientBirthDate": patient_dob,
+                                              "InstitutionName": "None",
+                                              "InstitutionAddress": "None"})
 
             except Exception as e:
                 pass
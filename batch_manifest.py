@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Per-patient manifest of the segmentation fix pipeline, for resumable and incremental batch runs.
+It records the UIDs assigned to the segmentations, the input hash of each file written and the state of the files
+after the run, so that a rerun skips the unchanged patients and files and reuses the same UIDs.
+"""
+import hashlib
+import json
+import os
+
+from dicom_header_index import state_filepath
+
+MANIFEST_FILENAME = "segmentation_fix_manifest.json"
+SAVE_EVERY_N_FILES = 100
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    """
+    :param path: filepath
+    :param chunk_size: bytes read at once
+    :return: sha1 hex digest of the file content
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def edits_hash(tags):
+    """
+    :param tags: dict DICOM keyword -> value planned for a file (see DicomEditPlan)
+    :return: sha1 hex digest of the edits
+    """
+    edits = json.dumps(tags, sort_keys=True, default=lambda value: value.item() if hasattr(value, 'item')
+                       else str(value))
+    return hashlib.sha1(edits.encode('utf-8')).hexdigest()
+
+
+def snapshot_tree(rootdir, ignore_filenames=()):
+    """
+    :param rootdir: patient folder
+    :param ignore_filenames: filenames left out, eg. the manifest itself
+    :return: dict filepath -> [size, mtime_ns] of all the files of the folder
+    """
+    snapshot = {}
+    for subdir, dirs, files in os.walk(rootdir):
+        for file in files:
+            if file in ignore_filenames:
+                continue
+            filepath = os.path.normpath(os.path.join(subdir, file))
+            stat = os.stat(filepath)
+            snapshot[filepath] = [stat.st_size, stat.st_mtime_ns]
+    return snapshot
+
+
+class PatientManifest(object):
+
+    def __init__(self, rootdir, manifest_file=None, ignore_filenames=()):
+        """
+        :param rootdir: patient folder
+        :param manifest_file: json filepath, default in the state folder (see dicom_header_index.state_filepath), out
+        of the patient folder as the manifest holds the original paths and content hashes
+        :param ignore_filenames: filenames of the other pipeline outputs, left out of the folder snapshot
+        """
+        self.rootdir = os.path.normpath(rootdir)
+        if manifest_file is None:
+            manifest_file = state_filepath(self.rootdir, MANIFEST_FILENAME)
+        self.manifest_file = manifest_file
+        self.ignore_filenames = (os.path.basename(manifest_file),) + tuple(ignore_filenames)
+        self.status = None
+        self.patient = None
+        self.files = {}  # filepath -> input_hash, edits_hash, size and mtime after the write
+        self.uids = {"SeriesInstanceUID": {}, "SOPInstanceUID": {}}  # folder/filepath -> assigned UID
+        self.snapshot = {}
+        self._pending = {}
+        self._written_since_save = 0
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.manifest_file, 'r') as fp:
+                manifest = json.load(fp)
+        except (OSError, ValueError):
+            return
+        self.status = manifest.get("status")
+        self.patient = manifest.get("patient")
+        self.files = manifest.get("files", {})
+        self.uids.update(manifest.get("uids", {}))
+        self.snapshot = manifest.get("snapshot", {})
+
+    def reset(self):
+        """
+        Forget the previous runs: all the files are processed again and new UIDs are assigned.
+        :return:
+        """
+        self.status = None
+        self.patient = None
+        self.files = {}
+        self.uids = {"SeriesInstanceUID": {}, "SOPInstanceUID": {}}
+        self.snapshot = {}
+
+    def save(self):
+        manifest = {"rootdir": self.rootdir,
+                    "status": self.status,
+                    "patient": self.patient,
+                    "uids": self.uids,
+                    "files": self.files,
+                    "snapshot": self.snapshot}
+        manifest_dir = os.path.dirname(self.manifest_file)
+        if manifest_dir and not os.path.isdir(manifest_dir):
+            os.makedirs(manifest_dir)
+        tmp_file = self.manifest_file + ".tmp"
+        with open(tmp_file, 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        os.replace(tmp_file, self.manifest_file)
+        self._written_since_save = 0
+
+    def is_unchanged(self, patient):
+        """
+        :param patient: dict of the patient values encoded in the files (name, id, dob, anonymize flag)
+        :return: True if the last run completed with the same values and no file changed since
+        """
+        return (self.status == "complete" and self.patient == patient and
+                self.snapshot == snapshot_tree(self.rootdir, self.ignore_filenames))
+
+    def start(self, patient):
+        """
+        Mark the run as in progress. A run interrupted before complete() is resumed by the next run.
+        :param patient: dict of the patient values encoded in the files
+        :return:
+        """
+        if self.patient is not None and self.patient != patient:
+            # the patient values changed, all the files have to be rewritten
+            self.files = {}
+        self.status = "in_progress"
+        self.patient = patient
+        self.save()
+
+    def _is_own_output(self, filepath):
+        entry = self.files.get(filepath)
+        if entry is None:
+            return False
+        stat = os.stat(filepath)
+        return entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def _is_same_input(self, filepath, entry):
+        stat = os.stat(filepath)
+        if entry.get("input_size") == stat.st_size and entry.get("input_mtime") == stat.st_mtime_ns:
+            return True
+        # hashed only when the size or mtime differ, eg. the same content copied back
+        return entry.get("input_hash") is not None and file_sha1(filepath) == entry["input_hash"]
+
+    def assigned_uids(self):
+        """
+        UIDs assigned by the previous runs, to be reused. The SOPInstanceUID of a file is dropped when the file was
+        replaced by new content (neither the file we wrote nor the same input as before).
+        :return: dict with SeriesInstanceUID (folder -> UID) and SOPInstanceUID (filepath -> UID)
+        """
+        for filepath in list(self.uids["SOPInstanceUID"]):
+            if not os.path.isfile(filepath):
+                del self.uids["SOPInstanceUID"][filepath]
+                continue
+            entry = self.files.get(filepath)
+            if entry is not None and not self._is_own_output(filepath) and not self._is_same_input(filepath, entry):
+                del self.uids["SOPInstanceUID"][filepath]
+        return self.uids
+
+    def filter_plan(self, edit_plan):
+        """
+        Drop from the plan the files already written with the same edits and unchanged since. The size and mtime of
+        the others are recorded, their content hash comes from the read of DicomEditPlan.apply (see file_written).
+        :param edit_plan: DicomEditPlan
+        :return: number of files skipped
+        """
+        skipped = 0
+        self._pending = {}
+        for filepath, tags in list(edit_plan.edits.items()):
+            tags_hash = edits_hash(tags)
+            entry = self.files.get(filepath)
+            if entry is not None and entry["edits_hash"] == tags_hash and self._is_own_output(filepath):
+                del edit_plan.edits[filepath]
+                skipped += 1
+            else:
+                stat = os.stat(filepath)
+                self._pending[filepath] = {"input_hash": None, "input_size": stat.st_size,
+                                           "input_mtime": stat.st_mtime_ns, "edits_hash": tags_hash}
+        self.save()  # keep the assigned UIDs before any file is written
+        return skipped
+
+    def file_written(self, filepath, input_hash=None):
+        """
+        Record a file written by the plan, the manifest is saved every SAVE_EVERY_N_FILES files.
+        :param filepath: filepath
+        :param input_hash: sha1 of the file content before the write, computed from the bytes the plan read, None for
+        the files patched in place (not read entirely)
+        :return:
+        """
+        stat = os.stat(filepath)
+        entry = self._pending.pop(filepath)
+        entry["input_hash"] = input_hash
+        entry["size"] = stat.st_size
+        entry["mtime"] = stat.st_mtime_ns
+        self.files[filepath] = entry
+        self._written_since_save += 1
+        if self._written_since_save >= SAVE_EVERY_N_FILES:
+            self.save()
+
+    def complete(self):
+        """
+        Mark the run as complete and record the state of the folder after the run.
+        :return:
+        """
+        self.status = "complete"
+        self.snapshot = snapshot_tree(self.rootdir, self.ignore_filenames)
+        self.save()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Small generated DICOM series and CAS-One XML recordings shared by the tests.
+"""
+import os
+
+import numpy as np
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+PLAN_XML = '''<?xml version="1.0" encoding="utf-8"?>
+<Eagles time="2019-07-28 19:33:55">
+  <PatientInfo ID="{patient_id}" Initial="{patient_name}" DOB="1938-05-17" />
+  <PatientData seriesID="1.2.3" seriesNumber="7" patientID="{patient_id}" seriesPath="C:\\Patients\\{patient_name}" />
+  <Trajectories>
+    <Trajectory>
+      <Segmentation StructureType="Lession" TypeOfSegmentation="1">
+        <SeriesUID>1.2.3.4</SeriesUID>
+        <Path>/Segmentations/SeriesNo_7/SegmentationNo_0</Path>
+      </Segmentation>
+      <Segmentation StructureType="Ablation" TypeOfSegmentation="2">
+        <SeriesUID>1.2.3.5</SeriesUID>
+        <Path>/Segmentations/SeriesNo_7/SegmentationNo_1</Path>
+      </Segmentation>
+    </Trajectory>
+  </Trajectories>
+</Eagles>
+'''
+
+
+def write_dicom_series(folder, n_slices=4, rows=8, columns=6, dtype=np.int16, series_uid=None, patient_name="Doe^John",
+                       patient_id="P001"):
+    """
+    :param folder: output folder, created if it does not exist
+    :param n_slices: number of slices, one file per slice
+    :param rows: rows of a slice
+    :param columns: columns of a slice
+    :param dtype: np.int16, np.uint16 or np.uint8 pixel data
+    :param series_uid: SeriesInstanceUID, a new one if None
+    :param patient_name: PatientName of the files
+    :param patient_id: PatientID of the files
+    :return: list of the filepaths written, in slice order
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    dtype = np.dtype(dtype)
+    series_uid = series_uid if series_uid is not None else generate_uid()
+    study_uid = generate_uid()
+    filepaths = []
+    for z in range(n_slices):
+        file_meta = FileMetaDataset()
+        file_meta.MediaStorageSOPClassUID = CTImageStorage
+        file_meta.MediaStorageSOPInstanceUID = generate_uid()
+        file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        dataset = Dataset()
+        dataset.file_meta = file_meta
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+        dataset.SOPClassUID = CTImageStorage
+        dataset.SOPInstanceUID = file_meta.MediaStorageSOPInstanceUID
+        dataset.StudyInstanceUID = study_uid
+        dataset.SeriesInstanceUID = series_uid
+        dataset.SeriesNumber = 7
+        dataset.Modality = "CT"
+        dataset.PatientName = patient_name
+        dataset.PatientID = patient_id
+        dataset.PatientBirthDate = "19380517"
+        dataset.InstitutionName = "Hospital"
+        dataset.InstanceNumber = z + 1
+        dataset.ImagePositionPatient = [0.0, 0.0, 2.5 * z]
+        dataset.ImageOrientationPatient = [1.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        dataset.PixelSpacing = [0.75, 0.5]
+        dataset.SliceThickness = 2.5
+        dataset.Rows = rows
+        dataset.Columns = columns
+        dataset.SamplesPerPixel = 1
+        dataset.PhotometricInterpretation = "MONOCHROME2"
+        dataset.BitsAllocated = 8 * dtype.itemsize
+        dataset.BitsStored = 8 * dtype.itemsize
+        dataset.HighBit = 8 * dtype.itemsize - 1
+        dataset.PixelRepresentation = 1 if dtype.kind == 'i' else 0
+        pixels = (np.arange(rows * columns).reshape(rows, columns) + z) % 100
+        dataset.PixelData = pixels.astype(dtype).tobytes()
+        filepath = os.path.join(folder, '%03d' % z)
+        dataset.save_as(filepath, write_like_original=False)
+        filepaths.append(filepath)
+    return filepaths
+
+
+@pytest.fixture
+def dicom_series(tmp_path):
+    """
+    :return: function(name, **kwargs) writing a series in tmp_path/name (see write_dicom_series), returns the folder
+    """
+    def make_series(name="series", **kwargs):
+        folder = str(tmp_path / name)
+        write_dicom_series(folder, **kwargs)
+        return folder
+    return make_series
+
+
+@pytest.fixture
+def plan_xml(tmp_path):
+    """
+    :return: function(name, patient_id, patient_name) writing a Plan XML recording in tmp_path, returns the filepath
+    """
+    def make_xml(name="Plan_1.xml", patient_id="P001", patient_name="Doe"):
+        filename = str(tmp_path / name)
+        with open(filename, 'w') as fp:
+            fp.write(PLAN_XML.format(patient_id=patient_id, patient_name=patient_name))
+        return filename
+    return make_xml
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Collect all the tag edits of the segmentation fix pipeline per DICOM file, then apply them with a single read and a
+single atomic write per file (temporary file + rename), so a file is never left half-edited.
+"""
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import pydicom
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+
+from dcm_inplace_patch import INPLACE_TAGS, patch_tags_inplace
+from dcm_io_pipeline import run_io_pipeline
+
+TEMP_SUFFIX = ".dcmedit.tmp"
+
+
+def set_dataset_tags(dataset, tags):
+    """
+    Set the tag values on a pydicom dataset. A list of dicts is written as a sequence of datasets.
+    :param dataset: pydicom Dataset
+    :param tags: dict DICOM keyword -> value
+    :return: the edited dataset
+    """
+    for keyword, value in tags.items():
+        if isinstance(value, list) and value and isinstance(value[0], dict):
+            items = []
+            for item_tags in value:
+                items.append(set_dataset_tags(Dataset(), item_tags))
+            value = Sequence(items)
+        setattr(dataset, keyword, value)
+    return dataset
+
+
+def save_as_atomic(dataset, dcm_file):
+    """
+    Save the dataset to a temporary file in the same folder then rename it over dcm_file.
+    :param dataset: pydicom Dataset
+    :param dcm_file: filepath
+    :return:
+    """
+    folder, filename = os.path.split(dcm_file)
+    fd, tmp_file = tempfile.mkstemp(prefix="." + filename, suffix=TEMP_SUFFIX, dir=folder)
+    os.close(fd)
+    try:
+        dataset.save_as(tmp_file)
+        shutil.copymode(dcm_file, tmp_file)  # mkstemp creates the file readable by the owner only
+        os.replace(tmp_file, dcm_file)
+    except Exception:
+        os.remove(tmp_file)
+        raise
+
+
+class DicomEditPlan(object):
+
+    def __init__(self):
+        # filepath -> dict DICOM keyword -> new value, in the order the files were first edited
+        self.edits = {}
+        # filepath -> sha1 of the content read by apply, before the write
+        self.input_hashes = {}
+        # filepath -> exception of the files the last apply failed to edit
+        self.errors = {}
+
+    def _read(self, dcm_file):
+        # a single read of the file gives both the dataset and the hash of its content
+        with open(dcm_file, 'rb') as fp:
+            content = fp.read()
+        dataset = pydicom.read_file(io.BytesIO(content))
+        self.input_hashes[dcm_file] = hashlib.sha1(content).hexdigest()
+        return dataset
+
+    def __len__(self):
+        return len(self.edits)
+
+    def set_tags(self, dcm_file, **tags):
+        """
+        Plan new tag values for a file. A later edit of the same tag replaces the earlier one.
+        :param dcm_file: filepath
+        :param tags: DICOM keywords and their new values, a list of dicts for a sequence
+        :return:
+        """
+        self.edits.setdefault(os.path.normpath(dcm_file), {}).update(tags)
+
+    def apply(self, on_written=None, io_threads=1):
+        """
+        Read each file once, set all its planned tags and write it once. The files with only identifying text tags
+        planned are patched in place when the new values fit (see dcm_inplace_patch).
+        A file that cannot be read, edited or written does not stop the others, the failures are kept in errors and
+        raised together once all the files are processed. The edits of the failed files are kept in the plan.
+        :param on_written: function called with the filepath after each file is written, the hash of the content read
+        is in input_hashes
+        :param io_threads: with more than 1, the files are read and written by that many reader and writer threads
+        (see dcm_io_pipeline), for network shares where each read and write waits on the latency
+        :return: list of the filepaths written, raise RuntimeError if some files failed
+        """
+        written_files = []
+        self.errors = {}
+        for dcm_file, tags in list(self.edits.items()):
+            # files only anonymized: overwrite the few bytes of the identifying tags, no full rewrite
+            if not all(keyword in INPLACE_TAGS for keyword in tags):
+                continue
+            try:
+                patched = patch_tags_inplace(dcm_file, tags)
+            except Exception as e:
+                # eg. a locked or read-only file, the atomic rewrite below replaces it or records the error
+                print('In place patch failed, the file is rewritten:', repr(e), dcm_file)
+                patched = False
+            if patched:
+                del self.edits[dcm_file]
+                written_files.append(dcm_file)
+                if on_written is not None:
+                    on_written(dcm_file)
+        if io_threads > 1:
+            pipeline_files, self.errors = run_io_pipeline(list(self.edits), self._read,
+                                                          lambda dcm_file, dataset:
+                                                          set_dataset_tags(dataset, self.edits[dcm_file]),
+                                                          lambda dcm_file, dataset: save_as_atomic(dataset, dcm_file),
+                                                          io_threads, io_threads, 4 * io_threads, on_written)
+            written_files += pipeline_files
+        else:
+            for dcm_file, tags in self.edits.items():
+                try:
+                    dataset = self._read(dcm_file)
+                    set_dataset_tags(dataset, tags)
+                    save_as_atomic(dataset, dcm_file)
+                except Exception as e:
+                    self.errors[dcm_file] = e
+                    continue
+                written_files.append(dcm_file)
+                if on_written is not None:
+                    on_written(dcm_file)
+        # the edits of the failed files stay in the plan, to be applied again or exported
+        self.edits = {dcm_file: tags for dcm_file, tags in self.edits.items() if dcm_file in self.errors}
+        if self.errors:
+            for dcm_file, e in self.errors.items():
+                print(repr(e), dcm_file)
+            raise RuntimeError('DICOM edits failed for %d files, first: %s' % (len(self.errors),
+                                                                              next(iter(self.errors))))
+        return written_files
+
+    def export(self, filename):
+        """
+        Dry-run: write the plan to a json file without touching the DICOM files.
+        :param filename: output json filepath
+        :return: filename
+        """
+        with open(filename, 'w') as fp:
+            # numpy scalars coming from the pandas DataFrames
+            json.dump(self.edits, fp, indent=1, default=lambda value: value.item() if hasattr(value, 'item')
+                      else str(value))
+        return filename
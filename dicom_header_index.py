@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Single-pass index of the DICOM headers found in a patient folder.
+The folder tree is walked once, every DICOM file is parsed once (header only) and the handful of tags needed by the
+segmentation fix pipeline are kept in memory and on disk, so that the following stages don't re-walk and re-parse.
+"""
+import hashlib
+import json
+import os
+
+from DicomReader import read_dcm_metadata
+from dcm_edit_plan import TEMP_SUFFIX
+
+INDEX_FILENAME = "dicom_header_index.json"
+# folder of the state files of the pipeline (header index, manifest), out of the patient folders that are delivered
+DEFAULT_STATE_DIR = os.path.join(os.path.expanduser("~"), ".segmentation_fix_state")
+HEADER_TAGS = ["SOPInstanceUID", "SeriesInstanceUID", "StudyInstanceUID", "SeriesNumber", "SOPClassUID"]
+
+
+def folder_role(subdir):
+    """
+    Classify a folder of the patient tree the same way the pipeline stages do.
+    :param subdir: folder path
+    :return: "segmentation" for CAS-One Segmentations/SeriesNo_* folders, "series" for Series*/SegmentationNo* folders,
+    "other" otherwise
+    """
+    path, foldername = os.path.split(subdir)
+    if 'Segmentations' in subdir and 'SeriesNo_' in subdir:
+        return "segmentation"
+    if ("Series" in foldername) or ("SegmentationNo" in foldername):
+        return "series"
+    return "other"
+
+
+def state_filepath(rootdir, filename, state_dir=None):
+    """
+    Filepath of a state file of a patient folder, in the state folder. The patient folders are told apart by a hash
+    of their absolute path.
+    :param rootdir: patient folder
+    :param filename: name of the state file, eg. INDEX_FILENAME
+    :param state_dir: folder of the state files, default DEFAULT_STATE_DIR
+    :return: filepath
+    """
+    rootdir = os.path.abspath(rootdir)
+    state_dir = state_dir if state_dir is not None else DEFAULT_STATE_DIR
+    rootdir_hash = hashlib.sha1(rootdir.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(state_dir, '%s_%s_%s' % (os.path.basename(rootdir), rootdir_hash, filename))
+
+
+def read_header_record(dcm_file):
+    """
+    Read the header of a single file and keep only the tags of the index.
+    :param dcm_file: filepath
+    :return: dict with the HEADER_TAGS values or None if the file is not DICOM
+    """
+    dataset = read_dcm_metadata(dcm_file, HEADER_TAGS)
+    if dataset is None:
+        return None  # not a DICOM file
+    record = {}
+    for tag in HEADER_TAGS:
+        value = dataset.get(tag, None)
+        if value is None or value == '':
+            record[tag] = None
+        elif tag == "SeriesNumber":
+            record[tag] = int(value)
+        else:
+            record[tag] = str(value)
+    return record
+
+
+class DicomHeaderIndex(object):
+
+    def __init__(self, rootdir, folders=None, records=None, index_file=None):
+        """
+        :param rootdir: patient folder that was scanned
+        :param folders: list of the walked folders in os.walk order
+        :param records: dict filepath -> record (Path, Folder, FolderRole, Size, Mtime + HEADER_TAGS).
+        The record of a non-DICOM file has all HEADER_TAGS set to None and IsDicom False.
+        :param index_file: filepath where the index is saved on disk, default in DEFAULT_STATE_DIR (see state_filepath)
+        """
+        self.rootdir = os.path.normpath(rootdir)
+        self.folders = folders if folders is not None else []
+        self.records = records if records is not None else {}
+        if index_file is None:
+            index_file = state_filepath(self.rootdir, INDEX_FILENAME)
+        self.index_file = index_file
+        self._files_by_folder = None
+
+    @classmethod
+    def build(cls, rootdir, index_file=None):
+        """
+        Walk the patient folder once and parse the header of each file.
+        Files unchanged (same size and mtime) since the index was last saved on disk are not parsed again.
+        :param rootdir: patient folder
+        :param index_file: on-disk index filepath, default in DEFAULT_STATE_DIR (see state_filepath)
+        :return: DicomHeaderIndex
+        """
+        dcm_index = cls(rootdir, index_file=index_file)
+        previous_records = dcm_index._load_records()
+        index_filepath = os.path.normpath(dcm_index.index_file)
+        for subdir, dirs, files in os.walk(dcm_index.rootdir):
+            subdir = os.path.normpath(subdir)
+            dcm_index.folders.append(subdir)
+            for file in sorted(files):
+                dcm_file = os.path.join(subdir, file)
+                if dcm_file == index_filepath or file.endswith(TEMP_SUFFIX):
+                    continue  # not a patient file, or left over by an interrupted atomic write
+                stat = os.stat(dcm_file)
+                record = previous_records.get(dcm_file)
+                if record is None or record["Size"] != stat.st_size or record["Mtime"] != stat.st_mtime_ns:
+                    header = read_header_record(dcm_file)
+                    record = {"Path": dcm_file,
+                              "Folder": subdir,
+                              "FolderRole": folder_role(subdir),
+                              "Size": stat.st_size,
+                              "Mtime": stat.st_mtime_ns,
+                              "IsDicom": header is not None}
+                    for tag in HEADER_TAGS:
+                        record[tag] = header[tag] if header is not None else None
+                dcm_index.records[dcm_file] = record
+        return dcm_index
+
+    def _load_records(self):
+        try:
+            with open(self.index_file, 'r') as fp:
+                saved_index = json.load(fp)
+        except (OSError, ValueError):
+            return {}
+        if os.path.normpath(saved_index.get("rootdir", "")) != self.rootdir:
+            return {}
+        return {record["Path"]: record for record in saved_index.get("records", [])}
+
+    def save(self):
+        """
+        Write the index to disk (json), in the state folder by default.
+        :return: filepath of the saved index
+        """
+        index_dir = os.path.dirname(self.index_file)
+        if index_dir and not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        saved_index = {"rootdir": self.rootdir,
+                       "folders": self.folders,
+                       "records": list(self.records.values())}
+        with open(self.index_file, 'w') as fp:
+            json.dump(saved_index, fp, indent=1)
+        return self.index_file
+
+    def files_in(self, subdir):
+        """
+        :param subdir: folder path
+        :return: records of the DICOM files found directly in subdir, sorted by filename
+        """
+        if self._files_by_folder is None:
+            self._files_by_folder = {}
+            for record in self.records.values():
+                if record["IsDicom"]:
+                    self._files_by_folder.setdefault(record["Folder"], []).append(record)
+        return self._files_by_folder.get(os.path.normpath(subdir), [])
+
+    def dicom_records(self):
+        """
+        :return: records of all the DICOM files, in walk order and sorted by filename within a folder
+        """
+        for subdir in self.folders:
+            for record in self.files_in(subdir):
+                yield record
+
+    def update(self, dcm_file, **tags):
+        """
+        Update the index after a file was rewritten: new tag values and new size/mtime.
+        :param dcm_file: filepath
+        :param tags: HEADER_TAGS keywords and their new values
+        :return: the updated record
+        """
+        record = self.records[os.path.normpath(dcm_file)]
+        for tag, value in tags.items():
+            if tag not in HEADER_TAGS:
+                raise KeyError('Tag not kept in the DICOM header index: ' + tag)
+            record[tag] = value
+        stat = os.stat(record["Path"])
+        record["Size"] = stat.st_size
+        record["Mtime"] = stat.st_mtime_ns
+        return record
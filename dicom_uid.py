@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+DICOM UIDs of the generated and re-encoded objects (segmentations, series, studies).
+- make_uid: a single UID from hashed entropy sources (HW address, time, process ID, randomness)
+- UIDAllocator: bulk allocation, one random stem under the root then a counter, no hashing per UID
+- derive_uid: deterministic UID derived from the original UID and a salt, so that reruns give the same UIDs
+"""
+import argparse
+import hashlib
+import os
+import threading
+import time
+import uuid
+from random import random
+
+DEFAULT_PREFIX = '2.25.'
+MAX_UID_LENGTH = 64
+COUNTER_DIGITS = 12  # UIDs allocated under the same stem before a new stem is drawn
+
+
+def make_uid(entropy_srcs=None, prefix=DEFAULT_PREFIX):
+    """Generate a DICOM UID value.
+    Follows the advice given at:
+    http://www.dclunie.com/medical-image-faq/html/part2.html#UID
+    :param entropy_srcs: list of str providing the entropy used to generate the UID. If None these will be collected
+    from a combination of HW address, time, process ID, and randomness.
+    :param prefix: UID root
+    :return: UID string
+    """
+    # Combine all the entropy sources with a hashing algorithm
+    if entropy_srcs is None:
+        entropy_srcs = [str(uuid.uuid1()),  # 128-bit from MAC/time/randomness
+                        str(os.getpid()),  # Current process ID
+                        random().hex()  # 64-bit randomness
+                        ]
+    hash_val = hashlib.sha256(''.join(entropy_srcs).encode('utf-8')).hexdigest()
+    # Convert this to an int with the maximum available digits
+    avail_digits = MAX_UID_LENGTH - len(prefix)
+    int_val = int(hash_val, 16) % (10 ** avail_digits)
+    return prefix + str(int_val)
+
+
+def derive_uid(original_uid, salt, prefix=DEFAULT_PREFIX):
+    """
+    Deterministic UID: the same original UID and salt always give the same new UID.
+    :param original_uid: UID (or any identifying string) of the original object
+    :param salt: project specific secret, the original UID cannot be recovered from the new one without it
+    :param prefix: UID root
+    :return: UID string
+    """
+    digest = hashlib.sha256((str(salt) + '|' + str(original_uid)).encode('utf-8')).digest()
+    avail_digits = MAX_UID_LENGTH - len(prefix)
+    int_val = int.from_bytes(digest[:16], 'big') % (10 ** avail_digits)  # 128 bits, a UUID under 2.25.
+    return prefix + str(int_val)
+
+
+class UIDAllocator(object):
+
+    def __init__(self, prefix=DEFAULT_PREFIX):
+        """
+        Allocate UIDs as <prefix><random stem>.<counter>. The stem is drawn once (from a random UUID) and the counter
+        makes each UID unique under it, so allocating a UID is a string concatenation. Thread-safe.
+        :param prefix: UID root, eg. 2.25. or the root of the organization
+        """
+        self.prefix = prefix
+        self._stem_digits = MAX_UID_LENGTH - len(prefix) - 1 - COUNTER_DIGITS
+        if self._stem_digits < 1:
+            raise ValueError('UID prefix too long: ' + prefix)
+        self._lock = threading.Lock()
+        self._new_stem()
+
+    def _new_stem(self):
+        self._stem = self.prefix + str(uuid.uuid4().int % (10 ** self._stem_digits)) + '.'
+        self._counter = 0
+
+    def reserve(self, n):
+        """
+        :param n: number of UIDs
+        :return: list of n new UIDs
+        """
+        uids = []
+        with self._lock:
+            while n > 0:
+                count = min(n, 10 ** COUNTER_DIGITS - 1 - self._counter)
+                stem, first = self._stem, self._counter + 1
+                uids.extend([stem + str(i) for i in range(first, first + count)])
+                self._counter += count
+                n -= count
+                if self._counter >= 10 ** COUNTER_DIGITS - 1:
+                    self._new_stem()
+        return uids
+
+    def next_uid(self):
+        """
+        :return: a new UID
+        """
+        return self.reserve(1)[0]
+
+
+def benchmark_uid_generation(n=1000000):
+    """
+    Compare the UIDs per second of make_uid, pydicom generate_uid, derive_uid and the bulk allocator.
+    :param n: number of UIDs of the bulk allocator and derive_uid, the slower generators run on n/10
+    :return: dict of UIDs per second
+    """
+    from pydicom.uid import generate_uid
+    rates = {}
+    n_slow = max(1, n // 10)
+    for name, generate in [("make_uid", make_uid), ("pydicom generate_uid", generate_uid)]:
+        start = time.perf_counter()
+        for i in range(n_slow):
+            generate()
+        rates[name] = n_slow / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for i in range(n):
+        derive_uid(i, 'salt')
+    rates["derive_uid"] = n / (time.perf_counter() - start)
+    allocator = UIDAllocator()
+    start = time.perf_counter()
+    uids = allocator.reserve(n)
+    rates["UIDAllocator.reserve"] = n / (time.perf_counter() - start)
+    assert len(set(uids)) == n and max(len(u) for u in uids) <= MAX_UID_LENGTH
+    return rates
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", "--number", required=False, type=int, default=1000000, help="number of UIDs generated")
+    args = vars(ap.parse_args())
+    for name, rate in benchmark_uid_generation(args["number"]).items():
+        print('%s: %.0f UIDs/s' % (name, rate))
@@ -4,105 +4,440 @@ Created  June 2019
 
 @author: Raluca Sandu
 """
+import argparse
 import os
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
 import untangle as ut
 
+# recording folder -> (state of the folder when parsed, its segmentation records), shared by the patient folders a
+# batch worker processes, least recently used first
+_recording_cache = OrderedDict()
+RECORDING_CACHE_SIZE = 64  # recording folders memoized, bounds the memory of a batch worker
+
+
+def is_segmentation_xml(file):
+    """
+    :param file: filename
+    :return: True for the Plan and the AblationValidation XML recordings
+    """
+    return file.startswith('AblationValidation_') or file.startswith('Plan_')
+
+
+def _segmentation_record(time_xml, needle_idx, source_series_id, series_number, segmentation_series_uid,
+                         segmentation_path_series, segmentation_attributes):
+    """
+    :return: dict of a trajectory segmentation, see create_tumour_ablation_mapping
+    """
+    return {
+        "Timestamp": time_xml,
+        "NeedleIdx": needle_idx,
+        "SourceSeriesID": source_series_id,
+        "PathSeries": segmentation_path_series,
+        "SegmentationSeriesUID_xml": segmentation_series_uid,
+        "SegmentLabel": segmentation_attributes.get("StructureType"),
+        "TypeOfSegmentation": segmentation_attributes.get("TypeOfSegmentation"),
+        "SphereRadius": segmentation_attributes.get("SphereRadius"),
+        "SeriesNumber": series_number
+    }
+
+
+def _cdata(element):
+    # text of the element itself, without the text of its children (same as untangle cdata)
+    return (element.text or '') + ''.join(child.tail or '' for child in element)
+
+
+def _single_child(element, tag):
+    """
+    :return: the child element with this tag, None if not found, raise ValueError if there are several
+    """
+    children = element.findall(tag)
+    if len(children) > 1:
+        raise ValueError('More than one %s element' % tag)
+    return children[0] if children else None
+
+
+def read_segmentation_records(xml_file):
+    """
+    Extract the segmentations of the trajectories of a Plan or AblationValidation XML in a single pass of the C
+    ElementTree parser.
+    :param xml_file: filepath
+    :return: list of segmentation records (None for a trajectory that could not be read), None if the file cannot be
+    parsed or has no Trajectories
+    """
+    try:
+        root = ET.parse(xml_file).getroot()
+    except Exception:
+        return None  # the file is not an xml
+    list_trajectories = root.findall('Trajectories') if root.tag == 'Eagles' else []
+    if not list_trajectories:
+        print(repr(AttributeError("'%s' has no attribute 'Trajectories'" % root.tag)))
+        return None
+    patient_data = root.findall('PatientData')
+    records = []
+    for trajectories in list_trajectories:
+        try:
+            single_tr = trajectories.findall('Trajectory')
+            if not single_tr:
+                raise AttributeError('no Trajectory')
+            for idx_tr, el in enumerate(single_tr):
+                segmentations = el.findall('Segmentation')
+                if not segmentations:
+                    continue  # no segmentation found in this trajectory
+                if len(patient_data) > 1:
+                    raise ValueError('More than one PatientData element')
+                series_number = patient_data[0].get("seriesNumber") if patient_data else None
+                if len(segmentations) > 1:
+                    print("No segmentation series uid for this segmentation")
+                    raise ValueError('More than one Segmentation element')
+                segmentation = segmentations[0]
+                try:
+                    series_uid_element = _single_child(segmentation, 'SeriesUID')
+                except ValueError:
+                    series_uid_element = None
+                if series_uid_element is None:
+                    print("No segmentation series uid for this segmentation")
+                    segmentation_series_uid = None
+                else:
+                    segmentation_series_uid = _cdata(series_uid_element)
+                try:
+                    path_element = _single_child(segmentation, 'Path')
+                except ValueError:
+                    path_element = None
+                segmentation_path_series = _cdata(path_element) if path_element is not None else None
+                if segmentation.get("SphereRadius") is not None:
+                    print('patient dir has spheres as segmentations. must correct:', os.path.dirname(xml_file))
+                if not patient_data:
+                    raise AttributeError('no PatientData')
+                records.append(_segmentation_record(root.get("time"), idx_tr, patient_data[0].get("seriesID"),
+                                                    series_number, segmentation_series_uid, segmentation_path_series,
+                                                    segmentation.attrib))
+        except Exception:
+            # no clue what happened, some XML error
+            records.append(None)
+    return records
+
+
+def read_segmentation_records_untangle(xml_file):
+    """
+    Same as read_segmentation_records, with the untangle object tree. Kept for the benchmark.
+    :param xml_file: filepath
+    :return: list of segmentation records (None for a trajectory that could not be read), None if the file cannot be
+    parsed or has no Trajectories
+    """
+    try:
+        xmlobj = ut.parse(xml_file)
+    except Exception as e:
+        # the file is not an xml
+        return None
+    try:
+        trajectories = xmlobj.Eagles.Trajectories
+    except Exception as e:
+        print(repr(e))
+        return None
+    records = []
+    for idx, tr in enumerate(trajectories):
+        try:
+            single_tr = tr.Trajectory
+            for idx_tr, el in enumerate(single_tr):
+                try:
+                    segmentation = el.Segmentation
+                except AttributeError:
+                    # no segmentation found in this trajectory
+                    continue  # go back to the beginning of the loop
+                try:
+                    series_number = xmlobj.Eagles.PatientData["seriesNumber"]
+                except AttributeError:
+                    series_number = None
+                try:
+                    segmentation_series_uid = el.Segmentation.SeriesUID.cdata
+                except AttributeError:
+                    print("No segmentation series uid for this segmentation")
+                    segmentation_series_uid = None
+                try:
+                    segmentation_path_series = el.Segmentation.Path.cdata
+                except AttributeError:
+                    segmentation_path_series = None
+                attributes = {key: el.Segmentation[key] for key in ["StructureType", "TypeOfSegmentation",
+                                                                    "SphereRadius"]}
+                if attributes["SphereRadius"] is not None:
+                    print('patient dir has spheres as segmentations. must correct:', os.path.dirname(xml_file))
+                records.append(_segmentation_record(xmlobj.Eagles["time"], idx_tr,
+                                                    xmlobj.Eagles.PatientData["seriesID"], series_number,
+                                                    segmentation_series_uid, segmentation_path_series, attributes))
+        except Exception:
+            # no clue what happened, some XML error
+            records.append(None)
+    return records
+
+
+class SegmentationPathsCollector(object):
+
+    def __init__(self, records=None):
+        """
+        Segmentation records of the XML recordings of a patient, with hash indexes of the PathSeries and SphereRadius
+        values already collected so that the duplicates are found in O(1).
+        :param records: list of records to extend in place, eg. the list given to create_tumour_ablation_mapping
+        """
+        self.records = records if records is not None else []
+        self._paths_series = set()
+        self._sphere_radii = set()
+        for record in self.records:
+            self._index(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def _index(self, record):
+        if record is not None:
+            self._paths_series.add(record["PathSeries"])
+            self._sphere_radii.add(record["SphereRadius"])
 
-def create_tumour_ablation_mapping(dir_xml_files, list_segmentations_paths_xml):
+    def append(self, record):
+        """
+        Add a record without checking for duplicates, None for a trajectory that could not be read.
+        :param record: segmentation record or None
+        :return:
+        """
+        self.records.append(record)
+        self._index(record)
+
+    def add(self, record):
+        """
+        Add a record unless both its PathSeries and its SphereRadius were already collected.
+        :param record: segmentation record
+        :return: True if the record was added
+        """
+        if record["PathSeries"] in self._paths_series and record["SphereRadius"] in self._sphere_radii:
+            return False
+        self.append(record)
+        return True
+
+    def to_dataframe(self):
+        """
+        :return: pandas DataFrame of the records with the TimeStartSegmentation (date of the Timestamp) column
+        """
+        df_segmentations_paths_xml = pd.DataFrame(self.records)
+        if df_segmentations_paths_xml.empty:
+            return df_segmentations_paths_xml
+        try:
+            df_segmentations_paths_xml["TimeStartSegmentation"] = df_segmentations_paths_xml["Timestamp"].map(
+                lambda x: x.split()[0])
+        except KeyError:
+            print('The TimeStamp Column in DataFrame is empty')
+        return df_segmentations_paths_xml
+
+
+def recording_state(dir_xml_files):
+    """
+    :param dir_xml_files: CAS-One recording folder (date_time)
+    :return: mtime of the folder and (filename, size, mtime) of its Plan and AblationValidation XMLs, None if the folder
+    does not exist
+    """
+    try:
+        entries = sorted((entry for entry in os.scandir(dir_xml_files) if entry.is_file() and
+                          is_segmentation_xml(entry.name)), key=lambda entry: entry.name)
+        folder_mtime = os.stat(dir_xml_files).st_mtime_ns
+    except OSError:
+        return None
+    return folder_mtime, tuple((entry.name, entry.stat().st_size, entry.stat().st_mtime_ns) for entry in entries)
+
+
+def read_xml_files_records(xml_files, read_records=read_segmentation_records, workers=1, parse_cache=None):
+    """
+    Segmentation records of each XML file. The files unchanged since they were cached in parse_cache are not parsed,
+    the others are parsed in a pool of worker processes and cached.
+    :param xml_files: list of Plan and AblationValidation XML filepaths
+    :param read_records: function(xml_file) extracting the segmentation records of a file
+    :param workers: number of worker processes, 1 parses the files in this process
+    :param parse_cache: XmlParseCache or None
+    :return: list with the records of each file (see read_segmentation_records), in the order of xml_files
+    """
+    files_records = [None] * len(xml_files)
+    to_parse = []
+    for idx, xml_file in enumerate(xml_files):
+        cached = parse_cache.get(xml_file, read_records.__name__) if parse_cache is not None else None
+        if cached is not None:
+            files_records[idx] = cached["records"]
+        else:
+            to_parse.append(idx)
+    files = [xml_files[idx] for idx in to_parse]
+    if workers <= 1 or len(files) < 2:
+        parsed = map(read_records, files)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map returns the results in the order of the files
+            parsed = list(executor.map(read_records, files, chunksize=max(1, len(files) // (4 * workers))))
+    for idx, records in zip(to_parse, parsed):
+        files_records[idx] = records
+        if parse_cache is not None:
+            parse_cache.put(xml_files[idx], read_records.__name__, {"records": records})
+    return files_records
+
+
+def read_recording_records(dir_xml_files, read_records=read_segmentation_records, use_cache=True, parse_cache=None):
+    """
+    Segmentation records of all the Plan and AblationValidation XMLs of a recording folder, in filename order.
+    The records are memoized per folder and reused as long as the folder and its XMLs are unchanged.
+    :param dir_xml_files: CAS-One recording folder (date_time)
+    :param read_records: function(xml_file) extracting the segmentation records of a file
+    :param use_cache: look up and store the records in the memo
+    :param parse_cache: XmlParseCache of the records of each file across runs, or None
+    :return: list of records (None for a trajectory that could not be read), None if the folder does not exist
+    """
+    dir_xml_files = os.path.normpath(dir_xml_files)
+    state = recording_state(dir_xml_files)
+    if state is None:
+        return None
+    key = (read_records.__name__, state)
+    if use_cache:
+        cached = _recording_cache.get(dir_xml_files)
+        if cached is not None and cached[0] == key:
+            _recording_cache.move_to_end(dir_xml_files)
+            return cached[1]
+    recording_records = _merge_files_records(read_xml_files_records(_state_files(dir_xml_files, state), read_records,
+                                                                    parse_cache=parse_cache))
+    if use_cache:
+        _memoize_recording(dir_xml_files, key, recording_records)
+    return recording_records
+
+
+def _memoize_recording(dir_xml_files, key, recording_records):
+    # the least recently used folders are dropped above RECORDING_CACHE_SIZE
+    _recording_cache[dir_xml_files] = (key, recording_records)
+    _recording_cache.move_to_end(dir_xml_files)
+    while len(_recording_cache) > RECORDING_CACHE_SIZE:
+        _recording_cache.popitem(last=False)
+
+
+def _state_files(dir_xml_files, state):
+    # filepaths of the XMLs listed in the folder state, in filename order
+    return [os.path.join(dir_xml_files, file) for file, size, mtime in state[1]]
+
+
+def _merge_files_records(files_records):
+    # records of a recording folder from the records of its files
+    recording_records = []
+    for records in files_records:
+        if records is not None:
+            recording_records.extend(records)
+    return recording_records
+
+
+def prefetch_recordings(recording_dirs, workers=1, read_records=read_segmentation_records, parse_cache=None):
+    """
+    Parse the recording folders not memoized yet, their files in a pool of worker processes, and memoize their
+    records, so that the following create_tumour_ablation_mapping calls merge them in their usual order without parsing.
+    :param recording_dirs: list of CAS-One recording folders
+    :param workers: number of worker processes, 1 parses the files in this process
+    :param read_records: function(xml_file) extracting the segmentation records of a file
+    :param parse_cache: XmlParseCache of the records of each file across runs, or None
+    :return: number of folders parsed
+    """
+    pending = []
+    xml_files = []
+    for dir_xml_files in dict.fromkeys(os.path.normpath(d) for d in recording_dirs):
+        state = recording_state(dir_xml_files)
+        if state is None:
+            continue
+        key = (read_records.__name__, state)
+        cached = _recording_cache.get(dir_xml_files)
+        if cached is None or cached[0] != key:
+            files = _state_files(dir_xml_files, state)
+            pending.append((dir_xml_files, key, len(files)))
+            xml_files += files
+    files_records = read_xml_files_records(xml_files, read_records, workers, parse_cache)
+    start = 0
+    for dir_xml_files, key, n_files in pending:
+        _memoize_recording(dir_xml_files, key, _merge_files_records(files_records[start:start + n_files]))
+        start += n_files
+    return len(pending)
+
+
+def clear_recording_cache():
+    """
+    Forget the memoized records of all the recording folders.
+    :return:
+    """
+    _recording_cache.clear()
+
+
+def create_tumour_ablation_mapping(dir_xml_files, list_segmentations_paths_xml, read_records=read_segmentation_records,
+                                   use_cache=True, parse_cache=None):
     """
     Parses all the XML Files in a given directory and extracts the Source SeriesInstanceSeries on which the segmentation
     files were annotated and the SeriesInstanceUID of the segmentations
-    :param list_segmentations_paths_xml: list of dicts with SeriesInstanceUID, TimeStamp adn SourceUID of segmentation files
+    :param list_segmentations_paths_xml: SegmentationPathsCollector or list of dicts with SeriesInstanceUID, TimeStamp
+    adn SourceUID of segmentation files, extended in place
     :param dir_xml_files: filepath to where the XML recordings are (date_time)
+    :param read_records: function(xml_file) extracting the segmentation records of a file
+    :param use_cache: reuse the records memoized for the folder if it is unchanged (see read_recording_records)
+    :param parse_cache: XmlParseCache of the records of each file across runs, or None
     :return: list_segmentations_paths_xml: Pandas DF with segmentation Sorur
     """
+    if isinstance(list_segmentations_paths_xml, SegmentationPathsCollector):
+        collector = list_segmentations_paths_xml
+    else:
+        collector = SegmentationPathsCollector(list_segmentations_paths_xml)
+    records = read_recording_records(dir_xml_files, read_records, use_cache, parse_cache)
+    for dict_series_path_xml in records or []:
+        if dict_series_path_xml is None:
+            collector.append(None)
+        elif dict_series_path_xml["SegmentationSeriesUID_xml"] or dict_series_path_xml["SphereRadius"] is not None:
+            # only add unique segmentations paths, skip duplicates
+            collector.add(dict_series_path_xml)
+    return list_segmentations_paths_xml
+
 
-    # list_dict_paths_xml = []
+def benchmark_segmentation_xml_parsing(rootdir, repeat=5, workers=1):
+    """
+    Compare the ElementTree and the untangle extractors on all the Plan and AblationValidation XMLs under rootdir,
+    and the serial and parallel parsing of the recording folders.
+    :param rootdir: folder with CAS-One recordings
+    :param repeat: number of times each file is parsed
+    :param workers: number of worker processes of the parallel parsing
+    :return: dict of seconds per extractor and the number of files, raise AssertionError if the records differ
+    """
+    xml_files = [os.path.join(subdir, file) for subdir, dirs, files in os.walk(rootdir) for file in sorted(files)
+                 if is_segmentation_xml(file)]
+    timings = {"files": len(xml_files)}
+    results = {}
+    for name, read_records in [("untangle", read_segmentation_records_untangle),
+                               ("ElementTree", read_segmentation_records)]:
+        start = time.perf_counter()
+        for i in range(repeat):
+            results[name] = [read_records(xml_file) for xml_file in xml_files]
+        timings[name] = time.perf_counter() - start
+    assert results["untangle"] == results["ElementTree"], 'the extractors returned different records'
+    recording_dirs = list(dict.fromkeys(os.path.dirname(xml_file) for xml_file in xml_files))
+    for name, n_workers in [("serial folders", 1), ("parallel folders", workers)]:
+        start = time.perf_counter()
+        for i in range(repeat):
+            clear_recording_cache()
+            prefetch_recordings(recording_dirs, n_workers)
+            results[name] = [_recording_cache[os.path.normpath(d)][1] for d in recording_dirs]
+        timings[name] = time.perf_counter() - start
+    assert results["serial folders"] == results["parallel folders"], 'the parallel parsing returned different records'
+    clear_recording_cache()
+    return timings
 
-    for subdir, dirs, files in os.walk(dir_xml_files):
 
-        for file in sorted(files):
-            xml_file = os.path.join(subdir, file)
-            if file.startswith('AblationValidation_') or file.startswith('Plan_'):
-                try:
-                    xmlobj = ut.parse(xml_file)
-                except Exception as e:
-                    # the file is not an xml
-                    continue
-                try:
-                    trajectories = xmlobj.Eagles.Trajectories
-                except Exception as e:
-                    print(repr(e))
-                    continue
-                for idx, tr in enumerate(trajectories):
-                    try:
-                        single_tr = tr.Trajectory
-                        for idx_tr, el in enumerate(single_tr):
-                            # do the source series mapping based on the seriesID from the XML PatientData
-                            # match ablation and tumour segmentations based on the needle index
-                            # ignore unique values
-                            # just loop until you find a not None value for both tumour and ablation at the same needle idx
-                            try:
-                                segmentation = el.Segmentation
-                            except AttributeError:
-                                # no segmentation found in this trajectory
-                                continue  # go back to the beginning of the loop
-                            try:
-                                series_number = xmlobj.Eagles.PatientData["seriesNumber"]
-                            except AttributeError:
-                                series_number = None
-                            try:
-                                segmentation_series_uid = el.Segmentation.SeriesUID.cdata
-                            except AttributeError:
-                                print("No segmentation series uid for this segmentation")
-                                segmentation_series_uid = None
-                            try:
-                                segmentation_path_series = el.Segmentation.Path.cdata
-                            except AttributeError:
-                                # print('no segmentation path available')
-                                segmentation_path_series = None
-                            try:
-                                type_of_segmentation = el.Segmentation["TypeOfSegmentation"]
-                            except AttributeError:
-                                type_of_segmentation = None
-                            try:
-                                sphere_radius = el.Segmentation["SphereRadius"]
-                            except AttributeError:
-                                sphere_radius = None
-
-                            if sphere_radius is not None:
-                                print('patient dir has spheres as segmentations. must correct:', dir_xml_files)
-
-                            dict_series_path_xml = {
-                                "Timestamp": xmlobj.Eagles["time"],
-                                "NeedleIdx": idx_tr,
-                                "SourceSeriesID": xmlobj.Eagles.PatientData["seriesID"],
-                                "PathSeries": segmentation_path_series,
-                                "SegmentationSeriesUID_xml": segmentation_series_uid,
-                                "SegmentLabel": el.Segmentation["StructureType"],
-                                "TypeOfSegmentation": type_of_segmentation,
-                                "SphereRadius": sphere_radius,
-                                "SeriesNumber": series_number
-                            }
-
-                            if segmentation_series_uid or sphere_radius is not None:
-                                try:
-                                    # look if the SegmentationSeriesUID already exists in the dictionary
-                                    path_series_found = next((item for item in list_segmentations_paths_xml if
-                                                              item["PathSeries"] == segmentation_path_series),
-                                                             None)
-                                    sphere_radius_found = next(
-                                        (item for item in list_segmentations_paths_xml if
-                                         item["SphereRadius"] == sphere_radius),
-                                        None)
-                                except AttributeError:
-                                    print('WTF')
-                                    # print(list_segmentations_paths_xml)
-                                if path_series_found is None or sphere_radius_found is None:
-                                    # only add unique segmentations paths, skip duplicates
-                                    list_segmentations_paths_xml.append(dict_series_path_xml)
-                    except Exception:
-                        # no clue what happened, some XML error
-                        list_segmentations_paths_xml.append(None)
-
-        return list_segmentations_paths_xml
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--rootdir", required=True, help="folder with CAS-One recordings, eg. a patient folder")
+    ap.add_argument("-r", "--repeat", required=False, type=int, default=5, help="number of times each file is parsed")
+    ap.add_argument("-w", "--workers", required=False, type=int, default=os.cpu_count(),
+                    help="worker processes of the parallel parsing")
+    args = vars(ap.parse_args())
+    timings = benchmark_segmentation_xml_parsing(args["rootdir"], args["repeat"], args["workers"])
+    print('%d files, untangle: %.3f s, ElementTree: %.3f s (x%.1f)' % (
+        timings["files"], timings["untangle"], timings["ElementTree"], timings["untangle"] / timings["ElementTree"]))
+    print('recording folders, serial: %.3f s, %d workers: %.3f s' % (timings["serial folders"], args["workers"],
+                                                                      timings["parallel folders"]))
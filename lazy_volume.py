@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy (z, y, x) volume of a DICOM series for the viewers: only the headers are read when it is opened, a z-slice is
+decoded the first time it is displayed. A window of the recently used slices is kept in memory and a background
+thread decodes the next slices in the scrolling direction, so that previewing a large CT starts at once.
+"""
+import argparse
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import SimpleITK as sitk
+
+from DicomReader import decode_slice, read_dcm_volume, read_series_geometry
+from volume_cache import volume_to_sitk
+
+_STOP = object()  # stops the prefetch thread
+
+
+class LazyVolume(object):
+
+    def __init__(self, path, window=32, prefetch=8, dtype=np.int16, rescale=True, workers=None):
+        """
+        :param path: folder of the series or list of the series filepaths
+        :param window: number of decoded slices kept in memory, least recently used dropped first
+        :param prefetch: number of slices decoded ahead of the last slice accessed, 0 to disable the prefetch thread
+        :param dtype: dtype of the slices
+        :param rescale: apply RescaleSlope and RescaleIntercept (Hounsfield Units for CT)
+        :param workers: number of threads reading the headers
+        """
+        self.geometry = read_series_geometry(path, workers)
+        if self.geometry is None:
+            raise ValueError('No DICOM slice found in %s' % path)
+        columns, rows, slices = self.geometry["Size"]
+        self.shape = (slices, rows, columns)
+        self.dtype = np.dtype(dtype)
+        self.ndim = 3
+        self.rescale = rescale
+        self.window = max(window, prefetch + 1)
+        self.prefetch = prefetch
+        self.hits = 0
+        self.misses = 0
+        self._slices = OrderedDict()  # z -> decoded slice, least recently used first
+        self._lock = threading.Lock()
+        self._last_z = None
+        # bounded, the requests of the slices scrolled past are dropped (see get_slice)
+        self._prefetch_queue = queue.Queue(maxsize=max(prefetch, 1))
+        self._thread = None
+        if prefetch > 0:
+            self._thread = threading.Thread(target=self._prefetch_slices)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def GetSpacing(self):
+        """
+        :return: spacing (x, y, z), as SimpleITK Image.GetSpacing
+        """
+        return self.geometry["Spacing"]
+
+    def slice_image(self, z):
+        """
+        :param z: slice index
+        :return: 2D SimpleITK Image of the z-slice with its in-plane spacing, origin and direction
+        """
+        image = sitk.GetImageFromArray(self.get_slice(z))
+        direction = np.reshape(self.geometry["Direction"], (3, 3))
+        image.SetSpacing(self.geometry["Spacing"][0:2])
+        origin = np.asarray(self.geometry["Origin"]) + z * self.geometry["Spacing"][2] * direction[:, 2]
+        image.SetOrigin(tuple(origin[0:2]))
+        image.SetDirection(tuple(direction[0:2, 0:2].flatten()))
+        return image
+
+    def to_sitk(self):
+        """
+        Decode all the slices once into a 3D SimpleITK Image with the geometry of the series.
+        :return: SimpleITK Image
+        """
+        return volume_to_sitk(np.asarray(self), self.geometry)
+
+    def _decode(self, z):
+        with self._lock:
+            volume_slice = self._slices.get(z)
+            if volume_slice is not None:
+                self._slices.move_to_end(z)
+                return volume_slice, True
+        volume_slice = np.empty(self.shape[1:], dtype=self.dtype)
+        decode_slice(self.geometry["Files"][z], volume_slice, self.rescale)
+        # the viewers get a reference, the cached slice must stay unchanged
+        volume_slice.flags.writeable = False
+        with self._lock:
+            self._slices[z] = volume_slice
+            while len(self._slices) > self.window:
+                self._slices.popitem(last=False)
+        return volume_slice, False
+
+    def get_slice(self, z):
+        """
+        :param z: slice index, negative from the end
+        :return: read-only (y, x) array of the slice
+        """
+        if z < 0:
+            z += self.shape[0]
+        if not 0 <= z < self.shape[0]:
+            raise IndexError('slice index %d out of range for %d slices' % (z, self.shape[0]))
+        volume_slice, cached = self._decode(z)
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+        step = -1 if self._last_z is not None and z < self._last_z else 1
+        self._last_z = z
+        if self._thread is not None:
+            self._drop_prefetch_requests()
+            for ahead in range(z + step, z + step * (self.prefetch + 1), step):
+                if 0 <= ahead < self.shape[0]:
+                    try:
+                        self._prefetch_queue.put_nowait(ahead)
+                    except queue.Full:
+                        break
+        return volume_slice
+
+    def _drop_prefetch_requests(self):
+        while True:
+            try:
+                self._prefetch_queue.get_nowait()
+            except queue.Empty:
+                return
+
+    def _prefetch_slices(self):
+        while True:
+            z = self._prefetch_queue.get()
+            if z is _STOP:
+                return
+            last_z = self._last_z
+            if z in self._slices or last_z is None or abs(z - last_z) > self.prefetch:
+                continue  # already decoded or outdated by the scrolling
+            try:
+                self._decode(z)
+            except Exception as e:
+                # reported when the slice is accessed
+                print('Prefetch of slice %d failed: %s' % (z, e))
+
+    def __getitem__(self, key):
+        """
+        Numpy indexing in (z, y, x) order, an integer z decodes only that slice.
+        """
+        if not isinstance(key, tuple):
+            key = (key,)
+        z_key, rest = key[0], key[1:]
+        if isinstance(z_key, (int, np.integer)):
+            return self.get_slice(int(z_key))[rest]
+        # several slices: no prefetch, they are all decoded now
+        zs = np.arange(self.shape[0])[z_key]
+        return np.stack([self._decode(int(z))[0] for z in np.atleast_1d(zs)])[(slice(None),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        volume = self[:]
+        return volume.astype(dtype) if dtype is not None else volume
+
+    def close(self):
+        """
+        Stop the prefetch thread and drop the decoded slices. The volume can still be read, without prefetch.
+        :return:
+        """
+        if self._thread is not None:
+            self._drop_prefetch_requests()
+            self._prefetch_queue.put(_STOP)
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            self._slices.clear()
+
+
+def benchmark_lazy_volume(folder, scrolled=20):
+    """
+    Time to the first displayed slice and per scrolled slice, lazy volume compared with the full volume read.
+    :param folder: folder of a DICOM series
+    :param scrolled: number of slices scrolled after the first one
+    :return: dict of seconds
+    """
+    timings = {}
+    start = time.perf_counter()
+    volume, geometry = read_dcm_volume(folder)
+    timings["full volume, first slice"] = time.perf_counter() - start
+    start = time.perf_counter()
+    with LazyVolume(folder) as lazy_volume:
+        first = lazy_volume.shape[0] // 2
+        lazy_volume[first]
+        timings["lazy volume, first slice"] = time.perf_counter() - start
+        start = time.perf_counter()
+        for z in range(first + 1, min(first + 1 + scrolled, lazy_volume.shape[0])):
+            lazy_volume[z]
+            # display time of a slice
+            time.sleep(0.01)
+        timings["lazy volume, per scrolled slice"] = (time.perf_counter() - start) / scrolled - 0.01
+    timings["lazy volume, slices decoded on access"] = lazy_volume.misses
+    return timings
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--series", required=True, help="folder of a DICOM series")
+    ap.add_argument("-n", "--scrolled", required=False, type=int, default=20, help="number of slices scrolled")
+    args = vars(ap.parse_args())
+    for name, value in benchmark_lazy_volume(args["series"], args["scrolled"]).items():
+        print('%-40s %8.4f' % (name, value))
@@ -6,9 +6,15 @@
 import matplotlib.pyplot as plt
 import SimpleITK as sitk
 
+from lazy_volume import LazyVolume
+
 
 def myshow(img, title=None, margin=0.05, dpi=80):
-    nda = sitk.GetArrayFromImage(img)
+    if isinstance(img, LazyVolume):
+        # decode only the displayed slice
+        nda = img[img.shape[0] // 2]
+    else:
+        nda = sitk.GetArrayFromImage(img)
     spacing = img.GetSpacing()
 
     if nda.ndim == 3:
@@ -48,13 +54,27 @@ def myshow(img, title=None, margin=0.05, dpi=80):
         plt.title(title)
 
     plt.show()
+    if isinstance(img, LazyVolume):
+        # stop the prefetch thread once the figure is closed
+        img.close()
 
 
 def myshow3d(img, xslices=[], yslices=[], zslices=[], title=None, margin=0.05,
              dpi=80):
-    img_xslices = [img[s, :, :] for s in range(0, xslices)]
-    img_yslices = [img[:, s, :] for s in range(0, yslices)]
-    img_zslices = [img[:, :, s] for s in range(0, zslices)]
+    lazy_volume = img if isinstance(img, LazyVolume) else None
+    if isinstance(img, LazyVolume) and (xslices or yslices):
+        # the x and y slices cut through all the z-slices: decode the volume once, with its geometry
+        img = img.to_sitk()
+    if isinstance(img, LazyVolume):
+        # axial slices only, decoded one by one
+        img_xslices = []
+        img_yslices = []
+        img_zslices = [img.slice_image(s) for s in range(0, zslices)]
+        img = img_zslices[0] if img_zslices else img.slice_image(0)
+    else:
+        img_xslices = [img[s, :, :] for s in range(0, xslices)]
+        img_yslices = [img[:, s, :] for s in range(0, yslices)]
+        img_zslices = [img[:, :, s] for s in range(0, zslices)]
 
     maxlen = max(len(img_xslices), len(img_yslices), len(img_zslices))
 
@@ -89,4 +109,6 @@ def myshow3d(img, xslices=[], yslices=[], zslices=[], title=None, margin=0.05,
                 img_comps.append(sitk.Tile(img_slices_c, [maxlen, d]))
             img = sitk.Compose(img_comps)
 
-    myshow(img, title, margin, dpi)
\ No newline at end of file
+    myshow(img, title, margin, dpi)
+    if lazy_volume is not None:
+        lazy_volume.close()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the mapping of the DICOM series of a patient folder, from the header index and from one representative
+file per series folder.
+"""
+import os
+
+import pydicom
+
+import A_fix_segmentations_dcm
+from A_fix_segmentations_dcm import create_dict_paths_series_dcm
+from conftest import write_dicom_series
+from dcm_edit_plan import TEMP_SUFFIX
+from dicom_header_index import DicomHeaderIndex
+
+
+def make_patient_folder(rootdir):
+    series_folder = os.path.join(rootdir, "Study_0", "Series_7")
+    segmentation_folder = os.path.join(series_folder, "CAS-One Recordings", "2019-07-28_19-33-55", "Segmentations",
+                                       "SeriesNo_7", "SegmentationNo_0")
+    write_dicom_series(series_folder, n_slices=6, series_uid="1.2.826.0.1.7")
+    write_dicom_series(segmentation_folder, n_slices=2, series_uid="1.2.826.0.1.8")
+    return series_folder, segmentation_folder
+
+
+def count_header_reads(monkeypatch):
+    reads = []
+
+    def read_header_record(dcm_file):
+        reads.append(dcm_file)
+        return read_header_record.original(dcm_file)
+    read_header_record.original = A_fix_segmentations_dcm.read_header_record
+    monkeypatch.setattr(A_fix_segmentations_dcm, "read_header_record", read_header_record)
+    return reads
+
+
+def test_representative_files_give_the_mapping_of_the_index(tmp_path, monkeypatch):
+    rootdir = str(tmp_path / "P1")
+    series_folder, segmentation_folder = make_patient_folder(rootdir)
+    with open(os.path.join(series_folder, ".000" + TEMP_SUFFIX), 'wb') as fp:
+        fp.write(b"left over by an interrupted write")
+    expected = create_dict_paths_series_dcm(rootdir, DicomHeaderIndex.build(rootdir))
+    assert [series["SeriesInstanceNumberUID"] for series in expected] == ["1.2.826.0.1.7", "1.2.826.0.1.8"]
+    assert expected[1]["PathSeries"] == os.sep + os.path.join("Segmentations", "SeriesNo_7", "SegmentationNo_0")
+    reads = count_header_reads(monkeypatch)
+    assert create_dict_paths_series_dcm(rootdir) == expected
+    assert len(reads) == 2  # one file per series folder
+    del reads[:]
+    assert create_dict_paths_series_dcm(rootdir, n_verify=2) == expected
+    assert len(reads) == 2 + 2 + 1  # at most n_verify more slices per folder
+
+
+def test_representative_file_verification_finds_a_second_series(tmp_path, monkeypatch):
+    rootdir = str(tmp_path / "P1")
+    series_folder, segmentation_folder = make_patient_folder(rootdir)
+    dcm_file = os.path.join(series_folder, "005")
+    dataset = pydicom.read_file(dcm_file)
+    dataset.SeriesInstanceUID = "1.2.826.0.1.9"
+    dataset.save_as(dcm_file)
+    series_uids = [series["SeriesInstanceNumberUID"] for series in create_dict_paths_series_dcm(rootdir)]
+    assert series_uids == ["1.2.826.0.1.7", "1.2.826.0.1.8"]  # the slice of the second series is not read
+    reads = count_header_reads(monkeypatch)
+    series_uids = [series["SeriesInstanceNumberUID"] for series in create_dict_paths_series_dcm(rootdir, n_verify=1)]
+    assert series_uids == ["1.2.826.0.1.7", "1.2.826.0.1.9", "1.2.826.0.1.8"]
+    # the representative file, the sampled slice, then all the files of the folder
+    assert reads.count(dcm_file) == 2 and len([f for f in reads if os.path.dirname(f) == series_folder]) == 2 + 6
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DICOM series reading: the volume decoding against SimpleITK (GDCM), the in-process volume cache and
+the discovery of the series of a folder tree.
+"""
+import os
+
+import numpy as np
+import pydicom
+import pytest
+import SimpleITK as sitk
+
+import DicomReader
+from conftest import write_dicom_series
+from DicomReader import VolumeCache, discover_series, read_dcm_series, read_dcm_volume, source_key
+
+
+def touch(filepath, seconds=1):
+    stat = os.stat(filepath)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+
+def set_rescale(folder, slope, intercept):
+    for file in os.listdir(folder):
+        dataset = pydicom.read_file(os.path.join(folder, file))
+        dataset.RescaleSlope = slope
+        dataset.RescaleIntercept = intercept
+        dataset.save_as(os.path.join(folder, file))
+
+
+def gdcm_volume(folder):
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(reader.GetGDCMSeriesFileNames(folder))
+    return sitk.GetArrayFromImage(reader.Execute())
+
+
+@pytest.mark.parametrize("slope, intercept", [(1, -1024), (1, -1024.5), (0.5, -1024.5), (2.5, 0.25)])
+def test_rescaled_volume_matches_gdcm(dicom_series, slope, intercept):
+    folder = dicom_series(n_slices=3)
+    set_rescale(folder, slope, intercept)
+    expected = gdcm_volume(folder)
+    volume, geometry = read_dcm_volume(folder)
+    assert volume.dtype == np.int16
+    # rounded to the nearest integer, not truncated towards zero
+    np.testing.assert_array_equal(volume, np.rint(expected))
+    volume, geometry = read_dcm_volume(folder, dtype=np.float32)
+    np.testing.assert_allclose(volume, expected)
+
+
+def test_process_pool_decodes_the_same_volume(dicom_series):
+    folder = dicom_series(n_slices=7)
+    set_rescale(folder, 0.5, -1024.5)
+    serial, geometry = read_dcm_volume(folder)
+    volume, pool_geometry = read_dcm_volume(folder, processes=2)
+    np.testing.assert_array_equal(volume, serial)
+    assert pool_geometry == geometry
+    assert volume.flags.writeable and volume.base is None
+
+
+def test_memory_cache_key_changes_with_an_in_place_rewrite(dicom_series):
+    folder = dicom_series()
+    key = source_key(folder)
+    folder_mtime = os.stat(folder).st_mtime_ns
+    touch(os.path.join(folder, "002"))
+    assert os.stat(folder).st_mtime_ns == folder_mtime
+    assert source_key(folder) != key
+
+
+def test_memory_cache_values_are_not_shared_writable(dicom_series):
+    folder = dicom_series()
+    memory_cache = VolumeCache()
+    image = read_dcm_series(folder, False, memory_cache=memory_cache)
+    image[0, 0, 0] = 99
+    assert read_dcm_series(folder, False, memory_cache=memory_cache)[0, 0, 0] != 99
+    memory_cache.put("volume", np.zeros(4))
+    with pytest.raises(ValueError):
+        memory_cache.get("volume")[0] = 1
+
+
+def test_memory_cache_evicts_the_least_recently_used(tmp_path):
+    memory_cache = VolumeCache(max_bytes=100)
+    memory_cache.put("a", np.zeros(40, dtype=np.uint8))
+    memory_cache.put("b", np.zeros(40, dtype=np.uint8))
+    memory_cache.get("a")
+    memory_cache.put("c", np.zeros(40, dtype=np.uint8))
+    assert memory_cache.get("b") is None
+    assert memory_cache.get("a") is not None and memory_cache.get("c") is not None
+    assert not memory_cache.put("d", np.zeros(200, dtype=np.uint8))
+    assert memory_cache.stats()["evictions"] == 1
+
+
+def set_position(filepath, z):
+    dataset = pydicom.read_file(filepath)
+    dataset.ImagePositionPatient = [0.0, 0.0, z]
+    dataset.save_as(filepath)
+
+
+def test_discover_series_groups_the_files_by_series(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    first = write_dicom_series(os.path.join(rootdir, "a"), n_slices=3, series_uid="1.2.826.0.1.1")
+    # a series split over two folders, its files named against the slice order
+    second = write_dicom_series(os.path.join(rootdir, "b"), n_slices=4, rows=5, series_uid="1.2.826.0.1.2")
+    for filepath in second[:2]:
+        os.replace(filepath, os.path.join(rootdir, "a", "z" + os.path.basename(filepath)))
+    with open(os.path.join(rootdir, "a", "notes.txt"), 'w') as fp:
+        fp.write("not a DICOM file")
+    series_index = discover_series(rootdir, workers=2)
+    assert list(series_index) == ["1.2.826.0.1.1", "1.2.826.0.1.2"]
+    assert series_index["1.2.826.0.1.1"]["Files"] == [os.path.normpath(f) for f in first]
+    series = series_index["1.2.826.0.1.2"]
+    assert [os.path.basename(f) for f in series["Files"]] == ["z000", "z001", "002", "003"]
+    assert series["Folders"] == [os.path.join(rootdir, "a"), os.path.join(rootdir, "b")]
+    assert series["Size"] == (6, 5, 4) and series["SliceSpacing"] == (2.5, 2.5)
+    assert series["Consistent"] and series["Issues"] == []
+    image = read_dcm_series(rootdir, False, series_uid="1.2.826.0.1.2", series_index=series_index)
+    assert image.GetSize() == series["Size"]
+    assert np.allclose(image.GetOrigin(), series["Origin"]) and np.allclose(image.GetSpacing(), series["Spacing"])
+
+
+def test_discover_series_reports_the_inconsistent_series(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    duplicates = write_dicom_series(os.path.join(rootdir, "duplicates"), n_slices=4)
+    set_position(duplicates[2], 2.5)
+    irregular = write_dicom_series(os.path.join(rootdir, "irregular"), n_slices=4)
+    set_position(irregular[3], 10.0)
+    series_index = discover_series(rootdir)
+    issues = {os.path.basename(series["Folders"][0]): series["Issues"] for series in series_index.values()}
+    assert issues["duplicates"] == ['duplicate slice positions', 'irregular slice spacing (2.500 to 5.000 mm)']
+    assert issues["irregular"] == ['irregular slice spacing (2.500 to 5.000 mm)']
+    assert not any(series["Consistent"] for series in series_index.values())
+
+
+def test_discover_series_reuses_the_cached_headers(tmp_path, monkeypatch):
+    rootdir = str(tmp_path / "P1")
+    filepaths = write_dicom_series(os.path.join(rootdir, "a"), n_slices=3)
+    cache_file = os.path.join(rootdir, "series_index.json")
+    series_index = discover_series(rootdir, cache_file=cache_file)
+    reads = []
+    read_dcm_metadata = DicomReader.read_dcm_metadata
+
+    def counting_read(filepath, tags=None):
+        reads.append(filepath)
+        return read_dcm_metadata(filepath, tags)
+    monkeypatch.setattr(DicomReader, "read_dcm_metadata", counting_read)
+    assert discover_series(rootdir, cache_file=cache_file) == series_index
+    assert reads == []
+    touch(filepaths[1])
+    assert discover_series(rootdir, cache_file=cache_file) == series_index
+    assert reads == [os.path.normpath(filepaths[1])]
+    # the cache of another folder is not used
+    os.rename(rootdir, str(tmp_path / "P2"))
+    discover_series(str(tmp_path / "P2"), cache_file=os.path.join(str(tmp_path / "P2"), "series_index.json"))
+    assert len(reads) == 4
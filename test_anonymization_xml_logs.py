@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the XML recordings encoding: the streaming encoder gives the same document as the ElementTree one, the
+SeriesUID lookup and the prescan of the files to encode.
+"""
+import os
+import xml.etree.ElementTree as ET
+
+import pandas as pd
+
+from anonymization_xml_logs import (SeriesUIDMap, encode_xml, encode_xml_streaming, main_encode_xml,
+                                   xml_needs_encoding)
+
+DF_CT_MAPPING = pd.DataFrame({"PathSeries": ["/Segmentations/SeriesNo_7/SegmentationNo_0"],
+                              "SeriesInstanceNumberUID": ["1.2.826.0.1.99"]})
+
+
+def canonical_xml(filename):
+    with open(filename, 'r', encoding='utf-8') as fp:
+        return ET.canonicalize(fp.read(), strip_text=True)
+
+
+def test_streaming_encoder_matches_encode_xml(plan_xml):
+    tree_file = plan_xml("Plan_tree.xml")
+    streamed_file = plan_xml("Plan_streamed.xml")
+    encode_xml(tree_file, "M01", "MAVM01", "19380517", DF_CT_MAPPING)
+    assert encode_xml_streaming(streamed_file, "M01", "MAVM01", "19380517", DF_CT_MAPPING) is True
+    assert canonical_xml(streamed_file) == canonical_xml(tree_file)
+    root = ET.parse(streamed_file).getroot()
+    assert root.find('PatientInfo').attrib == {"ID": "M01", "Initial": "MAVM01", "DOB": "1938-01-01"}
+    assert root.find('PatientData').get('seriesPath') == " "
+    # the segmentation without DICOM series keeps its SeriesUID
+    assert [el.text for el in root.iter('SeriesUID')] == ["1.2.826.0.1.99", "1.2.3.5"]
+
+
+def test_streaming_encoder_does_not_rewrite_an_encoded_file(plan_xml):
+    filename = plan_xml()
+    assert encode_xml_streaming(filename, "M01", "MAVM01", "19380517", DF_CT_MAPPING) is True
+    mtime = os.stat(filename).st_mtime_ns
+    assert encode_xml_streaming(filename, "M01", "MAVM01", "19380517", DF_CT_MAPPING) is False
+    assert os.stat(filename).st_mtime_ns == mtime
+
+
+def test_streaming_encoder_reports_a_broken_file(tmp_path):
+    filename = str(tmp_path / "Plan_broken.xml")
+    with open(filename, 'w') as fp:
+        fp.write('<Eagles><PatientInfo ID="P1"></Eagles>')
+    assert encode_xml_streaming(filename, "M01", "MAVM01", "19380517", DF_CT_MAPPING) is None
+    assert os.listdir(str(tmp_path)) == ["Plan_broken.xml"]
+
+
+def test_series_uid_map_keeps_the_first_row_and_records_the_misses(plan_xml, capsys):
+    df_ct_mapping = pd.DataFrame({"PathSeries": ["/A", "/B", "/A"],
+                                  "SeriesInstanceNumberUID": ["1.2.1", "1.2.2", "1.2.3"]})
+    series_uid_map = SeriesUIDMap(df_ct_mapping)
+    assert series_uid_map.lookup("/A", "Plan_1.xml") == "1.2.1"
+    assert series_uid_map.lookup("/C", "Plan_1.xml") is None
+    assert series_uid_map.lookup("/C", "Plan_1.xml") is None
+    assert SeriesUIDMap(pd.DataFrame({"PathSeries": ["/A"]})).lookup("/A") is None
+    # one map for all the XMLs of the patient: the misses of each file are reported once
+    series_uid_map = SeriesUIDMap(DF_CT_MAPPING)
+    filenames = [plan_xml("Plan_1.xml"), plan_xml("Plan_2.xml")]
+    for filename in filenames:
+        encode_xml(filename, "M01", "MAVM01", "19380517", series_uid_map)
+    misses = series_uid_map.report_misses()
+    assert misses == [(filename, "/Segmentations/SeriesNo_7/SegmentationNo_1") for filename in filenames]
+    assert capsys.readouterr().out.count('No DICOM series found') == 2
+    assert [el.text for el in ET.parse(filenames[0]).getroot().iter('SeriesUID')] == ["1.2.826.0.1.99", "1.2.3.5"]
+
+
+def test_prescan_finds_the_files_to_encode(tmp_path, plan_xml):
+    def write(name, content):
+        filename = str(tmp_path / name)
+        with open(filename, 'wb') as fp:
+            fp.write(content)
+        return filename
+    assert xml_needs_encoding(plan_xml())
+    assert xml_needs_encoding(write("info.xml", b'<Eagles><PatientInfo/></Eagles>'))
+    assert xml_needs_encoding(write("utf16.xml", '<Eagles><Other/></Eagles>'.encode('utf-16')))
+    assert not xml_needs_encoding(write("empty.xml", b''))
+    assert not xml_needs_encoding(write("other.xml", b'<Eagles><PatientInfos/><Segmentations/></Eagles>'))
+
+
+def test_prescan_skips_the_files_without_elements_to_encode(tmp_path, plan_xml, capsys):
+    filename = plan_xml()
+    other = str(tmp_path / "Navigation_1.xml")
+    with open(other, 'w') as fp:
+        fp.write('<Eagles time="2019-07-28 19:33:55"><Trajectories/></Eagles>')
+    mtime = os.stat(other).st_mtime_ns
+    main_encode_xml(str(tmp_path), "M01", "MAVM01", "19380517", DF_CT_MAPPING)
+    assert 'skipped by the prescan: 1 of 2' in capsys.readouterr().out
+    assert os.stat(other).st_mtime_ns == mtime
+    assert ET.parse(filename).getroot().find('PatientInfo').get('ID') == "M01"
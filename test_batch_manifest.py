@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the per-patient manifest of the segmentation fix pipeline.
+"""
+import os
+
+from batch_manifest import MANIFEST_FILENAME, PatientManifest
+from conftest import write_dicom_series
+from dcm_edit_plan import DicomEditPlan
+from dicom_header_index import state_filepath
+
+PATIENT = {"Patient Name": "M01", "Patient_ID": "P1", "Date_of_Birth": "19380101", "Anonymize_All": True}
+
+
+def load_manifest(rootdir):
+    state_dir = os.path.join(os.path.dirname(rootdir), "state")
+    return PatientManifest(rootdir, state_filepath(rootdir, MANIFEST_FILENAME, state_dir))
+
+
+def run_manifest(rootdir, patient=PATIENT, tags=None):
+    # the steps of fix_segmentations_patient_folder around the edits
+    manifest = load_manifest(rootdir)
+    manifest.start(patient)
+    edit_plan = DicomEditPlan()
+    for file in sorted(os.listdir(os.path.join(rootdir, "series"))):
+        edit_plan.set_tags(os.path.join(rootdir, "series", file), **(tags or {"SeriesDescription": "fixed"}))
+    skipped = manifest.filter_plan(edit_plan)
+    edit_plan.apply(lambda dcm_file: manifest.file_written(dcm_file, edit_plan.input_hashes.pop(dcm_file, None)))
+    manifest.complete()
+    return skipped
+
+
+def test_is_unchanged_after_a_complete_run(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    write_dicom_series(os.path.join(rootdir, "series"))
+    assert not load_manifest(rootdir).is_unchanged(PATIENT)
+    run_manifest(rootdir)
+    assert load_manifest(rootdir).is_unchanged(PATIENT)
+    assert not load_manifest(rootdir).is_unchanged(dict(PATIENT, Patient_ID="P2"))
+
+
+def test_is_unchanged_detects_a_modified_added_or_removed_file(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    filepaths = write_dicom_series(os.path.join(rootdir, "series"))
+    run_manifest(rootdir)
+    stat = os.stat(filepaths[0])
+    os.utime(filepaths[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not load_manifest(rootdir).is_unchanged(PATIENT)
+    run_manifest(rootdir)
+    with open(os.path.join(rootdir, "series", "notes.txt"), 'w') as fp:
+        fp.write("added")
+    assert not load_manifest(rootdir).is_unchanged(PATIENT)
+    os.remove(os.path.join(rootdir, "series", "notes.txt"))
+    assert load_manifest(rootdir).is_unchanged(PATIENT)
+    os.remove(filepaths[1])
+    assert not load_manifest(rootdir).is_unchanged(PATIENT)
+
+
+def test_is_unchanged_after_an_interrupted_run(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    write_dicom_series(os.path.join(rootdir, "series"))
+    manifest = load_manifest(rootdir)
+    manifest.start(PATIENT)
+    assert not load_manifest(rootdir).is_unchanged(PATIENT)
+
+
+def test_rerun_skips_the_files_already_written(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    write_dicom_series(os.path.join(rootdir, "series"), n_slices=3)
+    assert run_manifest(rootdir) == 0
+    assert run_manifest(rootdir) == 3
+    assert run_manifest(rootdir, tags={"SeriesDescription": "fixed again"}) == 0
+
+
+def test_manifest_is_saved_out_of_the_patient_folder(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    write_dicom_series(os.path.join(rootdir, "series"), n_slices=2)
+    run_manifest(rootdir)
+    assert os.path.isfile(load_manifest(rootdir).manifest_file)
+    assert sorted(os.listdir(rootdir)) == ["series"]
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DICOM edit plan: one read and one atomic write per file, the failures kept and raised together.
+"""
+import json
+import os
+
+import pydicom
+import pytest
+
+import dcm_edit_plan
+from conftest import write_dicom_series
+from dcm_edit_plan import DicomEditPlan
+
+
+def test_apply_sets_all_the_planned_tags(tmp_path):
+    filepaths = write_dicom_series(str(tmp_path), n_slices=2)
+    edit_plan = DicomEditPlan()
+    edit_plan.set_tags(filepaths[0], SeriesDescription="first")
+    edit_plan.set_tags(filepaths[0], SeriesDescription="fixed", ReferencedSegmentNumber=1)
+    edit_plan.set_tags(filepaths[1], PatientName="M01")
+    written = []
+    assert sorted(edit_plan.apply(written.append)) == sorted(os.path.normpath(f) for f in filepaths)
+    assert sorted(written) == sorted(os.path.normpath(f) for f in filepaths)
+    dataset = pydicom.read_file(filepaths[0])
+    assert (dataset.SeriesDescription, dataset.ReferencedSegmentNumber) == ("fixed", 1)
+    assert str(pydicom.read_file(filepaths[1]).PatientName) == "M01"
+    assert len(edit_plan) == 0
+    assert sorted(os.listdir(str(tmp_path))) == ["000", "001"]  # no temporary file left
+
+
+def test_apply_writes_sequences(tmp_path):
+    dcm_file = write_dicom_series(str(tmp_path), n_slices=1)[0]
+    edit_plan = DicomEditPlan()
+    edit_plan.set_tags(dcm_file, ReferencedSeriesSequence=[{"SeriesInstanceUID": "1.2.826.0.1.3"}])
+    edit_plan.apply()
+    assert pydicom.read_file(dcm_file).ReferencedSeriesSequence[0].SeriesInstanceUID == "1.2.826.0.1.3"
+
+
+def test_failed_inplace_patch_falls_back_to_the_rewrite(tmp_path, monkeypatch):
+    dcm_file = write_dicom_series(str(tmp_path), n_slices=1)[0]
+
+    def locked_file(dcm_file, tags):
+        raise PermissionError('locked')
+    monkeypatch.setattr(dcm_edit_plan, "patch_tags_inplace", locked_file)
+    edit_plan = DicomEditPlan()
+    edit_plan.set_tags(dcm_file, PatientName="M01")
+    assert edit_plan.apply() == [os.path.normpath(dcm_file)]
+    assert str(pydicom.read_file(dcm_file).PatientName) == "M01"
+
+
+@pytest.mark.parametrize("io_threads", [1, 3])
+def test_failed_files_are_raised_and_kept_in_the_plan(tmp_path, monkeypatch, io_threads):
+    filepaths = [os.path.normpath(f) for f in write_dicom_series(str(tmp_path), n_slices=4)]
+    save_as_atomic = dcm_edit_plan.save_as_atomic
+
+    def full_disk(dataset, dcm_file):
+        if dcm_file == filepaths[2]:
+            raise OSError('disk full')
+        save_as_atomic(dataset, dcm_file)
+    monkeypatch.setattr(dcm_edit_plan, "save_as_atomic", full_disk)
+    edit_plan = DicomEditPlan()
+    for dcm_file in filepaths:
+        edit_plan.set_tags(dcm_file, SeriesDescription="fixed")
+    written = []
+    with pytest.raises(RuntimeError):
+        edit_plan.apply(written.append, io_threads)
+    assert sorted(written) == [filepaths[0], filepaths[1], filepaths[3]]
+    assert list(edit_plan.errors) == [filepaths[2]]
+    assert edit_plan.edits == {filepaths[2]: {"SeriesDescription": "fixed"}}
+    with open(edit_plan.export(str(tmp_path / "plan.json")), 'r') as fp:
+        assert json.load(fp) == {filepaths[2]: {"SeriesDescription": "fixed"}}
+    monkeypatch.setattr(dcm_edit_plan, "save_as_atomic", save_as_atomic)
+    assert edit_plan.apply() == [filepaths[2]]
+    assert edit_plan.errors == {} and len(edit_plan) == 0
+    assert pydicom.read_file(filepaths[2]).SeriesDescription == "fixed"
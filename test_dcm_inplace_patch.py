@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the in-place anonymization of the identifying DICOM tags.
+"""
+import os
+
+import pydicom
+
+from conftest import write_dicom_series
+from dcm_inplace_patch import anonymize_dcm_file, inplace_patches, patch_tags_inplace
+
+
+def test_inplace_patches_locates_the_elements(tmp_path):
+    dcm_file = write_dicom_series(str(tmp_path), n_slices=1, patient_name="Doe^John")[0]
+    patches = inplace_patches(dcm_file, {"PatientName": "M01", "PatientID": "P9"})
+    assert len(patches) == 2
+    with open(dcm_file, 'rb') as fp:
+        content = fp.read()
+    for offset, new_bytes, old_bytes in patches:
+        assert content[offset:offset + len(old_bytes)] == old_bytes
+        assert len(new_bytes) == len(old_bytes)
+    assert patches[0][1] == b'M01'.ljust(len(patches[0][2]), b' ')
+
+
+def test_inplace_patches_refuses_what_does_not_fit(tmp_path):
+    dcm_file = write_dicom_series(str(tmp_path), n_slices=1, patient_id="P1")[0]
+    assert inplace_patches(dcm_file, {"PatientID": "a much longer patient id"}) is None
+    assert inplace_patches(dcm_file, {"SeriesDescription": "x"}) is None  # not an INPLACE_TAGS keyword
+    assert inplace_patches(dcm_file, {"InstitutionAddress": "x"}) is None  # element missing
+    assert inplace_patches(dcm_file, {"PatientName": u"Dö"}) is None  # not ascii
+
+
+def test_patch_tags_inplace_keeps_the_file_size(tmp_path):
+    dcm_file = write_dicom_series(str(tmp_path), n_slices=1)[0]
+    size = os.path.getsize(dcm_file)
+    assert patch_tags_inplace(dcm_file, {"PatientName": "M01", "InstitutionName": ""})
+    dataset = pydicom.read_file(dcm_file)
+    assert os.path.getsize(dcm_file) == size
+    assert str(dataset.PatientName) == "M01"
+    assert dataset.InstitutionName == ""
+    assert dataset.pixel_array.shape == (8, 6)
+
+
+def test_anonymize_dcm_file_falls_back_to_a_rewrite(tmp_path):
+    dcm_file = write_dicom_series(str(tmp_path), n_slices=1, patient_id="P1")[0]
+    assert anonymize_dcm_file(dcm_file, {"PatientID": "P1234567"}) == "rewrite"
+    assert pydicom.read_file(dcm_file).PatientID == "P1234567"
+    assert anonymize_dcm_file(dcm_file, {"PatientID": "P2"}) == "inplace"
+    assert pydicom.read_file(dcm_file).PatientID == "P2"
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the threaded read/modify/write pipeline.
+"""
+import threading
+
+from dcm_io_pipeline import run_io_pipeline
+
+
+def test_every_file_is_written_once():
+    filepaths = ['file_%d' % i for i in range(50)]
+    written = {}
+    callback_threads = set()
+
+    def write(filepath, dataset):
+        written[filepath] = dataset
+
+    def on_written(filepath):
+        callback_threads.add(threading.current_thread())
+    written_files, errors = run_io_pipeline(filepaths, lambda filepath: filepath.upper(),
+                                            lambda filepath, dataset: dataset + '!', write, 4, 3, 2, on_written)
+    assert errors == {}
+    assert sorted(written_files) == sorted(filepaths)
+    assert written == {filepath: filepath.upper() + '!' for filepath in filepaths}
+    assert callback_threads == {threading.current_thread()}
+
+
+def test_errors_of_each_stage_are_returned():
+    def read(filepath):
+        if filepath == 'unreadable':
+            raise IOError('unreadable')
+        return filepath
+
+    def edit(filepath, dataset):
+        if filepath == 'bad tag':
+            raise ValueError('bad tag')
+        return dataset
+
+    def write(filepath, dataset):
+        if filepath == 'full disk':
+            raise OSError('full disk')
+    written_files, errors = run_io_pipeline(['ok', 'unreadable', 'bad tag', 'full disk'], read, edit, write, 2, 2)
+    assert written_files == ['ok']
+    assert sorted(errors) == ['bad tag', 'full disk', 'unreadable']
+    assert isinstance(errors['full disk'], OSError)
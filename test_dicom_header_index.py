@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the single-pass index of the DICOM headers of a patient folder.
+"""
+import os
+
+import pydicom
+import pytest
+
+import dicom_header_index
+from conftest import write_dicom_series
+from dcm_edit_plan import TEMP_SUFFIX
+from dicom_header_index import DicomHeaderIndex, folder_role, state_filepath
+
+
+def make_patient_folder(rootdir):
+    series_folder = os.path.join(rootdir, "Study_0", "Series_7")
+    segmentation_folder = os.path.join(series_folder, "CAS-One Recordings", "2019-07-28_19-33-55", "Segmentations",
+                                       "SeriesNo_7", "SegmentationNo_0")
+    write_dicom_series(series_folder, n_slices=3, series_uid="1.2.826.0.1.7")
+    write_dicom_series(segmentation_folder, n_slices=2, series_uid="1.2.826.0.1.8")
+    with open(os.path.join(series_folder, "notes.txt"), 'w') as fp:
+        fp.write("not a DICOM file")
+    return series_folder, segmentation_folder
+
+
+def count_header_reads(monkeypatch):
+    reads = []
+
+    def read_header_record(dcm_file):
+        reads.append(dcm_file)
+        return read_header_record.original(dcm_file)
+    read_header_record.original = dicom_header_index.read_header_record
+    monkeypatch.setattr(dicom_header_index, "read_header_record", read_header_record)
+    return reads
+
+
+def test_folder_roles():
+    assert folder_role(os.path.join("P1", "Study_0", "Series_7")) == "series"
+    assert folder_role(os.path.join("P1", "Rec", "Segmentations", "SeriesNo_7", "SegmentationNo_0")) == "segmentation"
+    assert folder_role(os.path.join("P1", "Rec", "SegmentationNo_0")) == "series"
+    assert folder_role(os.path.join("P1", "Study_0")) == "other"
+
+
+def test_build_indexes_the_dicom_headers(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    series_folder, segmentation_folder = make_patient_folder(rootdir)
+    dcm_index = DicomHeaderIndex.build(rootdir, str(tmp_path / "state" / "index.json"))
+    assert [record["SeriesInstanceUID"] for record in dcm_index.files_in(series_folder)] == ["1.2.826.0.1.7"] * 3
+    assert len(dcm_index.files_in(segmentation_folder)) == 2
+    assert len(list(dcm_index.dicom_records())) == 5
+    assert not dcm_index.records[os.path.join(series_folder, "notes.txt")]["IsDicom"]
+    assert dcm_index.files_in(segmentation_folder)[0]["FolderRole"] == "segmentation"
+
+
+def test_build_reuses_the_records_of_the_unchanged_files(tmp_path, monkeypatch):
+    rootdir = str(tmp_path / "P1")
+    series_folder, segmentation_folder = make_patient_folder(rootdir)
+    index_file = str(tmp_path / "state" / "index.json")
+    DicomHeaderIndex.build(rootdir, index_file).save()
+    reads = count_header_reads(monkeypatch)
+    DicomHeaderIndex.build(rootdir, index_file)
+    assert reads == []
+    changed_file = os.path.join(series_folder, "001")
+    stat = os.stat(changed_file)
+    os.utime(changed_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    DicomHeaderIndex.build(rootdir, index_file)
+    assert reads == [changed_file]
+
+
+def test_build_skips_the_temporary_files_and_the_index(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    series_folder, segmentation_folder = make_patient_folder(rootdir)
+    with open(os.path.join(series_folder, ".001" + TEMP_SUFFIX), 'wb') as fp:
+        fp.write(b"left over by an interrupted write")
+    index_file = os.path.join(rootdir, "index.json")
+    DicomHeaderIndex.build(rootdir, index_file).save()
+    dcm_index = DicomHeaderIndex.build(rootdir, index_file)
+    assert not any(path.endswith(TEMP_SUFFIX) for path in dcm_index.records)
+    assert index_file not in dcm_index.records
+
+
+def test_update_after_a_write(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    series_folder, segmentation_folder = make_patient_folder(rootdir)
+    dcm_index = DicomHeaderIndex.build(rootdir, str(tmp_path / "state" / "index.json"))
+    dcm_file = os.path.join(segmentation_folder, "000")
+    dataset = pydicom.read_file(dcm_file)
+    dataset.SeriesInstanceUID = "1.2.826.0.1.9"
+    dataset.PatientComments = "rewritten with a new size"
+    dataset.save_as(dcm_file)
+    record = dcm_index.update(dcm_file, SeriesInstanceUID="1.2.826.0.1.9")
+    stat = os.stat(dcm_file)
+    assert (record["Size"], record["Mtime"]) == (stat.st_size, stat.st_mtime_ns)
+    assert dcm_index.files_in(segmentation_folder)[0]["SeriesInstanceUID"] == "1.2.826.0.1.9"
+    with pytest.raises(KeyError):
+        dcm_index.update(dcm_file, PatientName="M01")
+
+
+def test_index_is_saved_out_of_the_patient_folder(tmp_path):
+    rootdir = str(tmp_path / "P1")
+    make_patient_folder(rootdir)
+    state_dir = str(tmp_path / "state")
+    index_file = state_filepath(rootdir, dicom_header_index.INDEX_FILENAME, state_dir)
+    assert os.path.dirname(index_file) == state_dir
+    assert index_file != state_filepath(str(tmp_path / "other" / "P1"), dicom_header_index.INDEX_FILENAME, state_dir)
+    DicomHeaderIndex.build(rootdir, index_file).save()
+    assert os.path.isfile(index_file)
+    assert not any(dicom_header_index.INDEX_FILENAME in files for subdir, dirs, files in os.walk(rootdir))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the DICOM UID allocation.
+"""
+import re
+
+from dicom_uid import DEFAULT_PREFIX, MAX_UID_LENGTH, UIDAllocator, derive_uid
+
+UID_PATTERN = re.compile(r'^(0|[1-9][0-9]*)(\.(0|[1-9][0-9]*))*$')
+
+
+def test_derive_uid_is_deterministic():
+    original_uid = "1.2.826.0.1.3680043.8.498.1"
+    assert derive_uid(original_uid, "salt") == derive_uid(original_uid, "salt")
+    assert derive_uid(original_uid, "salt") != derive_uid(original_uid, "other salt")
+    assert derive_uid(original_uid, "salt") != derive_uid(original_uid + "2", "salt")
+
+
+def test_derive_uid_is_a_valid_uid():
+    for i in range(200):
+        uid = derive_uid("1.2.3.%d" % i, "salt")
+        assert uid.startswith(DEFAULT_PREFIX)
+        assert len(uid) <= MAX_UID_LENGTH
+        assert UID_PATTERN.match(uid), uid
+    assert derive_uid("1.2.3", "salt", prefix="1.2.840.99.").startswith("1.2.840.99.")
+
+
+def test_allocator_uids_are_unique_and_valid():
+    allocator = UIDAllocator()
+    uids = allocator.reserve(500) + [allocator.next_uid() for i in range(500)]
+    assert len(set(uids)) == len(uids)
+    for uid in uids:
+        assert len(uid) <= MAX_UID_LENGTH
+        assert UID_PATTERN.match(uid), uid
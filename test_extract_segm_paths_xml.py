@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the extraction of the segmentation records of the CAS-One XML recordings.
+"""
+import os
+
+import extract_segm_paths_xml
+from A_fix_segmentations_dcm import create_dict_paths_series_xml
+from extract_segm_paths_xml import (SegmentationPathsCollector, clear_recording_cache, prefetch_recordings,
+                                    read_recording_records, read_segmentation_records,
+                                    read_segmentation_records_untangle)
+
+SEGMENTATION = '''      <Segmentation StructureType="{structure}" TypeOfSegmentation="1"{sphere}>
+        <SeriesUID>{series_uid}</SeriesUID>
+        <Path>{path}</Path>
+      </Segmentation>
+'''
+
+
+def write_recording_xml(filename, segmentations, patient_data=True, time="2019-07-28 19:33:55"):
+    """
+    :param filename: XML filepath
+    :param segmentations: list with a list of (structure, series_uid, path, sphere radius) per trajectory
+    :param patient_data: write the PatientData element
+    :param time: time attribute of the recording
+    :return: filename
+    """
+    trajectories = ''
+    for trajectory in segmentations:
+        trajectories += '    <Trajectory>\n'
+        for structure, series_uid, path, sphere_radius in trajectory:
+            sphere = ' SphereRadius="%s"' % sphere_radius if sphere_radius is not None else ''
+            trajectories += SEGMENTATION.format(structure=structure, sphere=sphere, series_uid=series_uid, path=path)
+        trajectories += '    </Trajectory>\n'
+    with open(filename, 'w') as fp:
+        fp.write('<Eagles time="%s">\n' % time)
+        if patient_data:
+            fp.write('  <PatientData seriesID="1.2.3" seriesNumber="7" patientID="P1" />\n')
+        fp.write('  <Trajectories>\n%s  </Trajectories>\n</Eagles>\n' % trajectories)
+    return filename
+
+
+def test_elementtree_records_match_untangle(tmp_path):
+    xml_files = [
+        write_recording_xml(str(tmp_path / "Plan_1.xml"),
+                            [[("Lession", "1.2.3.4", "/Segmentations/SeriesNo_7/SegmentationNo_0", None)],
+                             [],
+                             [("Ablation", "1.2.3.5", "/Segmentations/SeriesNo_7/SegmentationNo_1", "12.5")]]),
+        # two segmentations in a trajectory: the trajectory cannot be read
+        write_recording_xml(str(tmp_path / "Plan_2.xml"),
+                            [[("Lession", "1.2.3.6", "/A", None), ("Lession", "1.2.3.7", "/B", None)],
+                             [("Lession", "1.2.3.8", "/C", None)]]),
+        write_recording_xml(str(tmp_path / "AblationValidation_1.xml"), [[("Lession", "", "/D", None)]],
+                            patient_data=False),
+    ]
+    no_trajectories = str(tmp_path / "Plan_3.xml")
+    with open(no_trajectories, 'w') as fp:
+        fp.write('<Eagles time="2019-07-28 19:33:55"><PatientData seriesID="1.2.3" /></Eagles>')
+    not_xml = str(tmp_path / "Plan_4.xml")
+    with open(not_xml, 'wb') as fp:
+        fp.write(os.urandom(64))
+    for xml_file in xml_files + [no_trajectories, not_xml]:
+        assert read_segmentation_records(xml_file) == read_segmentation_records_untangle(xml_file), xml_file
+    records = read_segmentation_records(xml_files[0])
+    assert [(record["NeedleIdx"], record["SegmentationSeriesUID_xml"], record["SphereRadius"])
+            for record in records] == [(0, "1.2.3.4", None), (2, "1.2.3.5", "12.5")]
+    assert read_segmentation_records(xml_files[1])[0] is None
+    assert read_segmentation_records(no_trajectories) is None
+
+
+def list_scan_dedup(records):
+    # the linear scans SegmentationPathsCollector replaces
+    collected = []
+    for record in records:
+        path_series_found = next((item for item in collected if item["PathSeries"] == record["PathSeries"]), None)
+        sphere_radius_found = next((item for item in collected if item["SphereRadius"] == record["SphereRadius"]),
+                                   None)
+        if path_series_found is None or sphere_radius_found is None:
+            collected.append(record)
+    return collected
+
+
+def test_collector_skips_the_same_duplicates_as_the_list_scan():
+    records = [{"PathSeries": path, "SphereRadius": radius}
+               for path, radius in [("/A", None), ("/A", None), ("/B", None), ("/A", "10"), ("/A", "10"),
+                                    ("/C", "10"), ("/B", "12"), ("/C", None), ("/B", "12")]]
+    collector = SegmentationPathsCollector()
+    added = [collector.add(record) for record in records]
+    assert collector.records == list_scan_dedup(records)
+    assert added == [True, False, True, True, False, True, True, False, False]
+
+
+def test_collector_extends_the_given_list():
+    records = [{"PathSeries": "/A", "SphereRadius": None}]
+    collector = SegmentationPathsCollector(records)
+    assert not collector.add({"PathSeries": "/A", "SphereRadius": None})
+    collector.append(None)
+    assert collector.add({"PathSeries": "/B", "SphereRadius": None})
+    assert records is collector.records and len(records) == 3
+
+
+def write_patient_folder(rootdir, n_recordings=2):
+    """
+    :return: list of the recording folders, each with a Plan XML and a Segmentations/SeriesNo_7 folder
+    """
+    recordings = []
+    for idx in range(n_recordings):
+        recording = os.path.join(rootdir, "Study_0", "Series_7", "CAS-One Recordings", "2019-07-28_19-3%d-55" % idx)
+        os.makedirs(os.path.join(recording, "Segmentations", "SeriesNo_7"))
+        write_recording_xml(os.path.join(recording, "Plan_1.xml"),
+                            [[("Lession", "1.2.3.%d" % idx, "/Segmentations/SeriesNo_7/SegmentationNo_%d" % idx,
+                               None)]])
+        recordings.append(os.path.normpath(recording))
+    return recordings
+
+
+def test_memo_is_reused_by_the_next_patient_folders(tmp_path, monkeypatch):
+    clear_recording_cache()
+    first_patient = write_patient_folder(str(tmp_path / "P1"))
+    second_patient = write_patient_folder(str(tmp_path / "P2"))
+    df_first = create_dict_paths_series_xml(str(tmp_path / "P1"))
+    create_dict_paths_series_xml(str(tmp_path / "P2"))
+    assert set(first_patient + second_patient) <= set(extract_segm_paths_xml._recording_cache)
+    # the same patient folder again in the batch: merged from the memo, nothing parsed
+    parsed = []
+    read_xml_files_records = extract_segm_paths_xml.read_xml_files_records
+
+    def counting_read(xml_files, *args, **kwargs):
+        parsed.extend(xml_files)
+        return read_xml_files_records(xml_files, *args, **kwargs)
+    monkeypatch.setattr(extract_segm_paths_xml, "read_xml_files_records", counting_read)
+    assert create_dict_paths_series_xml(str(tmp_path / "P1")).equals(df_first)
+    assert parsed == []
+    clear_recording_cache()
+
+
+def test_memo_is_bounded(tmp_path, monkeypatch):
+    clear_recording_cache()
+    monkeypatch.setattr(extract_segm_paths_xml, "RECORDING_CACHE_SIZE", 3)
+    recordings = write_patient_folder(str(tmp_path / "P1"), n_recordings=5)
+    for recording in recordings:
+        read_recording_records(recording)
+    read_recording_records(recordings[2])
+    assert list(extract_segm_paths_xml._recording_cache) == [recordings[3], recordings[4], recordings[2]]
+    clear_recording_cache()
+
+
+def test_memo_is_invalidated_by_a_changed_xml(tmp_path):
+    clear_recording_cache()
+    recording = write_patient_folder(str(tmp_path / "P1"), n_recordings=1)[0]
+    records = read_recording_records(recording)
+    assert read_recording_records(recording) is records
+    write_recording_xml(os.path.join(recording, "Plan_1.xml"), [[("Lession", "1.2.3.99", "/X", None)]])
+    stat = os.stat(os.path.join(recording, "Plan_1.xml"))
+    os.utime(os.path.join(recording, "Plan_1.xml"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert read_recording_records(recording)[0]["SegmentationSeriesUID_xml"] == "1.2.3.99"
+    clear_recording_cache()
+
+
+def test_parallel_prefetch_merges_in_the_serial_order(tmp_path):
+    recordings = write_patient_folder(str(tmp_path / "P1"), n_recordings=4)
+    for idx, recording in enumerate(recordings):
+        # several files per folder, merged in filename order
+        write_recording_xml(os.path.join(recording, "AblationValidation_1.xml"),
+                            [[("Ablation", "1.2.4.%d" % idx, "/Segmentations/SeriesNo_7/SegmentationNo_9",
+                               "1%d" % idx)]])
+    clear_recording_cache()
+    assert prefetch_recordings(recordings, workers=1) == 4
+    serial = [extract_segm_paths_xml._recording_cache[recording][1] for recording in recordings]
+    assert prefetch_recordings(recordings, workers=1) == 0  # all memoized
+    clear_recording_cache()
+    assert prefetch_recordings(list(reversed(recordings)) + recordings, workers=3) == 4
+    parallel = [extract_segm_paths_xml._recording_cache[recording][1] for recording in recordings]
+    assert parallel == serial
+    assert [record["SegmentLabel"] for record in serial[0]] == ["Ablation", "Lession"]
+    clear_recording_cache()
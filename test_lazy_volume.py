@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the lazy volume of the viewers: the window of decoded slices, the prefetch in the scrolling direction and
+close().
+"""
+import time
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from conftest import write_dicom_series
+from DicomReader import read_dcm_series, read_dcm_volume
+from lazy_volume import LazyVolume
+from ResampleSegmentations import ResizeSegmentation
+
+
+def wait_for_slices(lazy_volume, zs, timeout=5):
+    # the prefetch thread decodes in the background
+    deadline = time.time() + timeout
+    while not set(zs) <= set(lazy_volume._slices):
+        if time.time() > deadline:
+            raise AssertionError('slices %s not prefetched, decoded: %s' % (zs, list(lazy_volume._slices)))
+        time.sleep(0.01)
+
+
+def test_slices_match_the_volume(dicom_series):
+    folder = dicom_series(n_slices=5)
+    volume, geometry = read_dcm_volume(folder)
+    with LazyVolume(folder, prefetch=0) as lazy_volume:
+        assert lazy_volume.shape == volume.shape and len(lazy_volume) == 5
+        np.testing.assert_array_equal(lazy_volume[2], volume[2])
+        np.testing.assert_array_equal(lazy_volume[-1, 1:3], volume[-1, 1:3])
+        np.testing.assert_array_equal(lazy_volume[1:4, :, 0], volume[1:4, :, 0])
+        np.testing.assert_array_equal(np.asarray(lazy_volume), volume)
+        with pytest.raises(IndexError):
+            lazy_volume[5]
+        with pytest.raises(ValueError):
+            lazy_volume[2][0, 0] = 1
+
+
+def test_window_keeps_the_recently_used_slices(dicom_series):
+    folder = dicom_series(n_slices=6)
+    with LazyVolume(folder, window=3, prefetch=0) as lazy_volume:
+        for z in [0, 1, 2, 0, 3]:
+            lazy_volume[z]
+        assert (lazy_volume.hits, lazy_volume.misses) == (1, 4)
+        assert list(lazy_volume._slices) == [2, 0, 3]
+        lazy_volume[1]
+        assert lazy_volume.misses == 5
+
+
+def test_prefetch_follows_the_scrolling_direction(dicom_series):
+    folder = dicom_series(n_slices=10)
+    with LazyVolume(folder, window=10, prefetch=2) as lazy_volume:
+        lazy_volume[4]
+        wait_for_slices(lazy_volume, [5, 6])
+        lazy_volume[5]
+        assert lazy_volume.hits == 1
+        wait_for_slices(lazy_volume, [6, 7])
+        assert not {2, 3} & set(lazy_volume._slices)
+        # scrolling back
+        lazy_volume[3]
+        wait_for_slices(lazy_volume, [2, 1])
+        assert 8 not in lazy_volume._slices
+
+
+def test_close_stops_the_prefetch_and_drops_the_slices(dicom_series):
+    folder = dicom_series(n_slices=6)
+    lazy_volume = LazyVolume(folder, prefetch=2)
+    thread = lazy_volume._thread
+    lazy_volume[0]
+    lazy_volume.close()
+    assert not thread.is_alive() and lazy_volume._thread is None
+    assert len(lazy_volume._slices) == 0
+    # still readable, without prefetch
+    lazy_volume[3]
+    assert list(lazy_volume._slices) == [3]
+    lazy_volume.close()
+
+
+def test_geometry_is_the_resampling_reference_of_the_masks(tmp_path):
+    reference = str(tmp_path / "ct")
+    segmentation = str(tmp_path / "mask")
+    write_dicom_series(reference, n_slices=6, rows=10, columns=8)
+    write_dicom_series(segmentation, n_slices=3, rows=5, columns=4, dtype=np.uint8)
+    mask = read_dcm_series(segmentation, False)
+    expected = ResizeSegmentation(read_dcm_series(reference, False), mask).resample_segmentation()
+    with LazyVolume(reference, prefetch=0) as lazy_volume:
+        resampled = ResizeSegmentation(lazy_volume.geometry, mask).resample_segmentation()
+    assert resampled.GetSize() == expected.GetSize()
+    assert np.allclose(resampled.GetOrigin(), expected.GetOrigin())
+    assert np.allclose(resampled.GetSpacing(), expected.GetSpacing())
+    assert np.array_equal(sitk.GetArrayViewFromImage(resampled), sitk.GetArrayViewFromImage(expected))
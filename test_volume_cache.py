@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the on-disk cache of the decoded DICOM series.
+"""
+import os
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from conftest import write_dicom_series
+from DicomReader import read_dcm_series, read_dcm_series_array
+from ResampleSegmentations import ResizeSegmentation
+from volume_cache import CachedSeriesReader, VolumeDiskCache, entry_key
+
+
+def touch(filepath, seconds=1):
+    stat = os.stat(filepath)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10 ** 9))
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.uint8])
+def test_disk_cache_hit_returns_the_image_of_a_miss(tmp_path, dicom_series, dtype):
+    folder = dicom_series(dtype=dtype)
+    cache_dir = str(tmp_path / "cache")
+    image, reader = read_dcm_series(folder, True)
+    for i in range(2):
+        cached_image, cached_reader = read_dcm_series(folder, True, cache_dir=cache_dir)
+        assert cached_image.GetPixelID() == image.GetPixelID()
+        assert np.array_equal(sitk.GetArrayViewFromImage(cached_image), sitk.GetArrayViewFromImage(image))
+        assert np.allclose(cached_image.GetOrigin(), image.GetOrigin())
+        assert np.allclose(cached_image.GetSpacing(), image.GetSpacing())
+        assert np.allclose(cached_image.GetDirection(), image.GetDirection())
+        assert list(cached_reader.GetFileNames()) == list(reader.GetFileNames())
+        assert cached_reader.GetMetaData(0, "0020|000e") == reader.GetMetaData(0, "0020|000e")
+    assert isinstance(cached_reader, CachedSeriesReader)
+
+
+def test_disk_cache_keeps_the_series_of_a_folder_apart(tmp_path):
+    folder = str(tmp_path / "mixed")
+    write_dicom_series(folder, n_slices=3, rows=8, series_uid="1.2.826.0.1.1")
+    for filepath in write_dicom_series(str(tmp_path / "other"), n_slices=2, rows=5, series_uid="1.2.826.0.1.2"):
+        os.replace(filepath, os.path.join(folder, "other_" + os.path.basename(filepath)))
+    cache = VolumeDiskCache(str(tmp_path / "cache"))
+    for i in range(2):
+        first, geometry = cache.load_series(folder, "1.2.826.0.1.1")
+        second, other_geometry = cache.load_series(folder, "1.2.826.0.1.2")
+        assert first.shape == (3, 8, 6) and second.shape == (2, 5, 6)
+    assert cache.hits == 2
+    assert cache.invalidate("1.2.826.0.1.2") == 1
+    assert cache.load_series(folder, "1.2.826.0.1.1")[0] is not None and cache.hits == 3
+
+
+def test_disk_cache_entry_is_invalidated_by_a_changed_file(tmp_path, dicom_series):
+    folder = dicom_series()
+    cache = VolumeDiskCache(str(tmp_path / "cache"))
+    cache.load_series(folder)
+    cache.load_series(folder)
+    assert (cache.hits, cache.misses) == (1, 1)
+    touch(os.path.join(folder, "001"))
+    cache.load_series(folder)
+    assert (cache.hits, cache.misses) == (1, 2)
+    os.remove(os.path.join(folder, "003"))
+    volume, geometry = cache.load_series(folder)
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert volume.shape[0] == 3
+
+
+def test_disk_cache_key_is_the_real_path(tmp_path, dicom_series, monkeypatch):
+    folder = dicom_series()
+    os.symlink(folder, str(tmp_path / "link"))
+    monkeypatch.chdir(str(tmp_path))
+    assert entry_key("series") == entry_key(str(tmp_path / "link")) == entry_key(folder)
+    cache = VolumeDiskCache(str(tmp_path / "cache"))
+    cache.load_series(folder)
+    cache.load_series(os.path.join("link", ""))
+    cache.load_series([os.path.join("series", f) for f in os.listdir(folder)])
+    cache.load_series([os.path.join(str(tmp_path / "link"), f) for f in os.listdir(folder)])
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_warm_array_read_is_the_memory_mapped_volume(tmp_path, dicom_series):
+    folder = dicom_series(dtype=np.uint8)
+    cache_dir = str(tmp_path / "cache")
+    volume, geometry = read_dcm_series_array(folder)
+    cold_volume, cold_geometry = read_dcm_series_array(folder, cache_dir)
+    warm_volume, warm_geometry = read_dcm_series_array(folder, cache_dir)
+    assert isinstance(warm_volume, np.memmap) and not warm_volume.flags.writeable
+    assert warm_volume.dtype == volume.dtype == np.uint8
+    assert np.array_equal(warm_volume, volume) and np.array_equal(cold_volume, volume)
+    for name in ["Origin", "Spacing", "Direction", "Size"]:
+        assert np.allclose(warm_geometry[name], geometry[name])
+
+
+def test_segmentation_is_resampled_onto_the_cached_geometry(tmp_path):
+    reference = str(tmp_path / "ct")
+    segmentation = str(tmp_path / "mask")
+    write_dicom_series(reference, n_slices=6, rows=10, columns=8)
+    write_dicom_series(segmentation, n_slices=3, rows=5, columns=4, dtype=np.uint8)
+    expected = ResizeSegmentation(read_dcm_series(reference, False),
+                                  read_dcm_series(segmentation, False)).resample_segmentation()
+    cache_dir = str(tmp_path / "cache")
+    for i in range(2):
+        resizer = ResizeSegmentation.from_series(reference, segmentation, cache_dir)
+        assert isinstance(resizer.ablation_segmentation, dict)
+        resampled = resizer.resample_segmentation()
+        assert resampled.GetSize() == expected.GetSize() == (8, 10, 6)
+        assert np.allclose(resampled.GetOrigin(), expected.GetOrigin())
+        assert np.array_equal(sitk.GetArrayViewFromImage(resampled), sitk.GetArrayViewFromImage(expected))
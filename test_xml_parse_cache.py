@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the invalidation and the eviction of the SQLite cache of the XML recordings.
+"""
+import os
+import shutil
+import sqlite3
+
+import pandas as pd
+
+import xml_parse_cache
+from anonymization_xml_logs import XML_METADATA_KIND, encode_xml_streaming
+from batch_manifest import file_sha1
+from xml_parse_cache import XmlParseCache
+
+
+def test_entry_is_invalidated_by_a_content_change(tmp_path, plan_xml):
+    filename = plan_xml()
+    cache = XmlParseCache(str(tmp_path / "cache.sqlite"))
+    cache.put(filename, "records", [1, 2])
+    assert cache.get(filename, "records") == [1, 2]
+    assert cache.get(filename, "metadata") is None
+    with open(filename, 'a') as fp:
+        fp.write('\n')
+    assert cache.get(filename, "records") is None
+    cache.close()
+
+
+def touch(filename):
+    shutil.copyfile(filename, filename + ".copy")
+    os.replace(filename + ".copy", filename)
+    stat = os.stat(filename)
+    os.utime(filename, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_entry_survives_a_copy_with_a_new_mtime(tmp_path, plan_xml):
+    filename = plan_xml()
+    cache = XmlParseCache(str(tmp_path / "cache.sqlite"))
+    cache.put(filename, "records", [1, 2], sha1=file_sha1(filename))
+    touch(filename)
+    assert cache.get(filename, "records") == [1, 2]
+    cache.close()
+
+
+def test_put_does_not_hash_the_file(tmp_path, plan_xml, monkeypatch):
+    filename = plan_xml()
+    cache = XmlParseCache(str(tmp_path / "cache.sqlite"))
+    monkeypatch.setattr(xml_parse_cache, "file_sha1", None)
+    cache.put(filename, "records", [1, 2])
+    assert cache.get(filename, "records") == [1, 2]
+    # without a content hash an mtime-only change is a miss
+    touch(filename)
+    assert cache.get(filename, "records") is None
+    cache.close()
+
+
+def test_streaming_encoder_caches_the_hash_of_the_written_file(tmp_path, plan_xml):
+    filename = plan_xml()
+    cache = XmlParseCache(str(tmp_path / "cache.sqlite"))
+    df_ct_mapping = pd.DataFrame({"PathSeries": [], "SeriesInstanceNumberUID": []})
+    assert encode_xml_streaming(filename, "M01", "MAVM01", "19380517", df_ct_mapping, parse_cache=cache) is True
+    cache.commit()
+    sha1 = cache.connection.execute("SELECT sha1 FROM entries WHERE kind=?", (XML_METADATA_KIND,)).fetchone()[0]
+    assert sha1 == file_sha1(filename)
+    cache.close()
+
+
+def test_changes_are_written_in_batches(tmp_path, plan_xml, monkeypatch):
+    monkeypatch.setattr(xml_parse_cache, "COMMIT_EVERY_N_CHANGES", 3)
+    filenames = [plan_xml("Plan_%d.xml" % i) for i in range(4)]
+    db_file = str(tmp_path / "cache.sqlite")
+    cache = XmlParseCache(db_file)
+    reader = sqlite3.connect(db_file)
+    count = lambda: reader.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+    cache.put(filenames[0], "records", [0])
+    cache.put(filenames[1], "records", [1])
+    assert count() == 0
+    assert cache.get(filenames[0], "records") == [0]  # pending entries are read from memory
+    cache.put(filenames[2], "records", [2])
+    assert count() == 3
+    cache.put(filenames[3], "records", [3])
+    cache.close()
+    assert count() == 4
+    reader.close()
+
+
+def test_running_total_matches_the_database(tmp_path, plan_xml):
+    filenames = [plan_xml("Plan_%d.xml" % i) for i in range(3)]
+    db_file = str(tmp_path / "cache.sqlite")
+    cache = XmlParseCache(db_file, max_bytes=100)
+    for filename in filenames:
+        cache.put(filename, "records", "x" * 20)
+    cache.put(filenames[0], "records", "x" * 30)
+    cache.put(filenames[1], "metadata", "x" * 40)
+    cache.invalidate(filenames[2])
+    cache.commit()
+    assert cache.total_bytes == cache._stored_bytes() <= 100
+    cache.close()
+    assert XmlParseCache(db_file).total_bytes == cache.total_bytes
+
+
+def test_invalidate_a_folder_and_a_kind(tmp_path, plan_xml):
+    first, second = plan_xml("Plan_1.xml"), plan_xml("Plan_2.xml")
+    cache = XmlParseCache(str(tmp_path / "cache.sqlite"))
+    for filename in [first, second]:
+        cache.put(filename, "records", [filename])
+        cache.put(filename, "metadata", {})
+    assert cache.invalidate(first, "records") == 1
+    assert cache.get(first, "records") is None
+    assert cache.get(first, "metadata") == {}
+    assert cache.invalidate(str(tmp_path)) == 3
+    assert cache.get(second, "metadata") is None
+    cache.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, plan_xml):
+    filenames = [plan_xml("Plan_%d.xml" % i) for i in range(3)]
+    cache = XmlParseCache(str(tmp_path / "cache.sqlite"), max_bytes=50)
+    cache.put(filenames[0], "records", "x" * 20)
+    cache.put(filenames[1], "records", "y" * 20)
+    assert cache.get(filenames[0], "records") == "x" * 20
+    cache.commit()
+    cache.put(filenames[2], "records", "z" * 20)
+    assert cache.get(filenames[1], "records") is None
+    assert cache.get(filenames[0], "records") == "x" * 20
+    assert cache.get(filenames[2], "records") == "z" * 20
+    cache.close()
@@ -1,15 +1,29 @@
 # -*- coding: utf-8 -*-
 
+import argparse
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
 import DicomReader as Reader
 import ResampleSegmentations
 import SimpleITK as sitk
+from lazy_volume import LazyVolume
 
 #%%
 
 
+def display_array(img):
+    """
+    :param img: SimpleITK Image, LazyVolume or NumPy array (eg. a memory-mapped cached volume)
+    :return: the intensities rescaled to uint16 as a NumPy array, the LazyVolume and the NumPy array unchanged (read
+    slice by slice)
+    """
+    if isinstance(img, (LazyVolume, np.ndarray)):
+        # the display window is set from the first slice shown, a linear rescale would not change it
+        return img
+    return sitk.GetArrayFromImage(sitk.Cast(sitk.RescaleIntensity(img), sitk.sitkUInt16))
+
+
 class Animation(object):
 
     def __init__(self, ablation_img_sitk, tumor_img_sitk, source_img_sitk):
@@ -17,13 +31,18 @@ class Animation(object):
         self.tumor_img_sitk = tumor_img_sitk
         self.source_img_sitk = source_img_sitk
 
-        source_img_sitk_cast = sitk.Cast(sitk.RescaleIntensity(self.source_img_sitk), sitk.sitkUInt16)
-        tumor_img_sitk_cast = sitk.Cast(sitk.RescaleIntensity(self.tumor_img_sitk), sitk.sitkUInt16)
-        ablation_img_sitk_cast = sitk.Cast(sitk.RescaleIntensity(self.ablation_img_sitk), sitk.sitkUInt16)
+        self.ablation_mask_nda = display_array(self.ablation_img_sitk)
+        self.source_img_nda = display_array(self.source_img_sitk)
+        self.tumor_mask_nda = display_array(self.tumor_img_sitk)
 
-        self.ablation_mask_nda = sitk.GetArrayFromImage(ablation_img_sitk_cast)
-        self.source_img_nda = sitk.GetArrayFromImage(source_img_sitk_cast)
-        self.tumor_mask_nda = sitk.GetArrayFromImage(tumor_img_sitk_cast)
+    def close(self):
+        """
+        Stop the prefetch threads of the LazyVolume images, once the animation is closed.
+        :return:
+        """
+        for img in [self.ablation_mask_nda, self.source_img_nda, self.tumor_mask_nda]:
+            if isinstance(img, LazyVolume):
+                img.close()
 
     def get_tumor_img(self):
         return self.tumor_mask_nda
@@ -68,20 +87,35 @@ if __name__ == '__main__':
     ablation = r"C:\tmp_patients\Pat_MAV_BE_B02_\Study_0\Series_7\CAS-One Recordings\2019-07-28_19-33-55\Segmentations\SeriesNo_28\SegmentationNo_0"
     tumor = r"C:\tmp_patients\Pat_MAV_BE_B02_\Study_0\Series_7\CAS-One Recordings\2019-07-28_19-33-55\Segmentations\SeriesNo_7\SegmentationNo_0"
     source_img = r"C:\tmp_patients\Pat_MAV_BE_B02_\Study_0\Series_7"
-
-    ablation_img_sitk = Reader.read_dcm_series(ablation, False)
-    tumor_img_sitk = Reader.read_dcm_series(tumor, False)
-    source_img_sitk = Reader.read_dcm_series(source_img, False)
-    resizer_tumor = ResampleSegmentations.ResizeSegmentation(source_img_sitk, tumor_img_sitk)
-    resizer_ablation = ResampleSegmentations.ResizeSegmentation(source_img_sitk, ablation_img_sitk)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-a", "--ablation", required=False, default=ablation, help="folder of the ablation segmentation")
+    ap.add_argument("-t", "--tumor", required=False, default=tumor, help="folder of the tumor segmentation")
+    ap.add_argument("-s", "--source_img", required=False, default=source_img, help="folder of the source CT series")
+    ap.add_argument("-c", "--cache_dir", required=False, default=None, help="folder of the decoded volumes cache")
+    args = vars(ap.parse_args())
+    ablation, tumor, source_img = args["ablation"], args["tumor"], args["source_img"]
+
+    ablation_img_sitk = Reader.read_dcm_series(ablation, False, args["cache_dir"])
+    tumor_img_sitk = Reader.read_dcm_series(tumor, False, args["cache_dir"])
+    # the CT is not decoded at once, its slices are read as they are displayed and its geometry is the resampling
+    # reference of the masks
+    if args["cache_dir"] is not None:
+        # memory-mapped cached volume
+        source_img_nda, source_geometry = Reader.read_dcm_series_array(source_img, args["cache_dir"])
+    else:
+        source_img_nda = LazyVolume(source_img)
+        source_geometry = source_img_nda.geometry
+    resizer_tumor = ResampleSegmentations.ResizeSegmentation(source_geometry, tumor_img_sitk)
+    resizer_ablation = ResampleSegmentations.ResizeSegmentation(source_geometry, ablation_img_sitk)
     tumor_img_resampled = resizer_tumor.resample_segmentation()
     ablation_img_resampled = resizer_ablation.resample_segmentation()
 
-    animation_obj = Animation(ablation_img_resampled, tumor_img_resampled, source_img_sitk)
+    animation_obj = Animation(ablation_img_resampled, tumor_img_resampled, source_img_nda)
     fig = animation_obj.animate_dicom()
     img = animation_obj.get_src_img()
     slices, x, y = img.shape
     frames = slices - 1
     ani = animation.FuncAnimation(fig, animation_obj.update_fig,  frames=frames, interval=1, repeat_delay=10)
     plt.show()
+    animation_obj.close()
 
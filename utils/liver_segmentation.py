@@ -24,10 +24,11 @@ ap = argparse.ArgumentParser()
 ap.add_argument("-m", "--filepath_segm_mask", required=True, help="filepath folder tumor segmentation mask")
 ap.add_argument("-s", "--filepath_source_img", required=True, help="filepath folder ablation segmentation mask")
 ap.add_argument("-o", "--output_filepath", required=True, help="filepath output folder")
+ap.add_argument("-c", "--cache_dir", required=False, default=None, help="folder of the decoded volumes cache")
 
 args = vars(ap.parse_args())
-mask = DicomReader.read_dcm_series(args["filepath_segm_mask"], False)
-img = DicomReader.read_dcm_series(args["filepath_source_img"], False)
+mask = DicomReader.read_dcm_series(args["filepath_segm_mask"], False, args["cache_dir"])
+img = DicomReader.read_dcm_series(args["filepath_source_img"], False, args["cache_dir"])
 
 print('img size:', img.GetSize())
 print('mask size:', mask.GetSize())
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the bulk parsing of the transform tags of the CAS-One recordings and of the stacked matrix helpers, against
+the per-tag np.genfromtxt parsing and the single matrix helpers they replace.
+"""
+import io
+
+import numpy as np
+import pytest
+
+pytest.importorskip("dicom")  # legacy pydicom (< 1.0) imported by utilDICOMtags
+
+from utilDICOMtags import (mat_get_rotation, mat_get_rotation_vec1, mat_get_rotation_vec2,  # noqa: E402
+                           mat_get_translation_mat, mat_get_translation_vec, read_recording_transforms, txt_to_mat,
+                           txt_to_mats)
+
+TRANSFORMS = ["1 0 0 10.5\n0 1 0 -20\n0 0 1 30",
+              "0.5 -0.866 0 1e-3\n0.866 0.5 0 2\n0 0 1 -3.25",
+              "  0 0 1 0\n 0 1 0 0\n -1 0 0 100\n"]
+
+
+class Element(object):
+    # untangle element
+    def __init__(self, cdata):
+        self.cdata = cdata
+
+
+def genfromtxt_to_mat(xml_tag):
+    # the per-tag parsing replaced by txt_to_mats
+    mat_34 = np.genfromtxt(io.BytesIO(xml_tag.cdata.encode()))
+    return np.matrix(np.concatenate([mat_34, np.array([[0, 0, 0, 1]])]))
+
+
+def single_rotation_vec(transform_mat, columns):
+    rotation_mat = np.asarray(transform_mat)[0:3, 0:3]
+    return (rotation_mat.T if columns else rotation_mat).flatten()
+
+
+def test_txt_to_mats_matches_genfromtxt():
+    elements = [Element(text) for text in TRANSFORMS]
+    mats = txt_to_mats(elements)
+    assert mats.shape == (3, 4, 4) and mats.dtype == np.float64
+    for element, mat in zip(elements, mats):
+        np.testing.assert_array_equal(mat, genfromtxt_to_mat(element))
+        np.testing.assert_array_equal(txt_to_mat(element), genfromtxt_to_mat(element))
+    np.testing.assert_array_equal(txt_to_mats(TRANSFORMS), mats)
+    assert txt_to_mats([]).shape == (0, 4, 4)
+
+
+def test_txt_to_mats_rejects_a_tag_without_12_numbers():
+    with pytest.raises(ValueError):
+        txt_to_mats([TRANSFORMS[0], "1 0 0 1"])
+    with pytest.raises(ValueError):
+        txt_to_mats([TRANSFORMS[0], "a b c d e f g h i j k l"])
+
+
+def test_stacked_helpers_match_the_single_matrix_helpers():
+    mats = txt_to_mats(TRANSFORMS)
+    rotations, translation_mats = mat_get_rotation(mats), mat_get_translation_mat(mats)
+    rotation_vecs1, rotation_vecs2 = mat_get_rotation_vec1(mats), mat_get_rotation_vec2(mats)
+    translation_vecs = mat_get_translation_vec(mats)
+    assert rotation_vecs1.shape == rotation_vecs2.shape == (3, 9) and translation_vecs.shape == (3, 3)
+    for idx, mat in enumerate(mats):
+        np.testing.assert_array_equal(rotations[idx], mat_get_rotation(np.matrix(mat)))
+        np.testing.assert_array_equal(rotations[idx][0:3, 3], 0)
+        np.testing.assert_array_equal(translation_mats[idx], mat_get_translation_mat(mat))
+        np.testing.assert_array_equal(rotation_vecs1[idx], single_rotation_vec(mat, columns=False))
+        np.testing.assert_array_equal(rotation_vecs2[idx], single_rotation_vec(mat, columns=True))
+        np.testing.assert_array_equal(translation_vecs[idx], mat[0:3, 3])
+
+
+def test_read_recording_transforms_auto_detects_the_12_number_tags(tmp_path):
+    xml_file = str(tmp_path / "Recording.xml")
+    with open(xml_file, 'w') as fp:
+        fp.write('<Eagles><Navigation>'
+                 '<CalibrationMatrix>%s</CalibrationMatrix>'
+                 '<Position>1 2 3</Position>'
+                 '<Spacing>1 1 1 1 1 1 1 1 1 1 1 1 1</Spacing>'
+                 '<Comment>a b c d e f g h i j k l</Comment>'
+                 '<RegistrationMatrix>%s</RegistrationMatrix>'
+                 '<Transforms><Matrix>%s</Matrix></Transforms>'
+                 '</Navigation></Eagles>' % tuple(TRANSFORMS))
+    names, mats = read_recording_transforms(xml_file)
+    assert names == ["CalibrationMatrix", "RegistrationMatrix", "Matrix"]
+    np.testing.assert_array_equal(mats, txt_to_mats(TRANSFORMS))
+    names, mats = read_recording_transforms(xml_file, tag_names=["RegistrationMatrix"])
+    assert names == ["RegistrationMatrix"] and mats.shape == (1, 4, 4)
+    # a named tag without 12 numbers is an error, the auto-detection skips it
+    with pytest.raises(ValueError):
+        read_recording_transforms(xml_file, tag_names=["Position"])
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the vectorized reading of the CAS-One MWA database XML and of its npz cache.
+"""
+import os
+
+import numpy as np
+
+import util_xml_mwa_extract
+from util_xml_mwa_extract import load_mwa_database, mwa_dataframe, parse_vectors
+
+MWA_DATABASE = '''<Eagles>
+  <Database>
+    <MWA id="4" name="Covidien">
+      <AblationParameters>
+        <Geometry>
+          <Shape type="Ellipsoid" power="100" time="300" radii="15 15 20" translation="0,0,-5" rotation="0 0 0"/>
+          <Shape type="Sphere" power="100" time="600" radii="20" translation="0 0 -5" rotation=""/>
+        </Geometry>
+      </AblationParameters>
+      <AblationParameters>
+        <Geometry><Shape type="Ellipsoid" power="50" time="60" radii="1 1 1"/></Geometry>
+      </AblationParameters>
+    </MWA>
+    <MWA id="7" name="Emprint">
+      <AblationParameters>
+        <Geometry>
+          <Shape type="Ellipsoid" power="n/a" radii="10 12 14" translation="1 2 3" rotation="0 90 0"/>
+        </Geometry>
+      </AblationParameters>
+    </MWA>
+    <MWA id="10" name="Acculis"/>
+  </Database>
+</Eagles>
+'''
+
+
+def write_database(folder, content=MWA_DATABASE):
+    xml_file = os.path.join(folder, "MWA_Database.xml")
+    with open(xml_file, 'w') as fp:
+        fp.write(content)
+    return xml_file
+
+
+def test_parse_vectors_pads_the_short_vectors_with_nan():
+    vectors = parse_vectors(["15 15 20", "20", "", None, "1,2, 3"])
+    assert vectors.shape == (5, 3)
+    np.testing.assert_array_equal(vectors[0], [15, 15, 20])
+    np.testing.assert_array_equal(vectors[1], [20, np.nan, np.nan])
+    assert np.isnan(vectors[2:4]).all()
+    np.testing.assert_array_equal(vectors[4], [1, 2, 3])
+    assert parse_vectors([]).shape == (0, 0)
+
+
+def test_all_the_needles_are_read(tmp_path):
+    columns = load_mwa_database(write_database(str(tmp_path)), use_cache=False)
+    # only the first ablation parameters set of a needle, the needles without shapes have no row
+    assert list(columns["NeedleID"]) == ["4", "4", "7"]
+    assert list(columns["NeedleType"]) == ["Covidien (Covidien MWA)", "Covidien (Covidien MWA)", "Emprint"]
+    assert list(columns["Shape"]) == [0, 1, 0]
+    np.testing.assert_array_equal(columns["Power"], [100, 100, np.nan])
+    np.testing.assert_array_equal(columns["Time_Duration_Applied"], [300, 600, np.nan])
+    np.testing.assert_array_equal(columns["Translation"], [[0, 0, -5], [0, 0, -5], [1, 2, 3]])
+    df_mwa = mwa_dataframe(columns)
+    assert list(df_mwa["Radii"]) == ["15 15 20", "20", "10 12 14"]
+    assert list(df_mwa["Rotation"]) == ["0 0 0", "", "0 90 0"]
+
+
+def test_cache_is_rebuilt_when_the_xml_changes(tmp_path, monkeypatch):
+    xml_file = write_database(str(tmp_path))
+    columns = load_mwa_database(xml_file)
+    assert os.path.isfile(os.path.join(str(tmp_path), "MWA_Database.npz"))
+    parsed = []
+
+    def counting_parse(xml_file):
+        parsed.append(xml_file)
+        return parse_mwa_database(xml_file)
+    parse_mwa_database = util_xml_mwa_extract.parse_mwa_database
+    monkeypatch.setattr(util_xml_mwa_extract, "parse_mwa_database", counting_parse)
+    cached = load_mwa_database(xml_file)
+    assert parsed == []
+    assert sorted(cached) == sorted(columns)
+    for name in columns:
+        np.testing.assert_array_equal(cached[name], columns[name])
+    # same size, new mtime
+    stat = os.stat(xml_file)
+    os.utime(xml_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    load_mwa_database(xml_file)
+    assert parsed == [xml_file]
+    # new size
+    write_database(str(tmp_path), MWA_DATABASE.replace('radii="20"', 'radii="25 25"'))
+    assert load_mwa_database(xml_file)["Radii"][1].tolist()[:2] == [25, 25]
+    assert parsed == [xml_file, xml_file]
+    load_mwa_database(xml_file)
+    assert len(parsed) == 2
@@ -2,27 +2,78 @@
 
 import numpy as np
 import numpy.linalg
-import io
+import xml.etree.ElementTree as ET
 from scipy import misc
 import dicom
 from dicom.dataset import Dataset, FileDataset
 import datetime, time
 import os
-import uuid
-import hashlib
-from random import random
 import SimpleITK as sitk
+from dicom_uid import make_uid
+
+def _tag_text(xml_tag):
+    # untangle element (cdata), ElementTree element (text) or the text itself
+    if hasattr(xml_tag, 'cdata'):
+        return xml_tag.cdata
+    if hasattr(xml_tag, 'text'):
+        return xml_tag.text or ''
+    return xml_tag
+
+
+def txt_to_mats(xml_tags):
+    """
+    Parse the 3x4 transform matrices of many XML tags at once.
+    :param xml_tags: list of untangle or ElementTree elements, or their texts, 12 numbers each
+    :return: (N, 4, 4) float64 array of homogeneous transforms
+    """
+    texts = [_tag_text(xml_tag) for xml_tag in xml_tags]
+    values = np.array(' '.join(texts).split(), dtype=np.float64)
+    if values.size != 12 * len(texts):
+        raise ValueError('Expected 12 numbers per transform tag, got %d numbers for %d tags' % (values.size,
+                                                                                               len(texts)))
+    mats = np.zeros((len(texts), 4, 4))
+    mats[:, 0:3, :] = values.reshape(len(texts), 3, 4)
+    mats[:, 3, 3] = 1
+    return mats
+
+
+def read_recording_transforms(xml_file, tag_names=None):
+    """
+    Gather the transform tags of a CAS-One recording XML and parse them together.
+    :param xml_file: XML filepath
+    :param tag_names: names of the transform tags, None for all the leaf elements whose text is 12 numbers (pass the
+    names if the recording has other elements of 12 numbers)
+    :return: list of the tag names (in document order) and the (N, 4, 4) float64 array of their transforms
+    """
+    names, texts = [], []
+    for event, element in ET.iterparse(xml_file):
+        if len(element) == 0 and element.text and (tag_names is None or element.tag in tag_names):
+            tokens = element.text.split()
+            if tag_names is not None or (len(tokens) == 12 and _all_numbers(tokens)):
+                names.append(element.tag)
+                texts.append(element.text)
+    return names, txt_to_mats(texts)
+
+
+def _all_numbers(tokens):
+    try:
+        [float(token) for token in tokens]
+    except ValueError:
+        return False
+    return True
+
 
 def txt_to_mat(xml_tag):
-    mat_1 = np.array([[0, 0, 0, 1]])
-    mat_34 = np.genfromtxt(io.BytesIO(xml_tag.cdata.encode()))
-    mat = np.concatenate([mat_34, mat_1])
-    return np.matrix(mat)
+    return np.matrix(txt_to_mats([xml_tag])[0])
+
+
+# the mat_get_ helpers take a single (4, 4) transform or a stack (N, 4, 4) of transforms
 
 
 def mat_get_rotation(transform_mat):
-    rotation_mat = np.eye(4)
-    rotation_mat[0:3, 0:3] = transform_mat[0:3, 0:3]
+    transform_mat = np.asarray(transform_mat)
+    rotation_mat = np.broadcast_to(np.eye(4), transform_mat.shape).copy()
+    rotation_mat[..., 0:3, 0:3] = transform_mat[..., 0:3, 0:3]
     return rotation_mat
 
 
@@ -31,12 +82,9 @@ def mat_get_rotation_vec(transform_mat):
 
 
 def mat_get_rotation_vec1(transform_mat):
-    rotation_vec = np.ndarray(9)
-    rotation_mat = mat_get_rotation(transform_mat)
-    rotation_vec[0:3] = rotation_mat[0, 0:3]
-    rotation_vec[3:6] = rotation_mat[1, 0:3]
-    rotation_vec[6:9] = rotation_mat[2, 0:3]
-    return rotation_vec
+    # rows of the rotation
+    transform_mat = np.asarray(transform_mat)
+    return transform_mat[..., 0:3, 0:3].reshape(transform_mat.shape[:-2] + (9,)).astype(np.float64)
 
 
 def mat_get_inv(transform_mat):
@@ -44,25 +92,21 @@ def mat_get_inv(transform_mat):
 
 
 def mat_get_rotation_vec2(transform_mat):
-    rotation_vec = np.ndarray(9)
-    rotation_mat = mat_get_rotation(transform_mat)
-    rotation_vec[0:3] = rotation_mat[0:3, 0]
-    rotation_vec[3:6] = rotation_mat[0:3, 1]
-    rotation_vec[6:9] = rotation_mat[0:3, 2]
-    return rotation_vec
+    # columns of the rotation
+    transform_mat = np.asarray(transform_mat)
+    rotation_vec = np.swapaxes(transform_mat[..., 0:3, 0:3], -1, -2)
+    return rotation_vec.reshape(transform_mat.shape[:-2] + (9,)).astype(np.float64)
 
 
 def mat_get_translation_mat(transform_mat):
-    translation_mat = np.eye(4)
-    translation_mat[0, 3] = transform_mat[0, 3]
-    translation_mat[1, 3] = transform_mat[1, 3]
-    translation_mat[2, 3] = transform_mat[2, 3]
+    transform_mat = np.asarray(transform_mat)
+    translation_mat = np.broadcast_to(np.eye(4), transform_mat.shape).copy()
+    translation_mat[..., 0:3, 3] = transform_mat[..., 0:3, 3]
     return translation_mat
 
 
 def mat_get_translation_vec(transform_mat):
-    translation_vec = mat_get_translation_mat(transform_mat)[0:3, 3]
-    return translation_vec
+    return np.asarray(transform_mat)[..., 0:3, 3].astype(np.float64)
 
 
 def mat_get_rot90_y():
@@ -99,32 +143,6 @@ def write_image_dicom(image, file_name, metadata_file, image_number = 0):
 
     dcm_image.save_as(file_name)
 
-def make_uid(entropy_srcs=None, prefix='2.25.'):
-    """Generate a DICOM UID value.
-    Follows the advice given at:
-    http://www.dclunie.com/medical-image-faq/html/part2.html#UID
-    Parameters
-    ----------
-    entropy_srcs : list of str or None
-        List of strings providing the entropy used to generate the UID. If
-        None these will be collected from a combination of HW address, time,
-        process ID, and randomness.
-    prefix : prefix
-    """
-    # Combine all the entropy sources with a hashing algorithm
-    if entropy_srcs is None:
-        entropy_srcs = [str(uuid.uuid1()), # 128-bit from MAC/time/randomness
-                        str(os.getpid()), # Current process ID
-                        random().hex() # 64-bit randomness
-                       ]
-    hash_val = hashlib.sha256(''.join(entropy_srcs))
-
-    # Converet this to an int with the maximum available digits
-    avail_digits = 64 - len(prefix)
-    int_val = int(hash_val.hexdigest(), 16) % (10 ** avail_digits)
-
-    return prefix  + str(int_val)
-
 
 class DicomWriter:
 
@@ -3,76 +3,136 @@
 Created on Fri Jun  1 16:59:22 2018
 
 @author: Raluca Sandu
+
+Load the ablation geometry of all the MWA needles of the CAS-One MWA database XML into columns of NumPy arrays
+(radii, translation and rotation as (N, 3) float arrays), cached next to the XML as a compressed npz table.
 """
+import argparse
+import os
+import xml.etree.ElementTree as ET
 
+import numpy as np
 import pandas as pd
-import untangle as ut
-
-filename = "CAS-One MWA_Database.xml"
-''' try to open and parse the xml filename
-    if error, return message
-'''
-# TO DO: add the patient ID from the folder name
-try:
-    xmlobj = ut.parse(filename)
-except Exception:
-    print('XML file structure is broken, cannot read XML')
-
-dict_mwa_info = []
-mwa_needle_info = xmlobj.Eagles.Database.MWA
-for needle in mwa_needle_info:
-    # "Acculis MTA" has id=0
-    if needle['id'] == '4':
-        covidien_needle = needle
-        ablation_params = covidien_needle.AblationParameters[0].Geometry.Shape
-        for idx, ablation_param in enumerate(ablation_params):
-            mwa_info = {'Device_name': "Covidien (Covidien MWA)",
-                        'NeedleType': "Covidien (Covidien MWA)",
-                        'Shape': idx,
-                        'Type': ablation_param["type"],
-                        'Power': ablation_param["power"],
-                        'Time_Duration_Applied': ablation_param["time"],
-                        'Radii': ablation_param["radii"],
-                        'Translation': ablation_param["translation"],
-                        'Rotation': ablation_param["rotation"]
-                        }
-            dict_mwa_info.append(mwa_info)
-    if needle['id'] == '5':
-        amica_needle = needle
-        ablation_params = amica_needle.AblationParameters.Geometry.Shape
-        for idx, ablation_param in enumerate(ablation_params):
-            mwa_info = {'Device_name': "Amica (Probe)",
-                        'NeedleType': "Probe",
-                        'Shape': idx,
-                        'Type': ablation_param["type"],
-                        'Power': ablation_param["power"],
-                        'Time_Duration_Applied': ablation_param["time"],
-                        'Radii': ablation_param["radii"],
-                        'Translation': ablation_param["translation"],
-                        'Rotation': ablation_param["rotation"]
-                        }
-            dict_mwa_info.append(mwa_info)
-    if needle['id'] == '10':
-        angiodynamics_needle = needle
-        ablation_params = angiodynamics_needle.AblationParameters[0].Geometry.Shape
-        for idx, ablation_param in enumerate(ablation_params):
-            mwa_info = {'Device_name': 'Angyodinamics (Acculis)',
-                        'NeedleType': "Acculis",
-                        'Shape': idx,
-                        'Type': ablation_param["type"],
-                        'Power': ablation_param["power"],
-                        'Time_Duration_Applied': ablation_param["time"],
-                        'Radii': ablation_param["radii"],
-                        'Translation': ablation_param["translation"],
-                        'Rotation': ablation_param["rotation"]
-                        }
-            dict_mwa_info.append(mwa_info)
-
-df_mwa = pd.DataFrame(dict_mwa_info)
-# %%
-filename = 'Ellipsoid_Brochure_Info.xlsx'
-writer = pd.ExcelWriter(filename)
-df_mwa.to_excel(writer, sheet_name='Ellipsoid_Info', index=False, na_rep='NaN')
-writer.save()
+
+# needle id -> (Device_name, NeedleType) of the needles named in the brochure, the others keep the database name
+NEEDLE_NAMES = {'4': ("Covidien (Covidien MWA)", "Covidien (Covidien MWA)"),
+                '5': ("Amica (Probe)", "Probe"),
+                '10': ('Angyodinamics (Acculis)', "Acculis")}
+VECTOR_FIELDS = ["radii", "translation", "rotation"]
+CACHE_VERSION = 1
+
+
+def parse_vectors(vector_strings):
+    """
+    Parse all the vector attributes of a field at once.
+    :param vector_strings: list of strings of numbers separated by spaces or commas, eg. ["10 15 15", ...]
+    :return: (N, k) float64 array, the short vectors padded with NaN
+    """
+    tokens = [vector.replace(',', ' ').split() if vector else [] for vector in vector_strings]
+    lengths = np.array([len(vector) for vector in tokens], dtype=int)
+    n_columns = lengths.max() if len(lengths) else 0
+    values = np.array([value for vector in tokens for value in vector], dtype=np.float64)
+    vectors = np.full((len(tokens), n_columns), np.nan)
+    # row and column of each value in the flat array
+    rows = np.repeat(np.arange(len(tokens)), lengths)
+    columns = np.arange(len(values)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    vectors[rows, columns] = values
+    return vectors
+
+
+def _float_or_nan(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def parse_mwa_database(xml_file):
+    """
+    Read the ablation shapes of all the needles of the MWA database.
+    :param xml_file: CAS-One MWA_Database.xml filepath
+    :return: dict column name -> NumPy array, one row per ablation shape
+    """
+    root = ET.parse(xml_file).getroot()
+    rows = {"NeedleID": [], "Device_name": [], "NeedleType": [], "Shape": [], "Type": [], "Power": [],
+            "Time_Duration_Applied": []}
+    vector_strings = {field: [] for field in VECTOR_FIELDS}
+    for needle in root.iterfind('Database/MWA'):
+        needle_id = needle.get('id', '')
+        default_name = needle.get('name', 'MWA id ' + needle_id)
+        device_name, needle_type = NEEDLE_NAMES.get(needle_id, (default_name, default_name))
+        # the first ablation parameters set of the needle
+        first_parameters = needle.find('AblationParameters')
+        shapes = first_parameters.findall('Geometry/Shape') if first_parameters is not None else []
+        for idx, shape in enumerate(shapes):
+            rows["NeedleID"].append(needle_id)
+            rows["Device_name"].append(device_name)
+            rows["NeedleType"].append(needle_type)
+            rows["Shape"].append(idx)
+            rows["Type"].append(shape.get("type", ''))
+            rows["Power"].append(_float_or_nan(shape.get("power")))
+            rows["Time_Duration_Applied"].append(_float_or_nan(shape.get("time")))
+            for field in VECTOR_FIELDS:
+                vector_strings[field].append(shape.get(field))
+    columns = {"NeedleID": np.array(rows["NeedleID"], dtype=str),
+               "Device_name": np.array(rows["Device_name"], dtype=str),
+               "NeedleType": np.array(rows["NeedleType"], dtype=str),
+               "Shape": np.array(rows["Shape"], dtype=np.int64),
+               "Type": np.array(rows["Type"], dtype=str),
+               "Power": np.array(rows["Power"], dtype=np.float64),
+               "Time_Duration_Applied": np.array(rows["Time_Duration_Applied"], dtype=np.float64)}
+    for field in VECTOR_FIELDS:
+        columns[field.capitalize()] = parse_vectors(vector_strings[field])
+    return columns
+
+
+def load_mwa_database(xml_file, cache_file=None, use_cache=True):
+    """
+    Load the MWA database from the npz cache if it was written from the same XML (size and mtime), otherwise parse
+    the XML and write the cache.
+    :param xml_file: CAS-One MWA_Database.xml filepath
+    :param cache_file: npz filepath, default the XML filepath with the .npz extension
+    :param use_cache: read and write the cache
+    :return: dict column name -> NumPy array (see parse_mwa_database)
+    """
+    if cache_file is None:
+        cache_file = os.path.splitext(xml_file)[0] + '.npz'
+    stat = os.stat(xml_file)
+    source = np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if use_cache and os.path.isfile(cache_file):
+        with np.load(cache_file, allow_pickle=False) as cached:
+            if np.array_equal(cached["_source"], source):
+                return {name: cached[name] for name in cached.files if name != "_source"}
+    columns = parse_mwa_database(xml_file)
+    if use_cache:
+        np.savez_compressed(cache_file, _source=source, **columns)
+    return columns
+
+
+def mwa_dataframe(columns):
+    """
+    :param columns: dict column name -> NumPy array (see load_mwa_database)
+    :return: pandas DataFrame with one row per ablation shape, the vectors written as space separated strings
+    """
+    df_mwa = pd.DataFrame({name: values for name, values in columns.items() if values.ndim == 1})
+    for field in VECTOR_FIELDS:
+        name = field.capitalize()
+        df_mwa[name] = [' '.join('%g' % value for value in vector if not np.isnan(value))
+                        for vector in columns[name]]
+    return df_mwa
 
 
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--xml_file", required=False, default="CAS-One MWA_Database.xml",
+                    help="CAS-One MWA database XML")
+    ap.add_argument("-o", "--output", required=False, default='Ellipsoid_Brochure_Info.xlsx',
+                    help="output Excel file")
+    args = vars(ap.parse_args())
+    try:
+        mwa_columns = load_mwa_database(args["xml_file"])
+    except ET.ParseError:
+        print('XML file structure is broken, cannot read XML')
+        raise
+    df_mwa = mwa_dataframe(mwa_columns)
+    df_mwa.to_excel(args["output"], sheet_name='Ellipsoid_Info', index=False, na_rep='NaN')
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the decoded DICOM series: each series is read once with GDCM and stored as a raw .npy volume
+(z, y, x) with the source pixel type, plus a json sidecar with its geometry (origin, spacing, direction), a few key
+tags and the size and mtime of the source files. An entry is keyed by the real path of the folder (or file list) and
+the selected SeriesInstanceUID, and is valid while the source files are unchanged; the later loads are a
+memory-mapped np.load instead of decoding the series again. The NumPy callers get the memory-mapped volume itself
+(load_series), the SimpleITK image of load_image is a copy of it.
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import SimpleITK as sitk
+
+from DicomReader import read_dcm_metadata, read_dcm_series
+
+CACHE_VERSION = 2
+KEY_TAGS = ["SeriesInstanceUID", "StudyInstanceUID", "PatientID", "Modality", "SeriesNumber"]
+
+
+def series_filepaths(path):
+    """
+    :param path: folder of the series or list of filepaths
+    :return: sorted list of the real absolute filepaths, the same for a relative path or a symbolic link
+    """
+    if isinstance(path, str):
+        filepaths = [os.path.join(path, f) for f in os.listdir(path)]
+        filepaths = [f for f in filepaths if os.path.isfile(f)]
+    else:
+        filepaths = list(path)
+    return sorted(os.path.realpath(f) for f in filepaths)
+
+
+def files_state(filepaths):
+    """
+    :param filepaths: list of filepaths
+    :return: list of [filepath, size, mtime] sorted by filepath, compared to detect a changed series
+    """
+    state = []
+    for filepath in sorted(os.path.realpath(f) for f in filepaths):
+        stat = os.stat(filepath)
+        state.append([filepath, stat.st_size, stat.st_mtime_ns])
+    return state
+
+
+def entry_key(path, series_uid=None):
+    """
+    :param path: folder of the series or list of the series filepaths
+    :param series_uid: SeriesInstanceUID selected in the folder, None for the series GDCM reads by default
+    :return: name of the cache entry of this series selection
+    """
+    source = os.path.realpath(path) if isinstance(path, str) else series_filepaths(path)
+    return hashlib.sha1(json.dumps([source, series_uid]).encode('utf-8')).hexdigest()
+
+
+def read_key_tags(filepaths):
+    """
+    :param filepaths: list of filepaths of a single series
+    :return: dict of the KEY_TAGS values of the first DICOM file, None if there is no DICOM file
+    """
+    for filepath in filepaths:
+        ds = read_dcm_metadata(filepath, KEY_TAGS)
+        if ds is not None:
+            return {tag: str(ds.get(tag, '')) for tag in KEY_TAGS}
+    return None
+
+
+def read_series_image(path, series_uid=None):
+    """
+    GDCM read of a series, with the pixel type of the source (see DicomReader.read_dcm_series).
+    :param path: folder of the series or list of the series filepaths, in slice order
+    :param series_uid: SeriesInstanceUID selected in the folder
+    :return: SimpleITK Image and ImageSeriesReader, None, None if the series is not readable
+    """
+    if isinstance(path, str):
+        return read_dcm_series(path, True, series_uid=series_uid)
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames(list(path))
+    reader.MetaDataDictionaryArrayUpdateOn()
+    reader.LoadPrivateTagsOn()
+    try:
+        return reader.Execute(), reader
+    except Exception:
+        print('Non-readable DICOM Data: ', path[0] if path else path)
+        return None, None
+
+
+def volume_to_sitk(volume, geometry):
+    """
+    The image owns a copy of the pixels, use the volume itself where a NumPy array is enough.
+    :param volume: (z, y, x) NumPy array, eg. a memory-mapped cached volume
+    :param geometry: dict with Origin, Spacing and Direction (see DicomReader.series_geometry)
+    :return: SimpleITK Image with the geometry of the series
+    """
+    image = sitk.GetImageFromArray(volume)
+    image.SetOrigin(geometry["Origin"])
+    image.SetSpacing(geometry["Spacing"])
+    image.SetDirection(geometry["Direction"])
+    return image
+
+
+class CachedSeriesReader(object):
+
+    def __init__(self, filenames):
+        """
+        Stands for the ImageSeriesReader of a series loaded from the cache: the same file names and metadata
+        accessors, the header of a slice is read (GDCM, without the pixel data) the first time its metadata is asked.
+        :param filenames: files of the series in slice order
+        """
+        self.filenames = tuple(filenames)
+        self._file_readers = {}
+
+    def _file_reader(self, slice_index):
+        if slice_index not in self._file_readers:
+            file_reader = sitk.ImageFileReader()
+            file_reader.SetFileName(self.filenames[slice_index])
+            file_reader.LoadPrivateTagsOn()
+            file_reader.ReadImageInformation()
+            self._file_readers[slice_index] = file_reader
+        return self._file_readers[slice_index]
+
+    def GetFileNames(self):
+        return self.filenames
+
+    def GetMetaDataKeys(self, slice_index):
+        return self._file_reader(slice_index).GetMetaDataKeys()
+
+    def HasMetaDataKey(self, slice_index, key):
+        return self._file_reader(slice_index).HasMetaDataKey(key)
+
+    def GetMetaData(self, slice_index, key):
+        return self._file_reader(slice_index).GetMetaData(key)
+
+
+class VolumeDiskCache(object):
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: folder of the cached volumes, created if it does not exist
+        """
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_paths(self, key):
+        entry = os.path.join(self.cache_dir, key)
+        return entry + '.npy', entry + '.json'
+
+    def get(self, key, filepaths, mmap_mode='r'):
+        """
+        :param key: entry name (see entry_key)
+        :param filepaths: current filepaths of the series folder or list
+        :param mmap_mode: np.load memory map mode, None to read the volume into memory
+        :return: volume and geometry dict, None, None if not cached or the series files changed
+        """
+        npy_file, json_file = self._entry_paths(key)
+        try:
+            with open(json_file, 'r') as fp:
+                sidecar = json.load(fp)
+            if sidecar["Version"] != CACHE_VERSION or sidecar["FilesState"] != files_state(filepaths):
+                raise ValueError('outdated volume cache entry')
+            volume = np.load(npy_file, mmap_mode=mmap_mode, allow_pickle=False)
+            if list(volume.shape) != sidecar["Shape"] or str(volume.dtype) != sidecar["Dtype"]:
+                raise ValueError('volume cache entry does not match its sidecar')
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None, None
+        self.hits += 1
+        return volume, sidecar["Geometry"]
+
+    def put(self, key, filepaths, volume, geometry, tags=None):
+        """
+        Write the volume (temporary file + rename) then its sidecar, an entry without sidecar is never read.
+        :param key: entry name (see entry_key)
+        :param filepaths: filepaths of the series folder or list the volume was read from
+        :param volume: (z, y, x) NumPy array
+        :param geometry: dict with Origin, Spacing, Direction, Size and Files
+        :param tags: dict of key tags kept in the sidecar
+        :return: filepath of the cached volume
+        """
+        npy_file, json_file = self._entry_paths(key)
+        tags = tags if tags is not None else {}
+        sidecar = {"Version": CACHE_VERSION,
+                   "SeriesInstanceUID": tags.get("SeriesInstanceUID"),
+                   "Shape": list(volume.shape),
+                   "Dtype": str(volume.dtype),
+                   "Geometry": geometry,
+                   "Tags": tags,
+                   "FilesState": files_state(filepaths)}
+        for filepath, content in [(npy_file, volume), (json_file, sidecar)]:
+            fd, temp_file = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb' if filepath == npy_file else 'w') as fp:
+                    if filepath == npy_file:
+                        np.save(fp, content, allow_pickle=False)
+                    else:
+                        json.dump(content, fp)
+                os.replace(temp_file, filepath)
+            except Exception:
+                os.remove(temp_file)
+                raise
+        return npy_file
+
+    def _put_image(self, key, filepaths, image, reader):
+        filenames = list(reader.GetFileNames())
+        geometry = {"Origin": image.GetOrigin(),
+                    "Spacing": image.GetSpacing(),
+                    "Direction": image.GetDirection(),
+                    "Size": image.GetSize(),
+                    "Files": filenames}
+        volume = sitk.GetArrayViewFromImage(image)
+        self.put(key, filepaths, volume, geometry, read_key_tags(filenames))
+        return volume, geometry
+
+    def load_series(self, path, series_uid=None, mmap_mode='r'):
+        """
+        Load a DICOM series as a NumPy array from the cache, read it with GDCM and cache it if needed.
+        The volume has the pixel type GDCM reads from the source (eg. uint8 masks, int16 CT).
+        :param path: folder of the series or list of the series filepaths, in slice order
+        :param series_uid: SeriesInstanceUID selected in the folder, None for the series GDCM reads by default
+        :param mmap_mode: np.load memory map mode of the cached volume
+        :return: (z, y, x) volume and geometry dict (Origin, Spacing, Direction, Size, Files), None, None if the
+        series is not readable
+        """
+        key = entry_key(path, series_uid)
+        filepaths = series_filepaths(path)
+        volume, geometry = self.get(key, filepaths, mmap_mode)
+        if volume is None:
+            image, reader = read_series_image(path, series_uid)
+            if image is None:
+                return None, None
+            volume, geometry = self._put_image(key, filepaths, image, reader)
+            volume = np.array(volume)
+        return volume, geometry
+
+    def load_image(self, path, series_uid=None):
+        """
+        Same series selection as DicomReader.read_dcm_series, the image of a cache hit is the image of a miss.
+        :param path: folder of the series or list of the series filepaths, in slice order
+        :param series_uid: SeriesInstanceUID selected in the folder, None for the series GDCM reads by default
+        :return: SimpleITK Image and the reader of its metadata: the ImageSeriesReader on a miss, a
+        CachedSeriesReader on a hit. None, None if the series is not readable.
+        """
+        key = entry_key(path, series_uid)
+        filepaths = series_filepaths(path)
+        volume, geometry = self.get(key, filepaths)
+        if volume is not None:
+            return volume_to_sitk(volume, geometry), CachedSeriesReader(geometry["Files"])
+        image, reader = read_series_image(path, series_uid)
+        if image is not None:
+            self._put_image(key, filepaths, image, reader)
+        return image, reader
+
+    def invalidate(self, series_uid=None):
+        """
+        :param series_uid: SeriesInstanceUID of the entries to remove, None for all the entries
+        :return: number of entries removed
+        """
+        removed = 0
+        for filename in os.listdir(self.cache_dir):
+            key, extension = os.path.splitext(filename)
+            if extension != '.json':
+                continue
+            if series_uid is not None:
+                try:
+                    with open(os.path.join(self.cache_dir, filename), 'r') as fp:
+                        if json.load(fp).get("SeriesInstanceUID") != series_uid:
+                            continue
+                except (OSError, ValueError):
+                    pass
+            for filepath in self._entry_paths(key):
+                if os.path.isfile(filepath):
+                    os.remove(filepath)
+            removed += 1
+        return removed
+
+
+def benchmark_volume_cache(folder, cache_dir, repeat=5):
+    """
+    Compare the GDCM series read (DicomReader.read_dcm_series) with the cold and the warm cache loads.
+    :param folder: folder of a single DICOM series
+    :param cache_dir: volume cache folder, the series entry is removed first
+    :param repeat: number of warm loads, the best time is kept
+    :return: dict load mode -> seconds
+    """
+    cache = VolumeDiskCache(cache_dir)
+    cache.invalidate(read_key_tags(series_filepaths(folder))["SeriesInstanceUID"])
+    timings = {}
+    start = time.perf_counter()
+    read_dcm_series(folder, False)
+    timings["GDCM read_dcm_series"] = time.perf_counter() - start
+    start = time.perf_counter()
+    cache.load_series(folder)
+    timings["cold cache (read + store)"] = time.perf_counter() - start
+    load_modes = {"warm cache, memory-mapped": lambda: cache.load_series(folder),
+                  "warm cache, SimpleITK image": lambda: cache.load_image(folder)}
+    for name, load_mode in load_modes.items():
+        seconds = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            load_mode()
+            seconds.append(time.perf_counter() - start)
+        timings[name] = min(seconds)
+    return timings
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-i", "--series", required=True, help="folder of a DICOM series")
+    ap.add_argument("-c", "--cache_dir", required=True, help="volume cache folder")
+    ap.add_argument("-r", "--repeat", required=False, type=int, default=5, help="number of warm cache loads")
+    args = vars(ap.parse_args())
+    for name, seconds in benchmark_volume_cache(args["series"], args["cache_dir"], args["repeat"]).items():
+        print('%-30s %8.4f s' % (name, seconds))
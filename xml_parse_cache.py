@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent (SQLite) cache of the values extracted from the CAS-One XML recordings: the segmentation records of
+create_tumour_ablation_mapping and the patient metadata of encode_xml. An entry is valid while the file has the same
+size and mtime, or the same content hash if only the mtime changed (eg. a copied folder), so the unchanged files
+are not parsed again by the following batch runs. The content hash is not computed when an entry is added: the
+callers pass the hash of the bytes they parsed (HashingFile), entries without it are only valid for the same mtime.
+The cache is capped in size, the least recently used entries are evicted first. The changes are kept in memory and
+written in one transaction every COMMIT_EVERY_N_CHANGES changes and on close().
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from batch_manifest import file_sha1
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+COMMIT_EVERY_N_CHANGES = 100
+EVICT_TO_FRACTION = 0.9  # evict below the cap so that the following puts do not evict again
+
+
+class HashingFile(object):
+    """
+    File object wrapper computing the sha1 of the bytes read or written through it, eg. the XML file given to
+    xml.sax.parse, so the content hash of a parsed file costs no extra read.
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self._sha1 = hashlib.sha1()
+
+    def read(self, *args):
+        data = self.fp.read(*args)
+        self._sha1.update(data)
+        return data
+
+    def write(self, data):
+        self._sha1.update(data)
+        return self.fp.write(data)
+
+    def hexdigest(self):
+        return self._sha1.hexdigest()
+
+    def close(self):
+        self.fp.close()
+
+
+class XmlParseCache(object):
+
+    def __init__(self, db_file, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        :param db_file: SQLite database filepath, created if it does not exist. It can be shared by the worker
+        processes of a batch run.
+        :param max_bytes: maximum total size of the cached values (json), LRU eviction above it
+        """
+        self.db_file = db_file
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # pending changes, written to the database at the next commit
+        self._used = {}  # (path, kind) -> last used time
+        self._puts = {}  # (path, kind) -> row
+        self.connection = sqlite3.connect(db_file, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+                                "path TEXT, kind TEXT, size INTEGER, mtime INTEGER, sha1 TEXT, value TEXT, "
+                                "nbytes INTEGER, last_used REAL, PRIMARY KEY (path, kind))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        self.connection.commit()
+        self.total_bytes = self._stored_bytes()
+
+    def get(self, path, kind):
+        """
+        :param path: XML filepath
+        :param kind: name of the extracted value, eg. the name of the extracting function
+        :return: the cached value, None if not cached or the file changed
+        """
+        path = os.path.normpath(path)
+        row = self._row(path, kind)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            row = None
+        # the content hash is only computed to validate an mtime-only change
+        if row is not None and (row[2] != stat.st_size or
+                                (row[3] != stat.st_mtime_ns and (row[4] is None or file_sha1(path) != row[4]))):
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if row[3] != stat.st_mtime_ns or (path, kind) in self._puts:
+            # same content with a new mtime, or an entry not written yet
+            self._puts[(path, kind)] = row[:3] + (stat.st_mtime_ns,) + row[4:7] + (time.time(),)
+        else:
+            self._used[(path, kind)] = time.time()
+        self._changed()
+        return json.loads(row[5])
+
+    def put(self, path, kind, value, sha1=None):
+        """
+        Cache the value extracted from the file in its current state.
+        :param path: XML filepath
+        :param kind: name of the extracted value
+        :param value: json serializable value
+        :param sha1: content hash of the file if the caller has it (HashingFile), the entry then survives an
+        mtime-only change
+        :return:
+        """
+        path = os.path.normpath(path)
+        stat = os.stat(path)
+        value = json.dumps(value)
+        row = self._row(path, kind)
+        self.total_bytes += len(value) - (row[6] if row is not None else 0)
+        self._puts[(path, kind)] = (path, kind, stat.st_size, stat.st_mtime_ns, sha1, value, len(value), time.time())
+        self._used.pop((path, kind), None)
+        self._changed()
+
+    def _row(self, path, kind):
+        row = self._puts.get((path, kind))
+        if row is None:
+            row = self.connection.execute("SELECT * FROM entries WHERE path=? AND kind=?", (path, kind)).fetchone()
+        return row
+
+    def _changed(self):
+        if self.total_bytes > self.max_bytes or len(self._puts) + len(self._used) >= COMMIT_EVERY_N_CHANGES:
+            self.commit()
+
+    def _stored_bytes(self):
+        return self.connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM entries").fetchone()[0]
+
+    def _evict(self):
+        # the other processes sharing the database may have added entries since the running total was read
+        self.total_bytes = self._stored_bytes()
+        if self.total_bytes <= self.max_bytes:
+            return
+        evicted = []
+        for path, kind, nbytes in self.connection.execute("SELECT path, kind, nbytes FROM entries "
+                                                          "ORDER BY last_used"):
+            if self.total_bytes <= self.max_bytes * EVICT_TO_FRACTION:
+                break
+            evicted.append((path, kind))
+            self.total_bytes -= nbytes
+        self.connection.executemany("DELETE FROM entries WHERE path=? AND kind=?", evicted)
+
+    def invalidate(self, path=None, kind=None):
+        """
+        Remove entries from the cache.
+        :param path: XML filepath or folder (all the files under it), None for all the files
+        :param kind: name of the extracted value, None for all
+        :return: number of entries removed
+        """
+        conditions, params = [], []
+        if path is not None:
+            path = os.path.normpath(path)
+            conditions.append("(path=? OR substr(path, 1, ?)=?)")
+            params += [path, len(path) + 1, os.path.join(path, '')]
+        if kind is not None:
+            conditions.append("kind=?")
+            params.append(kind)
+        query = "DELETE FROM entries" + (" WHERE " + " AND ".join(conditions) if conditions else "")
+        self.commit()
+        removed = self.connection.execute(query, params).rowcount
+        self.total_bytes = self._stored_bytes()
+        self.connection.commit()
+        return removed
+
+    def commit(self):
+        """
+        Write the pending entries and the last used time of the entries read in one transaction, evict the least
+        recently used entries if the cache is above its size.
+        :return:
+        """
+        self.connection.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    list(self._puts.values()))
+        self.connection.executemany("UPDATE entries SET last_used=? WHERE path=? AND kind=?",
+                                    [(used, path, kind) for (path, kind), used in self._used.items()])
+        self._puts = {}
+        self._used = {}
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()